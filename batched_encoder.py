@@ -0,0 +1,107 @@
+'''
+Encoding of the observations of several evaluation threads in one call of the encoder.
+
+Every thread of the PopulationEvaluator needs the latent vector of one frame at a time. Instead of making each
+thread call encoder.predict on a batch of one frame, the frames are gathered by a server thread and encoded together.
+'''
+from concurrent.futures import Future
+from queue import Queue, Empty
+import numpy as np
+import threading
+import time
+
+
+class BatchedEncoder():
+
+	def __init__(self, encoder, session, graph, max_batch_size=8, max_wait=0.002):
+		'''
+		:param encoder: keras model of the encoder (VAE.encoder)
+		:param session, graph: tensorflow session and graph of the encoder, None for a numpy_inference.NumpyModel
+		:param max_batch_size: maximum number of frames encoded at once (the number of evaluation threads is enough)
+		:param max_wait: maximum time (seconds) the first frame of a batch waits for other frames
+		'''
+		self.encoder = encoder
+		self.session = session
+		self.graph = graph
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.requests = Queue()
+		self.lock = threading.Lock()
+		self.reset_stats()
+		self.thread = threading.Thread(target=self._serve, daemon=True)
+		self.thread.start()
+
+	def encode(self, observation):
+		'''
+		Called by the evaluation threads, waits until the frame is encoded.
+
+		:param observation: frame of the emulator
+		:return: latent vector of the frame
+		'''
+		future = Future()
+		self.requests.put((observation, future, time.time()))
+		return future.result()
+
+	def _serve(self):
+		while True:
+			batch = [self.requests.get()]
+			deadline = time.time() + self.max_wait
+			while len(batch) < self.max_batch_size:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					batch.append(self.requests.get(timeout=timeout))
+				except Empty:
+					break
+
+			start = time.time()
+			try:
+				frames = np.array([request[0] for request in batch])
+				if self.session is None:
+					# NumPy encoder (numpy_inference.py)
+					latent_vectors = self.encoder.predict(frames, batch_size=len(frames))
+				else:
+					with self.session.as_default():
+						with self.graph.as_default():
+							latent_vectors = self.encoder.predict(frames)
+			except Exception as e:
+				for _, future, _ in batch:
+					future.set_exception(e)
+				continue
+			end = time.time()
+
+			for (_, future, _), latent_vector in zip(batch, latent_vectors):
+				future.set_result(latent_vector)
+
+			with self.lock:
+				self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+				self.nb_frames += len(batch)
+				self.predict_time += end - start
+				for _, _, request_time in batch:
+					latency = start - request_time
+					self.queue_latency += latency
+					self.max_queue_latency = max(self.max_queue_latency, latency)
+
+	def reset_stats(self):
+		with self.lock:
+			# Number of batches of every size
+			self.batch_sizes = {}
+			self.nb_frames = 0
+			self.predict_time = 0.
+			# Time between the request of a frame and the beginning of its encoding
+			self.queue_latency = 0.
+			self.max_queue_latency = 0.
+
+	def stats(self):
+		with self.lock:
+			nb_batches = sum(self.batch_sizes.values())
+			return {
+				'batches': nb_batches,
+				'frames': self.nb_frames,
+				'mean_batch_size': self.nb_frames / nb_batches if nb_batches else 0.,
+				'batch_sizes': dict(sorted(self.batch_sizes.items())),
+				'mean_queue_latency': self.queue_latency / self.nb_frames if self.nb_frames else 0.,
+				'max_queue_latency': self.max_queue_latency,
+				'predict_time': self.predict_time,
+			}
@@ -0,0 +1,287 @@
+'''
+Incremental checkpoints of the NEAT population, written in the background.
+
+neat.Checkpointer pickles the whole population at the end of a generation, while the evolution waits. Most genomes
+of a generation were already in the previous one (elites) or differ only by their fitness, so the genomes are saved
+in a table of pickled genomes identified by the hash of their pickle : a checkpoint only writes the genomes that are
+not in the files of its chain yet. Every full_interval checkpoints, a full checkpoint writes all its genomes and
+starts a new chain.
+
+Files of a checkpoint of generation g, in the checkpoints folder :
+	genomes-g.gz : table {hash : pickled genome} of the genomes not saved by the previous checkpoints of the chain
+	state-g.gz : population, species, config and random state, pickled with the hashes of the genomes instead of the
+		genomes (persistent ids), and the generations of the genomes files of the chain
+
+The evolution only takes a shallow snapshot of the population and the species : pickling, compression and writing
+are done by a thread during the next generation. The last keep_full chains are kept.
+
+Restore a checkpoint with restore_checkpoint(NEAT_DIR + '/checkpoints', generation), then call
+IncrementalCheckpointer.resume(generation) before the evolution continues.
+'''
+from constants import *
+import glob
+import gzip
+import copy
+import hashlib
+import io
+import neat
+import os
+import pickle
+import random
+import re
+import threading
+import time
+
+
+def _genome_path(directory, generation):
+	return os.path.join(directory, 'genomes-{0}.gz'.format(generation))
+
+
+def _state_path(directory, generation):
+	return os.path.join(directory, 'state-{0}.gz'.format(generation))
+
+
+def _write_files(files):
+	for path, data in files:
+		# Written under another name first, a checkpoint is never half written
+		with gzip.open(path + '.part', 'wb', compresslevel=5) as f:
+			f.write(data)
+		os.replace(path + '.part', path)
+
+
+class IncrementalCheckpointer(neat.reporting.BaseReporter):
+
+	def __init__(self, directory=NEAT_DIR + '/checkpoints', generation_interval=1, full_interval=10, keep_full=3):
+		'''
+		:param generation_interval: a checkpoint every generation_interval generations
+		:param full_interval: a full checkpoint every full_interval checkpoints
+		:param keep_full: number of chains (full checkpoint + the following ones) kept
+		'''
+		self.directory = directory
+		self.generation_interval = generation_interval
+		self.full_interval = full_interval
+		self.keep_full = keep_full
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.current_generation = None
+		# Generations of the genomes files of the current chain
+		self.chain = []
+		# The next checkpoint is a full one even in the middle of a chain
+		self.force_full = False
+		# Hashes of the genomes saved by the current chain
+		self.saved = set()
+		# id of a genome -> (genome, fitness, hash), genomes are not pickled again while their fitness doesn't change
+		self.hashes = {}
+		# Thread pickling and writing the previous checkpoint, and its exception
+		self.writer = None
+		self.writer_error = None
+
+	def resume(self, generation):
+		'''
+		To call when the evolution restarts from the population of generation (restored checkpoint) : the checkpoints
+		of the later generations are moved to a "replaced-..." folder (the next checkpoints would overwrite the files
+		their chains need) and the next checkpoint is a full one.
+		'''
+		self.wait()
+		newer = [g for g in list_checkpoints(self.directory) if g > generation]
+		if newer:
+			replaced_directory = os.path.join(self.directory, 'replaced-{0}-{1}'.format(generation, int(time.time())))
+			os.makedirs(replaced_directory)
+			for newer_generation in newer:
+				for path in (_state_path(self.directory, newer_generation),
+							 _genome_path(self.directory, newer_generation)):
+					if os.path.exists(path):
+						os.replace(path, os.path.join(replaced_directory, os.path.basename(path)))
+			print('checkpoints {0} moved to {1}'.format(newer, replaced_directory))
+		self.chain = []
+		self.saved = set()
+		self.hashes = {}
+		self.force_full = True
+
+	def start_generation(self, generation):
+		self.current_generation = generation
+
+	def end_generation(self, config, population, species_set):
+		# The population is the one of the next generation
+		generation = self.current_generation + 1
+		if generation % self.generation_interval == 0:
+			self.save_checkpoint(config, population, species_set, generation)
+
+	def _snapshot(self, population, species_set):
+		'''
+		Shallow copies of what the next generations modify (the fitness of the genomes, the species and their members),
+		the genes are shared : NEAT never modifies the genes of an existing genome.
+
+		:return: population, species set, {id(copy of a genome) : genome}
+		'''
+		copies = {}
+		originals = {}
+
+		def genome_copy(genome):
+			if id(genome) not in copies:
+				copies[id(genome)] = copy.copy(genome)
+				originals[id(copies[id(genome)])] = genome
+			return copies[id(genome)]
+
+		population_copy = {key: genome_copy(genome) for key, genome in population.items()}
+		species_set_copy = copy.copy(species_set)
+		# The reporters (this checkpointer among them) are given back by neat.Population when restoring
+		species_set_copy.reporters = None
+		species_set_copy.indexer = copy.copy(species_set.indexer)
+		species_set_copy.genome_to_species = dict(species_set.genome_to_species)
+		species_set_copy.species = {}
+		for key, species in species_set.species.items():
+			species_copy = copy.copy(species)
+			species_copy.members = {genome_key: genome_copy(genome) for genome_key, genome in species.members.items()}
+			if species.representative is not None:
+				species_copy.representative = genome_copy(species.representative)
+			species_copy.fitness_history = list(species.fitness_history)
+			species_set_copy.species[key] = species_copy
+		return population_copy, species_set_copy, originals
+
+	def _hash(self, genome, original, table):
+		known = self.hashes.get(id(original))
+		if known is not None and known[0] is original and known[1] == genome.fitness:
+			genome_hash = known[2]
+		else:
+			data = pickle.dumps(genome, pickle.HIGHEST_PROTOCOL)
+			genome_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+			if genome_hash not in self.saved:
+				table[genome_hash] = data
+		self.hashes[id(original)] = (original, genome.fitness, genome_hash)
+		return genome_hash
+
+	def save_checkpoint(self, config, population, species_set, generation):
+		'''
+		Only a snapshot of the population is taken here, the pickling and the writing are done by a thread while the
+		next generation is evaluated.
+		'''
+		self.wait()
+		full = self.force_full or len(self.chain) % self.full_interval == 0
+		self.force_full = False
+		if full:
+			self.chain = []
+			self.saved = set()
+			self.hashes = {}
+		self.chain.append(generation)
+		population_copy, species_set_copy, originals = self._snapshot(population, species_set)
+		state = {'generation': generation, 'chain': list(self.chain), 'config': config, 'population': population_copy,
+				 'species_set': species_set_copy, 'random_state': random.getstate()}
+		self.writer_error = None
+		self.writer = threading.Thread(target=self._write_checkpoint,
+									   args=(state, originals, config.genome_type, generation, full))
+		self.writer.start()
+
+	def _write_checkpoint(self, state, originals, genome_type, generation, full):
+		try:
+			table = {}
+			used_hashes = set()
+
+			def persistent_id(obj):
+				if isinstance(obj, genome_type):
+					genome_hash = self._hash(obj, originals[id(obj)], table)
+					used_hashes.add(genome_hash)
+					return genome_hash
+				return None
+
+			state_data = io.BytesIO()
+			pickler = pickle.Pickler(state_data, pickle.HIGHEST_PROTOCOL)
+			pickler.persistent_id = persistent_id
+			pickler.dump(state)
+			self.saved.update(table)
+			# Genomes that are not in the population anymore are forgotten
+			self.hashes = {key: value for key, value in self.hashes.items() if value[2] in used_hashes}
+
+			_write_files([(_genome_path(self.directory, generation), pickle.dumps(table, pickle.HIGHEST_PROTOCOL)),
+						  (_state_path(self.directory, generation), state_data.getvalue())])
+			print('checkpoint {0} : {1} genomes written, {2} referenced{3}'.format(
+				generation, len(table), len(used_hashes), ' (full)' if full else ''))
+		except Exception as e:
+			self.writer_error = e
+
+	def wait(self):
+		'''
+		Waits until the previous checkpoint is written, then removes the old checkpoints.
+		'''
+		if self.writer is None:
+			return
+		self.writer.join()
+		self.writer = None
+		if self.writer_error is not None:
+			print('checkpoint writing failed : {0!r}'.format(self.writer_error))
+			# The genomes of the failed checkpoint may not be saved, the next checkpoint starts a new chain
+			self.force_full = True
+			self.writer_error = None
+		self._apply_retention()
+
+	def _apply_retention(self):
+		generations = list_checkpoints(self.directory)
+		full_generations = [generation for generation in generations
+							if _read_state_header(self.directory, generation)[0] == generation]
+		if len(full_generations) <= self.keep_full:
+			return
+		oldest_kept = full_generations[-self.keep_full]
+		for generation in generations:
+			if generation < oldest_kept:
+				for path in (_state_path(self.directory, generation), _genome_path(self.directory, generation)):
+					if os.path.exists(path):
+						os.remove(path)
+
+	def close(self):
+		self.wait()
+
+
+def list_checkpoints(directory=NEAT_DIR + '/checkpoints'):
+	'''
+	:return: sorted generations of the checkpoints of a folder
+	'''
+	generations = []
+	for path in glob.glob(os.path.join(directory, 'state-*.gz')):
+		match = re.match(r'state-(\d+)\.gz$', os.path.basename(path))
+		if match:
+			generations.append(int(match.group(1)))
+	return sorted(generations)
+
+
+class _StateUnpickler(pickle.Unpickler):
+
+	def __init__(self, file, genomes=None):
+		super(_StateUnpickler, self).__init__(file)
+		self.genomes = genomes
+		self.loaded = {}
+
+	def persistent_load(self, genome_hash):
+		if self.genomes is None:
+			# Only the header is read
+			return None
+		# The same genome is shared by the population and its species
+		if genome_hash not in self.loaded:
+			self.loaded[genome_hash] = pickle.loads(self.genomes[genome_hash])
+		return self.loaded[genome_hash]
+
+
+def _read_state_header(directory, generation):
+	'''
+	:return: (first generation of the chain, generations of the chain) of a checkpoint
+	'''
+	with gzip.open(_state_path(directory, generation), 'rb') as f:
+		state = _StateUnpickler(f).load()
+	return state['chain'][0], state['chain']
+
+
+def restore_checkpoint(directory=NEAT_DIR + '/checkpoints', generation=None):
+	'''
+	:param generation: generation of the checkpoint, the last one if None
+	:return: neat.Population of the checkpoint
+	'''
+	if generation is None:
+		generation = list_checkpoints(directory)[-1]
+	_, chain = _read_state_header(directory, generation)
+	genomes = {}
+	for chain_generation in chain:
+		with gzip.open(_genome_path(directory, chain_generation), 'rb') as f:
+			genomes.update(pickle.load(f))
+	with gzip.open(_state_path(directory, generation), 'rb') as f:
+		state = _StateUnpickler(f, genomes).load()
+	random.setstate(state['random_state'])
+	return neat.Population(state['config'], (state['population'], state['species_set'], state['generation']))
@@ -17,12 +17,16 @@ NB_LIFES_AT_START = 3
 VAE_TRAINING_EXT = '.vae_train'
 RNN_TRAINING_EXT = '.rnn_train'
 RNN_TEST_EXT = '.rnn_test'
+# Recordings of images compressed by frame_codec.py
+COMPRESSED_FRAMES_EXT = '.frames'
 
 DATA_DIR = './data'
 ACTIONS_DIR = DATA_DIR + '/actions'
 IMG_DIR = DATA_DIR + '/images'
 LATENT_IMG_DIR = DATA_DIR + '/latent_images'
 NEAT_DIR = DATA_DIR + '/neat'
+# Index of the recordings (see manifest.py)
+MANIFEST_PATH = DATA_DIR + '/manifest.jsonl'
 SAVED_MODELS_DIR = './saved_models'
 
 # LEVELS = ['GreenHillZone.Act1', 'GreenHillZone.Act2', 'SpringYardZone.Act1', 'SpringYardZone.Act2']
@@ -6,7 +6,10 @@ from pyglet.window import key as keycodes
 from pyglet.gl import *
 import ctypes
 import retro
+from emulator import skip_frames
 from models.VAE import *
+from manifest import Manifest
+from recording import RecordingSink
 
 
 class ButtonCodes:
@@ -28,7 +31,7 @@ class ButtonCodes:
 
 
 def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', scenario='scenario', extension_name='',
-				  frame_jump=1, save_images=True, save_actions=True, fixed_record_size=False):
+				  frame_jump=1, save_images=True, save_actions=True, fixed_record_size=False, compress_images=False):
 	'''
 	Play to Sonic and save the images and actions of the session in order to create data for neural networks trainings
 
@@ -39,7 +42,9 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 	:param frame_jump: factor for not saving images
 		ex :frame_jump = 1 : every image of the session is saved
 			frame_jump = 3 : only 1/3 images are saved
-		The last action is repeated during the jumped frames
+		The action is repeated during the jumped frames, which are played in one call (emulator.skip_frames) and
+		at 60 / frame_jump iterations per second, so the game still runs at 60 fps
+	:param compress_images: if True, images are saved in the compressed format of frame_codec.py
 	:return:
 
 	Actions :
@@ -57,7 +62,6 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 		  '\n\tR : Save current recording'
 		  '\n\tECHAP : End')
 
-	jump = 0
 	# Level loading
 	env = retro.make(game=game, state=state, use_restricted_actions=retro.ACTIONS_ALL, scenario=scenario)
 	obs = env.reset()
@@ -77,7 +81,8 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 	pyglet.app.platform_event_loop.start()
 
 	fps_display = pyglet.clock.ClockDisplay()
-	clock.set_fps_limit(60)
+	# The frame_jump frames of an action are played in one iteration
+	clock.set_fps_limit(60 / frame_jump)
 
 	glEnable(GL_TEXTURE_2D)
 	texture_id = GLuint(0)
@@ -89,10 +94,18 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
 	glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, screen_width, screen_height, 0, GL_RGB, GL_UNSIGNED_BYTE, None)
 
-	# Array of the session's images
-	images = []
-	# Array of the session's actions
-	actions = []
+	# The session's images and actions are written on the disk while playing, and indexed in the manifest
+	sink = RecordingSink(manifest=Manifest())
+	streams_paths, streams_shapes, streams_dtypes = [], [], []
+	if save_images:
+		streams_paths.append(IMG_DIR + '/' + state + extension_name + '{0}' +
+							 (COMPRESSED_FRAMES_EXT if compress_images else '.npy'))
+		streams_shapes.append(obs.shape)
+		streams_dtypes.append(np.uint8)
+	if save_actions:
+		streams_paths.append(ACTIONS_DIR + '/' + state + extension_name + '{0}.npy')
+		streams_shapes.append((NB_ACTIONS,))
+		streams_dtypes.append(np.bool)
 	while not win.has_exit:
 		win.dispatch_events()
 
@@ -112,49 +125,30 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 
 		# End of the session
 		if keycodes.ESCAPE in keys_pressed:
+			# The current recording isn't saved
+			sink.close()
 			pyglet.app.platform_event_loop.stop()
 			return
 		# Reset images and actions
 		elif keycodes.C in keys_pressed:
 			print('reset record')
-			print(len(images))
-			images = []
-			actions = []
+			print(len(sink))
+			sink.discard()
 		# Images and actions of the game session are saved
-		elif fixed_record_size and len(images) == SEQ_LENGTH + 1:
-			if save_images:
-				images = np.array(images, dtype=np.uint8)
-				np.save('./data/images/' + state + extension_name + str(save_index), images)
-				print('Images saved at : ./data/images/' + state + extension_name + str(save_index))
-
-			if save_actions:
-				actions = np.array(actions, dtype=np.bool)
-				np.save('./data/actions/' + state + extension_name + str(save_index), actions)
-				print('Actions saved at : ./data/actions/' + state + extension_name + str(save_index))
-
-			images = []
-			actions = []
+		elif fixed_record_size and len(sink) == SEQ_LENGTH + 1:
+			sink.commit()
 			save_index += 1
 		elif keycodes.R in keys_pressed:
-			if save_images and len(images) > 10:
-				images = np.array(images, dtype=np.uint8)
-				np.save('./data/images/' + state + extension_name + str(save_index), images)
-				print('Images saved at : ./data/images/' + state + extension_name + str(save_index))
-
-			if save_actions and len(actions) > 10:
-				actions = np.array(actions, dtype=np.bool)
-				np.save('./data/actions/' + state + extension_name + str(save_index), actions)
-				print('Actions saved at : ./data/actions/' + state + extension_name + str(save_index))
-
-			images = []
-			actions = []
+			if len(sink) > 10:
+				sink.commit()
+			else:
+				sink.discard()
 			save_index += 1
 		# Reset of the level, actions and images
 		elif keycodes.BACKSPACE in keys_pressed:
 			print('level reset')
 			env.reset()
-			images = []
-			actions = []
+			sink.discard()
 
 		inputs = {
 			'A': keycodes.Z in keys_pressed or ButtonCodes.A in buttons_pressed,
@@ -173,19 +167,19 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 			'START': keycodes.ENTER in keys_pressed or ButtonCodes.START in buttons_pressed,
 		}
 
-		if jump == 0:
-			action = [inputs[b] for b in env.BUTTONS]
-			last_action = action
-			obs, rew, done, info = env.step(action)
-			jump = frame_jump
+		action = [inputs[b] for b in env.BUTTONS]
+		# The action is repeated during frame_jump frames, only the last frame is returned and saved
+		obs, rew, done, info, nb_frames = skip_frames(env, action, frame_jump)
+		if streams_paths:
+			if not sink.is_recording():
+				sink.start_segment([path.format(save_index) for path in streams_paths], streams_shapes,
+								   streams_dtypes)
+			items = []
 			if save_images:
-				images.append(obs)
+				items.append(obs)
 			if save_actions:
-				actions.append([inputs['A'], inputs['LEFT'], inputs['RIGHT'], inputs['DOWN']])
-		else:
-			obs, rew, done, info = env.step(last_action)
-
-		jump -= 1
+				items.append([inputs['A'], inputs['LEFT'], inputs['RIGHT'], inputs['DOWN']])
+			sink.append(*items)
 
 		glBindTexture(GL_TEXTURE_2D, texture_id)
 		video_buffer = ctypes.cast(obs.tobytes(), ctypes.POINTER(ctypes.c_short))
@@ -211,5 +205,6 @@ def generate_data(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', s
 
 		clock.tick()
 
+	sink.close()
 	pyglet.app.platform_event_loop.stop()
 
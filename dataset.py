@@ -0,0 +1,338 @@
+'''
+Memory-mapped access to the recorded game sessions.
+
+The recordings saved by data_generation.py are never loaded in RAM all at once : every file is memory-mapped and
+frames are addressed with a global index that goes across all the files. Only the frames of the current batch are
+read from the disk.
+'''
+from keras.utils import Sequence
+from constants import *
+from frame_codec import FrameFile
+import numpy as np
+import os
+
+
+def open_recording(path):
+	'''
+	:return: array-like of the recording's frames, read from the disk only when indexed
+	'''
+	if path.endswith(COMPRESSED_FRAMES_EXT):
+		return FrameFile(path)
+	return np.load(path, mmap_mode='r')
+
+
+class FrameDataset():
+	'''
+	Several recordings seen as one big array of frames.
+	'''
+
+	def __init__(self, paths, lengths=None):
+		'''
+		:param paths: paths of the recordings
+		:param lengths: number of frames of every recording (from the manifest), if None the recordings are opened
+			to get their lengths
+		'''
+		self.paths = list(paths)
+		# Arrays stay on the disk, only the pages read by a batch are loaded by the OS
+		self._recordings = None
+		if lengths is None:
+			lengths = [len(recording) for recording in self.recordings]
+		# offsets[i] is the global index of the first frame of the i-th recording
+		self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+	@staticmethod
+	def from_manifest(manifest, split, level=None):
+		'''
+		:param manifest: Manifest of the recordings
+		:param split: VAE_TRAINING_EXT, RNN_TRAINING_EXT or RNN_TEST_EXT, None for all the recordings
+		:param level: if not None, only the recordings of this level are used
+		'''
+		entries = manifest.query('images', split, level)
+		return FrameDataset([entry['path'] for entry in entries], [entry['length'] for entry in entries])
+
+	@property
+	def recordings(self):
+		# Recordings are opened the first time a frame is read
+		if self._recordings is None:
+			self._recordings = [open_recording(path) for path in self.paths]
+		return self._recordings
+
+	def __len__(self):
+		return int(self.offsets[-1])
+
+	def locate(self, indices):
+		'''
+		Converts global frame indices into (recording index, local frame index) pairs.
+		'''
+		indices = np.asarray(indices, dtype=np.int64)
+		recording_indices = np.searchsorted(self.offsets, indices, side='right') - 1
+		return recording_indices, indices - self.offsets[recording_indices]
+
+	def take(self, indices):
+		'''
+		:param indices: global indices of the wanted frames
+		:return: uint8 array of shape (len(indices),) + IMG_SHAPE, in the same order as indices
+		'''
+		indices = np.asarray(indices, dtype=np.int64)
+		batch = np.empty((len(indices),) + IMG_SHAPE, dtype=np.uint8)
+		# Sorting the indices makes the reads sequential inside each file
+		order = np.argsort(indices, kind='stable')
+		recording_indices, local_indices = self.locate(indices[order])
+		for recording_index in np.unique(recording_indices):
+			mask = recording_indices == recording_index
+			batch[order[mask]] = self.recordings[recording_index][local_indices[mask]]
+		return batch
+
+	def split(self, validation_split):
+		'''
+		Same split as the validation_split argument of keras : the last frames are kept for the validation.
+
+		:return: (training indices, validation indices)
+		'''
+		split_at = int(len(self) * (1. - validation_split))
+		return np.arange(split_at), np.arange(split_at, len(self))
+
+
+class FrameBatches(Sequence):
+	'''
+	Feeds keras with shuffled batches of frames taken from a FrameDataset.
+	The memory used only depends on batch_size.
+	'''
+
+	def __init__(self, dataset, indices, batch_size=32, shuffle=True, normalize=True, targets=None):
+		'''
+		:param dataset: FrameDataset
+		:param indices: global indices of the frames used by this generator (see FrameDataset.split)
+		:param normalize: if True, batches are converted into float16 between 0 and 1, else they stay in uint8
+		:param targets: if not None, array of the targets of every frame of the dataset, given with the batches
+		'''
+		self.dataset = dataset
+		self.indices = np.array(indices, dtype=np.int64)
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.normalize = normalize
+		self.targets = targets
+		self.on_epoch_end()
+
+	def __len__(self):
+		return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+	def __getitem__(self, index):
+		batch_indices = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+		batch = self.dataset.take(batch_indices)
+		if self.normalize:
+			batch = batch.astype(np.float16) / 255
+		if self.targets is not None:
+			return batch, self.targets[batch_indices]
+		# The VAE's loss is added with add_loss, there are no targets
+		return batch, None
+
+	def on_epoch_end(self):
+		if self.shuffle:
+			np.random.shuffle(self.indices)
+
+
+class LatentStore():
+	'''
+	Encoded recordings (latent vectors + actions) saved in a folder as memory-mapped arrays :
+		latents.npy : (nb frames, LATENT_DIM), float32
+		actions.npy : (nb frames, NB_ACTIONS), bool
+		offsets.npy : global index of the first frame of every recording, followed by the total number of frames
+	The i-th latent vector and the i-th action belong to the same frame.
+	'''
+
+	def __init__(self, directory, mode='r'):
+		self.directory = directory
+		self.latents = np.load(os.path.join(directory, 'latents.npy'), mmap_mode=mode)
+		self.actions = np.load(os.path.join(directory, 'actions.npy'), mmap_mode=mode)
+		self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+
+	@staticmethod
+	def create(directory, lengths):
+		'''
+		Allocates an empty store on the disk.
+
+		:param lengths: number of frames of every recording
+		:return: LatentStore opened in read/write mode
+		'''
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		nb_frames = int(np.sum(lengths))
+		np.lib.format.open_memmap(os.path.join(directory, 'latents.npy'), mode='w+', dtype=np.float32,
+								  shape=(nb_frames, LATENT_DIM))
+		np.lib.format.open_memmap(os.path.join(directory, 'actions.npy'), mode='w+', dtype=np.bool_,
+								  shape=(nb_frames, NB_ACTIONS))
+		np.save(os.path.join(directory, 'offsets.npy'), np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+		return LatentStore(directory, mode='r+')
+
+	def __len__(self):
+		return int(self.offsets[-1])
+
+	def nb_recordings(self):
+		return len(self.offsets) - 1
+
+	def recording(self, index):
+		'''
+		:return: (latent vectors, actions) of one recording, as views of the memory-mapped arrays
+		'''
+		start, end = self.offsets[index], self.offsets[index + 1]
+		return self.latents[start:end], self.actions[start:end]
+
+	def flush(self):
+		self.latents.flush()
+		self.actions.flush()
+
+	def training_pairs(self):
+		'''
+		Inputs and labels for the LSTMs, without crossing the recordings' boundaries.
+		The input of a frame is its latent vector + its action, its label is the latent vector of the next frame.
+
+		:return: x of shape (n, LATENT_DIM + NB_ACTIONS), y of shape (n, LATENT_DIM)
+		'''
+		x, y = [], []
+		for index in range(self.nb_recordings()):
+			latents, actions = self.recording(index)
+			x.append(np.append(latents[:-1], actions[:-1], axis=1))
+			y.append(np.array(latents[1:]))
+		return np.concatenate(x), np.concatenate(y)
+
+
+class LatentWindows(Sequence):
+	'''
+	Feeds the LSTMs with windows of consecutive frames taken from a LatentStore.
+
+	The input of a timestep is the latent vector + the action of a frame, its target is the latent vector of the
+	next frame. A window never goes across two recordings.
+	Inputs are of shape (batch_size, window, LATENT_DIM + NB_ACTIONS), targets of shape
+	(batch_size, window, LATENT_DIM) or (batch_size, LATENT_DIM) if only the last timestep is predicted.
+	'''
+
+	def __init__(self, store, window=64, stride=None, batch_size=32, shuffle=True, sequence_targets=True):
+		'''
+		:param store: LatentStore
+		:param window: number of timesteps of a window
+		:param stride: number of frames between the beginnings of two windows (window if None)
+		:param sequence_targets: if True, targets are given for every timestep (LSTM with return_sequences)
+			else only for the last one
+		'''
+		self.store = store
+		self.window = window
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.sequence_targets = sequence_targets
+		stride = window if stride is None else stride
+
+		# Global index of the first frame of every window
+		starts = []
+		for index in range(store.nb_recordings()):
+			start, end = store.offsets[index], store.offsets[index + 1]
+			# The last frame of a recording has no target
+			starts.append(np.arange(start, end - window, stride, dtype=np.int64))
+		self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+		self.on_epoch_end()
+
+	def __len__(self):
+		return int(np.ceil(len(self.starts) / float(self.batch_size)))
+
+	def __getitem__(self, index):
+		starts = self.starts[index * self.batch_size:(index + 1) * self.batch_size]
+		x = np.empty((len(starts), self.window, LATENT_DIM + NB_ACTIONS), dtype=np.float32)
+		y = np.empty((len(starts), self.window, LATENT_DIM), dtype=np.float32)
+		for position, start in enumerate(starts):
+			x[position, :, :LATENT_DIM] = self.store.latents[start:start + self.window]
+			x[position, :, LATENT_DIM:] = self.store.actions[start:start + self.window]
+			y[position] = self.store.latents[start + 1:start + self.window + 1]
+		if not self.sequence_targets:
+			y = y[:, -1]
+		return x, y
+
+	def on_epoch_end(self):
+		if self.shuffle:
+			np.random.shuffle(self.starts)
+
+
+class LatentLanes():
+	'''
+	Feeds stateful LSTMs with chunks of whole recordings, for truncated backpropagation through time (see
+	stateful_training.py).
+
+	The recordings of a LatentStore are packed one after the other into nb_lanes lanes (a lane is a row of the
+	batches), the recordings being spread so that the lanes have about the same length. Every batch holds the next
+	chunk_length timesteps of every lane : the state of the LSTM at the end of a chunk is the initial state of the next
+	chunk of the same lane. A recording always starts at the beginning of a chunk, the state of its lane is reset
+	before it. The end of its last chunk, and the end of the shortest lanes, are padded with timesteps of weight 0.
+	'''
+
+	def __init__(self, store, nb_lanes=32, chunk_length=64, shuffle=True):
+		'''
+		:param store: LatentStore
+		:param shuffle: if True, the recordings are packed in a random order every epoch
+		'''
+		self.store = store
+		self.nb_lanes = nb_lanes
+		self.chunk_length = chunk_length
+		self.shuffle = shuffle
+		self.on_epoch_end()
+
+	def _pack(self):
+		# The last frame of a recording has no target
+		nb_pairs = np.diff(self.store.offsets) - 1
+		recordings = np.flatnonzero(nb_pairs > 0)
+		if self.shuffle:
+			recordings = np.random.permutation(recordings)
+		else:
+			recordings = recordings[np.argsort(-nb_pairs[recordings], kind='stable')]
+
+		lanes = [[] for _ in range(self.nb_lanes)]
+		lanes_lengths = np.zeros(self.nb_lanes, dtype=np.int64)
+		for index in recordings:
+			lane = int(np.argmin(lanes_lengths))
+			lanes[lane].append(index)
+			lanes_lengths[lane] += int(np.ceil(nb_pairs[index] / float(self.chunk_length)))
+
+		nb_chunks = int(np.max(lanes_lengths)) if len(recordings) else 0
+		# Global index of the first frame of every chunk of every lane (-1 : padding), number of its timesteps with a
+		# target, and True if a recording starts with it
+		self.starts = np.full((nb_chunks, self.nb_lanes), -1, dtype=np.int64)
+		self.sizes = np.zeros((nb_chunks, self.nb_lanes), dtype=np.int64)
+		self.resets = np.zeros((nb_chunks, self.nb_lanes), dtype=bool)
+		for lane, lane_recordings in enumerate(lanes):
+			chunk = 0
+			for index in lane_recordings:
+				self.resets[chunk, lane] = True
+				for start in range(0, nb_pairs[index], self.chunk_length):
+					self.starts[chunk, lane] = self.store.offsets[index] + start
+					self.sizes[chunk, lane] = min(self.chunk_length, nb_pairs[index] - start)
+					chunk += 1
+		# Lanes without recordings start with a reset too
+		if nb_chunks:
+			self.resets[0] = True
+
+	def __len__(self):
+		return len(self.starts)
+
+	def nb_timesteps(self):
+		'''
+		:return: number of timesteps with a target (the padding is not counted)
+		'''
+		return int(np.sum(self.sizes))
+
+	def __getitem__(self, index):
+		'''
+		:return: inputs (nb_lanes, chunk_length, LATENT_DIM + NB_ACTIONS), targets (nb_lanes, chunk_length, LATENT_DIM),
+			sample weights (nb_lanes, chunk_length), lanes whose state must be reset before this chunk (nb_lanes,)
+		'''
+		x = np.zeros((self.nb_lanes, self.chunk_length, LATENT_DIM + NB_ACTIONS), dtype=np.float32)
+		y = np.zeros((self.nb_lanes, self.chunk_length, LATENT_DIM), dtype=np.float32)
+		weights = np.zeros((self.nb_lanes, self.chunk_length), dtype=np.float32)
+		for lane, (start, size) in enumerate(zip(self.starts[index], self.sizes[index])):
+			if size == 0:
+				continue
+			x[lane, :size, :LATENT_DIM] = self.store.latents[start:start + size]
+			x[lane, :size, LATENT_DIM:] = self.store.actions[start:start + size]
+			y[lane, :size] = self.store.latents[start + 1:start + size + 1]
+			weights[lane, :size] = 1.
+		return x, y, weights, self.resets[index]
+
+	def on_epoch_end(self):
+		self._pack()
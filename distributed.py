@@ -0,0 +1,418 @@
+'''
+Evaluation of the genomes by workers connected to the NEAT process, on this machine or on other hosts.
+
+The coordinator (in the run_neat process) listens on a TCP address (host, port) or on a Unix socket (path). Every
+worker connects to it, receives the setup (the NEAT config), loads the encoder and the environments once, says it is
+ready, then evaluates the tasks it receives one at a time and sends their results back. While it evaluates a task, a worker sends
+a heartbeat every HEARTBEAT_INTERVAL seconds : a worker that doesn't send anything during HEARTBEAT_TIMEOUT seconds,
+or whose connection is closed, is dead and its task is given to another worker. A result received for a task
+already finished by another worker is ignored. A task whose evaluation raises an exception is not given to another
+worker (it would fail again) : its result is a TaskError. So is a task that lost MAX_TASK_ATTEMPTS workers, it
+probably kills them.
+
+The messages are unpickled, so anyone knowing the authkey can run code in the coordinator : the coordinator listens
+on the loopback interface by default, and refuses to listen on another interface with the built-in authkey (set
+NEAT_AUTHKEY to a secret on every host).
+
+Messages (pickled by multiprocessing.connection, the connections are authenticated with AUTHKEY) :
+	worker -> coordinator : ('hello', worker name), ('ready',), ('heartbeat',), ('result', task id, result),
+		('error', task id, description of the exception)
+	coordinator -> worker : ('setup', setup), ('task', task id, payload, sending time), ('stop',)
+
+Start a worker on another host (the encoder's weights and the retro game must be installed there, and the
+coordinator must listen on an interface reachable from it, ex : ('0.0.0.0', 6000)) :
+	NEAT_AUTHKEY=secret python distributed.py --address coordinator-host:6000
+or several workers on this machine :
+	python distributed.py --address coordinator-host:6000 --workers 4
+Check the protocol with dummy tasks and local workers (a task killing its workers, a frozen worker, a failing task) :
+	python distributed.py --self-check
+'''
+from collections import deque
+from multiprocessing.connection import Listener, Client
+import argparse
+import ipaddress
+import itertools
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+COORDINATOR_ADDRESS = ('127.0.0.1', 6000)
+# Only accepted for the workers of this machine (loopback interface or Unix socket)
+DEFAULT_AUTHKEY = b'sonic-world-models'
+# Shared secret of the coordinator and the workers, set NEAT_AUTHKEY on every host
+AUTHKEY = os.environ['NEAT_AUTHKEY'].encode('utf8') if 'NEAT_AUTHKEY' in os.environ else DEFAULT_AUTHKEY
+HEARTBEAT_INTERVAL = 5.
+HEARTBEAT_TIMEOUT = 30.
+# Number of workers lost by a task before its result is a TaskError
+MAX_TASK_ATTEMPTS = 3
+
+
+class WorkerLost(Exception):
+	pass
+
+
+class TaskError(Exception):
+	'''
+	Result of a task whose evaluation raised an exception in the worker.
+	'''
+	pass
+
+
+def parse_address(address):
+	'''
+	:param address: 'host:port' or path of a Unix socket
+	:return: address for multiprocessing.connection
+	'''
+	if isinstance(address, tuple) or os.sep in address or ':' not in address:
+		return address
+	host, port = address.rsplit(':', 1)
+	return host, int(port)
+
+
+def is_local_address(address):
+	'''
+	:return: True for a Unix socket or a loopback address
+	'''
+	if not isinstance(address, tuple):
+		return True
+	host = address[0]
+	if host == 'localhost':
+		return True
+	try:
+		return ipaddress.ip_address(host).is_loopback
+	except ValueError:
+		return False
+
+
+class Coordinator():
+	'''
+	Gives tasks to the connected workers and gathers their results.
+	'''
+
+	def __init__(self, address=COORDINATOR_ADDRESS, authkey=AUTHKEY, setup=None, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+				 max_attempts=MAX_TASK_ATTEMPTS):
+		'''
+		:param address: (host, port) or path of a Unix socket
+		:param authkey: must not be the built-in DEFAULT_AUTHKEY if address isn't local
+		:param setup: object sent to every worker when it connects
+		:param max_attempts: number of workers a task can lose before its result is a TaskError
+		'''
+		if authkey == DEFAULT_AUTHKEY and not is_local_address(address):
+			raise ValueError('listening on {0} needs a secret authkey : set NEAT_AUTHKEY'.format(address))
+		self.setup = setup
+		self.heartbeat_timeout = heartbeat_timeout
+		self.max_attempts = max_attempts
+		self.listener = Listener(address, authkey=authkey)
+		# Address really used (the port chosen by the system if it was 0)
+		self.address = self.listener.address
+		self.condition = threading.Condition()
+		self.task_ids = itertools.count()
+		# Payloads of the tasks not finished yet
+		self.tasks = {}
+		# Tasks waiting for a worker, the tasks of dead workers are put back first
+		self.pending = deque()
+		# Task id -> number of workers lost while evaluating it
+		self.attempts = {}
+		# (task id, worker name, result) received, not returned by map yet
+		self.finished = deque()
+		# Name of a worker -> task it evaluates (None if it waits)
+		self.workers = {}
+		self.requeued_tasks = 0
+		self.lost_workers = 0
+		self.closed = False
+		self.accept_thread = threading.Thread(target=self._accept, daemon=True)
+		self.accept_thread.start()
+
+	def _accept(self):
+		while not self.closed:
+			try:
+				connection = self.listener.accept()
+			except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+				if self.closed:
+					break
+				print('connection refused : ' + str(e))
+				continue
+			threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+	def _next_task(self, name):
+		with self.condition:
+			while not self.pending and not self.closed:
+				self.condition.wait()
+			if self.closed:
+				return None
+			task_id = self.pending.popleft()
+			self.workers[name] = task_id
+			return task_id, self.tasks[task_id]
+
+	def _receive_result(self, connection, task_id):
+		while True:
+			# Heartbeats are sent during the evaluation
+			if not connection.poll(self.heartbeat_timeout):
+				raise WorkerLost('no heartbeat for {0} s'.format(self.heartbeat_timeout))
+			message = connection.recv()
+			if message[0] == 'result' and message[1] == task_id:
+				return message[2]
+			if message[0] == 'error' and message[1] == task_id:
+				return TaskError(message[2])
+
+	def _serve(self, connection):
+		name = None
+		try:
+			if not connection.poll(self.heartbeat_timeout):
+				raise WorkerLost('no hello')
+			_, name = connection.recv()
+			with self.condition:
+				# Two workers can't have the same name, a worker reconnecting gets a new one
+				while name in self.workers:
+					name += "'"
+				self.workers[name] = None
+			print('worker ' + name + ' connected')
+			connection.send(('setup', self.setup))
+			# Loading the encoder and the environments can take long, there is no timeout before the first task
+			message = connection.recv()
+			if message[0] != 'ready':
+				raise WorkerLost('unexpected message ' + str(message[0]))
+			print('worker ' + name + ' ready')
+			while True:
+				task = self._next_task(name)
+				if task is None:
+					connection.send(('stop',))
+					break
+				task_id, payload = task
+				connection.send(('task', task_id, payload, time.time()))
+				result = self._receive_result(connection, task_id)
+				if isinstance(result, TaskError):
+					print('worker {0} failed to evaluate task {1} : {2}'.format(name, task_id, result))
+				with self.condition:
+					self.workers[name] = None
+					# The task may have been given to another worker that finished it first
+					if task_id in self.tasks:
+						del self.tasks[task_id]
+						self.attempts.pop(task_id, None)
+						self.finished.append((task_id, name, result))
+						self.condition.notify_all()
+		except (OSError, EOFError, WorkerLost) as e:
+			print('worker {0} lost : {1}'.format(name, e))
+			with self.condition:
+				self.lost_workers += 1
+				task_id = self.workers.get(name)
+				if task_id is not None and task_id in self.tasks:
+					self.attempts[task_id] = self.attempts.get(task_id, 0) + 1
+					if self.attempts[task_id] >= self.max_attempts:
+						print('task {0} given up after {1} lost workers'.format(task_id, self.attempts[task_id]))
+						del self.tasks[task_id]
+						del self.attempts[task_id]
+						self.finished.append((task_id, name, TaskError('{0} workers lost'.format(self.max_attempts))))
+					else:
+						self.pending.appendleft(task_id)
+						self.requeued_tasks += 1
+					self.condition.notify_all()
+		finally:
+			with self.condition:
+				self.workers.pop(name, None)
+			connection.close()
+
+	def nb_workers(self):
+		with self.condition:
+			return len(self.workers)
+
+	def map(self, payloads, callback=None):
+		'''
+		Evaluates tasks on the workers, waits until every task is finished.
+
+		:param callback: function (position of the task, result, worker name) called in this thread for every result
+			received
+		:return: results of the payloads, in the same order (TaskError for the tasks whose evaluation raised)
+		'''
+		positions = {}
+		results = [None] * len(payloads)
+		with self.condition:
+			for position, payload in enumerate(payloads):
+				task_id = next(self.task_ids)
+				positions[task_id] = position
+				self.tasks[task_id] = payload
+				self.pending.append(task_id)
+			self.condition.notify_all()
+
+		remaining = len(payloads)
+		while remaining > 0:
+			with self.condition:
+				while not self.finished:
+					if not self.condition.wait(timeout=60.) and not self.workers:
+						print('{0} tasks waiting, no worker connected to {1}'.format(remaining, self.address))
+				received = list(self.finished)
+				self.finished.clear()
+			for task_id, worker_name, result in received:
+				# Results of the tasks of a previous map call are ignored
+				if task_id not in positions:
+					continue
+				position = positions.pop(task_id)
+				results[position] = result
+				remaining -= 1
+				if callback is not None:
+					callback(position, result, worker_name)
+		return results
+
+	def stats(self):
+		with self.condition:
+			return {'workers': len(self.workers), 'lost_workers': self.lost_workers,
+					'requeued_tasks': self.requeued_tasks}
+
+	def close(self):
+		'''
+		Stops the workers waiting for a task and stops listening.
+		'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		self.listener.close()
+
+
+def _send_heartbeats(connection, send_lock, evaluating, stopped, interval):
+	while not stopped.wait(interval):
+		if evaluating.is_set():
+			with send_lock:
+				connection.send(('heartbeat',))
+
+
+def serve_tasks(address, make_evaluate, authkey=AUTHKEY, name=None, heartbeat_interval=HEARTBEAT_INTERVAL):
+	'''
+	Worker : connects to the coordinator and evaluates its tasks until it stops.
+
+	:param make_evaluate: function (setup received from the coordinator) -> function evaluating a task's payload
+		(called once, loads what the evaluations need)
+	:param name: name of the worker, hostname-pid by default
+	:param heartbeat_interval: seconds between two heartbeats, lower than the coordinator's heartbeat_timeout
+	'''
+	if name is None:
+		name = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+	connection = Client(parse_address(address), authkey=authkey)
+	send_lock = threading.Lock()
+	evaluating = threading.Event()
+	stopped = threading.Event()
+	heartbeat = threading.Thread(target=_send_heartbeats,
+								 args=(connection, send_lock, evaluating, stopped, heartbeat_interval), daemon=True)
+	try:
+		connection.send(('hello', name))
+		_, setup = connection.recv()
+		evaluate = make_evaluate(setup)
+		connection.send(('ready',))
+		heartbeat.start()
+		while True:
+			message = connection.recv()
+			if message[0] == 'stop':
+				break
+			_, task_id, payload, sending_time = message
+			evaluating.set()
+			try:
+				reply = ('result', task_id, evaluate(payload, sending_time))
+			except Exception as e:
+				print('evaluation of task {0} failed : {1!r}'.format(task_id, e))
+				reply = ('error', task_id, repr(e))
+			evaluating.clear()
+			with send_lock:
+				connection.send(reply)
+	except (EOFError, OSError) as e:
+		print('connection to the coordinator lost : {0!r}'.format(e))
+	finally:
+		stopped.set()
+		connection.close()
+
+
+def start_local_workers(address, nb_workers, authkey=AUTHKEY):
+	'''
+	Starts workers on this machine in new processes.
+
+	:return: the processes
+	'''
+	# Spawned rather than forked, a forked tensorflow session can't be used
+	context = multiprocessing.get_context('spawn')
+	# Not daemonic : every worker creates the processes of its environments (retrowrapper)
+	processes = [context.Process(target=run_worker, args=(address, authkey)) for _ in range(nb_workers)]
+	for process in processes:
+		process.start()
+	return processes
+
+
+def run_worker(address, authkey=AUTHKEY):
+	'''
+	Worker evaluating NEAT genomes (see neat_sonic.DistributedPopulationEvaluator).
+	'''
+	from neat_sonic import remote_evaluation
+	serve_tasks(address, remote_evaluation, authkey)
+
+
+def _self_check_evaluation(marker_directory):
+	'''
+	Dummy make_evaluate of self_check. Payloads : ('square', x), ('raise',), ('crash',) which kills the worker's
+	process, ('freeze',) which stops the worker's process the first time (marker file) and returns 'thawed' after.
+	'''
+	def evaluate(payload, sending_time):
+		if payload[0] == 'square':
+			return payload[1] ** 2
+		if payload[0] == 'raise':
+			raise ValueError('failing task')
+		if payload[0] == 'crash':
+			os._exit(1)
+		marker = os.path.join(marker_directory, 'frozen')
+		if not os.path.exists(marker):
+			open(marker, 'w').close()
+			# No heartbeat anymore, like a frozen host
+			os.kill(os.getpid(), signal.SIGSTOP)
+		return 'thawed'
+	return evaluate
+
+
+def self_check(nb_workers=5, heartbeat_timeout=3.):
+	'''
+	Runs dummy tasks on local workers : a failing task, a task killing every worker it is given to and a task freezing
+	its first worker, among normal ones. Raises an AssertionError if a result or the statistics are wrong.
+	'''
+	import tempfile
+	marker_directory = tempfile.mkdtemp()
+	coordinator = Coordinator(('127.0.0.1', 0), setup=marker_directory, heartbeat_timeout=heartbeat_timeout,
+							  max_attempts=2)
+	context = multiprocessing.get_context('spawn')
+	processes = [context.Process(target=serve_tasks, args=(coordinator.address, _self_check_evaluation, AUTHKEY,
+														   'check-' + str(index), heartbeat_timeout / 6))
+				 for index in range(nb_workers)]
+	for process in processes:
+		process.start()
+	try:
+		payloads = [('square', x) for x in range(20)] + [('raise',), ('crash',), ('freeze',)]
+		results = coordinator.map(payloads)
+		stats = coordinator.stats()
+		print('results : ' + str(results))
+		print('statistics : ' + str(stats))
+		assert results[:20] == [x ** 2 for x in range(20)], 'wrong results'
+		assert isinstance(results[20], TaskError), 'the failing task must give a TaskError'
+		assert isinstance(results[21], TaskError), 'the crashing task must give a TaskError after 2 lost workers'
+		assert results[22] == 'thawed', 'the task of the frozen worker must be given to another one'
+		# 2 workers killed by the crashing task, 1 frozen
+		assert stats['lost_workers'] == 3, 'wrong number of lost workers'
+		print('self-check passed')
+	finally:
+		coordinator.close()
+		for process in processes:
+			process.kill()
+			process.join()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Worker evaluating the genomes of a NEAT process')
+	parser.add_argument('--address', default='localhost:{0}'.format(COORDINATOR_ADDRESS[1]),
+						help='host:port or path of the Unix socket of the coordinator')
+	parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+	parser.add_argument('--self-check', action='store_true',
+						help='checks the protocol with dummy tasks and local workers instead of starting a worker')
+	args = parser.parse_args()
+	if args.self_check:
+		self_check()
+	elif args.workers == 1:
+		run_worker(args.address)
+	else:
+		for process in start_local_workers(args.address, args.workers):
+			process.join()
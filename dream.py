@@ -0,0 +1,175 @@
+'''
+Evaluation of the genomes inside the dream of the world model.
+
+Instead of playing in the emulator, the networks of the whole population play together inside the LSTM (or
+MDN_LSTM) : at every decision, the PopulationNetwork gives the buttons of every genome from its latent vector, then
+the world model predicts the next latent vector of every genome in one call.
+The game's reward (distance traveled) is not in the latent space : a ProgressModel, a ridge regression trained on
+the runs played in the emulator, predicts the reward of a decision from the latent vectors and the buttons.
+
+The first generation is evaluated in the emulator to train the ProgressModel. Then, every generation, the top_k
+genomes of the dream are evaluated again in the emulator : they get their real fitness and their runs improve the
+ProgressModel.
+'''
+from constants import *
+from fitness import compute_fitness, MAX_STEPS, MAX_STEPS_WITHOUT_PROGRESS
+from population_network import PopulationNetwork, from_emulator_actions
+from scheduler import SuccessiveHalving
+import numpy as np
+import time
+
+
+class ProgressModel():
+	'''
+	Reward of a decision predicted from (latent vector, buttons, next latent vector - latent vector).
+	The sums of the ridge regression are accumulated, so the model can be fitted again with new runs at any time.
+	'''
+
+	def __init__(self, l2=1.0):
+		self.l2 = l2
+		nb_features = 2 * LATENT_DIM + NB_ACTIONS + 1
+		self.xx = np.zeros((nb_features, nb_features))
+		self.xy = np.zeros(nb_features)
+		self.nb_samples = 0
+		self.weights = None
+
+	@staticmethod
+	def features(latent_vectors, buttons, next_latent_vectors):
+		return np.concatenate((latent_vectors, buttons, next_latent_vectors - latent_vectors,
+							   np.ones((len(latent_vectors), 1))), axis=1)
+
+	def add_trace(self, trace):
+		'''
+		:param trace: decisions of a run (see neat_sonic.run_net_in_env)
+		'''
+		# The reward of a decision is known with the latent vector of the next decision
+		pairs = [(decision, next_decision) for decision, next_decision in zip(trace, trace[1:])
+				 if next_decision[0] == decision[0] + FRAME_JUMP]
+		if len(pairs) == 0:
+			return
+		x = self.features(np.array([decision[1] for decision, _ in pairs]),
+						  from_emulator_actions(np.array([decision[2] for decision, _ in pairs])),
+						  np.array([next_decision[1] for _, next_decision in pairs]))
+		y = np.array([decision[3] for decision, _ in pairs])
+		self.xx += x.T.dot(x)
+		self.xy += x.T.dot(y)
+		self.nb_samples += len(pairs)
+
+	def fit(self):
+		regularization = self.l2 * np.eye(len(self.xy))
+		# The bias is not regularized
+		regularization[-1, -1] = 0.
+		self.weights = np.linalg.solve(self.xx + regularization, self.xy)
+
+	def is_fitted(self):
+		return self.weights is not None
+
+	def predict(self, latent_vectors, buttons, next_latent_vectors):
+		return self.features(latent_vectors, buttons, next_latent_vectors).dot(self.weights)
+
+
+class DreamEvaluator(object):
+
+	def __init__(self, world_model, real_evaluator, top_k=5, temperature=0.):
+		'''
+		:param world_model: trained LSTM or MDN_LSTM (anything with a step method)
+		:param real_evaluator: neat_sonic.PopulationEvaluator, used for the first generation and the re-checks
+		:param top_k: number of genomes evaluated again in the emulator every generation (0 to never re-check)
+		:param temperature: temperature of the MDN_LSTM
+		'''
+		self.world_model = world_model
+		self.real_evaluator = real_evaluator
+		self.top_k = top_k
+		self.temperature = temperature
+		self.progress_model = ProgressModel()
+		# Generation of the population being evaluated, set by run_neat
+		self.generation = 0
+		# Latent vector of the first decision played from a latent vector of the game, for every level
+		self.start_latent_vectors = {}
+
+	def _step(self, inputs, states):
+		if self.temperature > 0:
+			return self.world_model.step(inputs, states, temperature=self.temperature)
+		return self.world_model.step(inputs, states)
+
+	def evaluate_in_emulator(self, genomes, config, scheduler=None):
+		'''
+		Evaluates genomes in the emulator and trains the ProgressModel with their runs.
+
+		:param scheduler: scheduler.SuccessiveHalving of the evaluation, the one of the real evaluator if None
+		'''
+		self.real_evaluator.traces = []
+		self.real_evaluator.generation = self.generation
+		self.real_evaluator.evaluate_genomes(genomes, config, scheduler)
+		for level, trace in self.real_evaluator.traces:
+			self.progress_model.add_trace(trace)
+			for decision in trace:
+				# The first decision sees the blank latent vector, the second one the first frame of the level
+				if decision[0] == FRAME_JUMP and level not in self.start_latent_vectors:
+					self.start_latent_vectors[level] = decision[1]
+		self.real_evaluator.traces = None
+		self.progress_model.fit()
+		print('progress model : {0} decisions'.format(self.progress_model.nb_samples))
+
+	def dream_fitness(self, genomes, config):
+		'''
+		:return: fitness of every genome, sum of its best scores in the dream of every level
+		'''
+		network = PopulationNetwork([genome for gid, genome in genomes], config)
+		fitness = np.zeros(len(genomes))
+		max_decisions_without_progress = MAX_STEPS_WITHOUT_PROGRESS // FRAME_JUMP
+		for level in LEVELS:
+			if level not in self.start_latent_vectors:
+				continue
+			latent_vectors = np.tile(self.start_latent_vectors[level], (len(genomes), 1))
+			states = None
+			cumulative_reward = np.zeros(len(genomes))
+			best_score = np.zeros(len(genomes))
+			decisions_without_progress = np.zeros(len(genomes), dtype=np.int64)
+			for step in range(FRAME_JUMP, MAX_STEPS, FRAME_JUMP):
+				# Like in the emulator, a run stops when it doesn't progress anymore
+				playing = decisions_without_progress < max_decisions_without_progress
+				if not np.any(playing):
+					break
+				buttons = network.buttons(latent_vectors)
+				next_latent_vectors, states = self._step(np.concatenate((latent_vectors, buttons), axis=1), states)
+				reward = self.progress_model.predict(latent_vectors, buttons, next_latent_vectors)
+				cumulative_reward += np.where(playing, reward, 0.)
+				# step is the step after the decision, like in neat_sonic.run_net_in_env
+				score = compute_fitness(cumulative_reward, step - 1)
+				progress = playing & (score > best_score)
+				best_score = np.where(progress, score, best_score)
+				decisions_without_progress = np.where(progress, 0, decisions_without_progress + 1)
+				latent_vectors = next_latent_vectors
+			fitness += best_score
+		return fitness
+
+	def evaluate_genomes(self, genomes, config):
+		if not self.progress_model.is_fitted():
+			print('first generation evaluated in the emulator')
+			self.evaluate_in_emulator(genomes, config)
+			return
+
+		t0 = time.time()
+		fitness = self.dream_fitness(genomes, config)
+		for (gid, genome), genome_fitness in zip(genomes, fitness):
+			genome.fitness = genome_fitness
+		run_time = time.time() - t0
+		print("dream run time {0} ({1:.2f} genomes/s)".format(run_time, len(genomes) / run_time))
+
+		if self.top_k > 0:
+			best_genomes = [genomes[index] for index in np.argsort(-fitness, kind='stable')[:self.top_k]]
+			# In decreasing order
+			dream_scores = [genome.fitness for gid, genome in best_genomes]
+			# Full budget for everyone, without the successive halving of the real evaluator
+			self.evaluate_in_emulator(best_genomes, config, SuccessiveHalving([(len(LEVELS), MAX_STEPS)]))
+			real_scores = np.array([genome.fitness for gid, genome in best_genomes])
+			# The real fitness isn't on the scale of the dream's fitness of the other genomes : it only ranks the top_k
+			# genomes among themselves, they get the dream's scores of the top_k in the order of their real fitness
+			for rank, index in enumerate(np.argsort(-real_scores, kind='stable')):
+				best_genomes[index][1].fitness = dream_scores[rank]
+			for (gid, genome), dream_score, real_score in zip(best_genomes, dream_scores, real_scores):
+				print('genome {0} : dream fitness {1:.1f}, real fitness {2:.1f}, new fitness {3:.1f}'.format(
+					gid, dream_score, real_score, genome.fitness))
+
+		print('best score : ' + str(max(genome.fitness for gid, genome in genomes)))
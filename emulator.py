@@ -0,0 +1,81 @@
+'''
+Environments of the game used to evaluate the networks.
+
+The environments run in their own process (retrowrapper). They are created by make_retro, which adds to the retro
+environment the access to the emulator's save states, so that a run can be resumed from a snapshot (see
+rollout_cache.py), and a step playing the FRAME_JUMP frames of a decision in one call : the observations of the
+repeated frames are not sent back from the environment's process.
+'''
+from constants import *
+import gym
+import retro
+import retrowrapper
+
+
+def skip_frames(env, action, nb_frames):
+	'''
+	Plays nb_frames frames with the same action. Stops before if the game is done or if a life is lost.
+
+	:param env: retro environment
+	:param nb_frames: at least 1
+	:return: observation of the last frame, sum of the rewards, done, info of the last frame, number of frames played
+	'''
+	if nb_frames < 1:
+		raise ValueError('nb_frames must be at least 1, got ' + str(nb_frames))
+	total_reward = 0.
+	# Lives before the first frame, a life lost during the first frame stops the decision too
+	lives = env.unwrapped.data.lookup_value('lives')
+	for frame in range(nb_frames):
+		observation, reward, done, info = env.step(action)
+		total_reward += reward
+		if done or info.get('lives') != lives:
+			break
+	return observation, total_reward, done, info, frame + 1
+
+
+class SaveStateEnv(gym.Wrapper):
+	'''
+	Retro environment whose emulator state can be saved and restored, and which can play several frames in one call.
+	'''
+
+	def skip_step(self, action, nb_frames=FRAME_JUMP):
+		'''
+		See skip_frames. With retrowrapper, only the last observation is sent back by the environment's process.
+		'''
+		return skip_frames(self.env, action, nb_frames)
+
+	def get_state(self):
+		'''
+		:return: save state of the emulator (bytes)
+		'''
+		return self.unwrapped.em.get_state()
+
+	def set_state(self, state):
+		'''
+		Restores a save state of get_state. The variables of the scenario (lives, x position, ...) are read again
+		so that the next rewards are computed from the restored state.
+		'''
+		env = self.unwrapped
+		env.em.set_state(state)
+		env.data.reset()
+		env.data.update_ram()
+
+
+def make_retro(game, state=retro.State.DEFAULT, **kwargs):
+	return SaveStateEnv(retro.make(game, state, **kwargs))
+
+
+# Environments created by retrowrapper in their processes are SaveStateEnv
+retrowrapper.set_retro_make(make_retro)
+
+
+def make_envs(record=False):
+	'''
+	:return: one environment per level of LEVELS, each running in its own process
+	'''
+	envs = []
+	for level in LEVELS:
+		envs.append(retrowrapper.RetroWrapper(game='SonicTheHedgehog-Genesis', state=level,
+											  use_restricted_actions=retro.ACTIONS_ALL, scenario='scenario',
+											  record=record))
+	return envs
@@ -0,0 +1,13 @@
+'''
+Fitness of a run, shared by the evaluations in the emulator (neat_sonic.py) and in the dream (dream.py).
+'''
+
+MAX_STEPS_WITHOUT_PROGRESS = 600
+MAX_STEPS = 4500
+
+
+def compute_fitness(distance, step, done=False):
+	score = distance
+	if done:
+		score += MAX_STEPS - step
+	return score
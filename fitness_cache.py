@@ -0,0 +1,113 @@
+'''
+Scores of the networks already evaluated.
+
+Elites go to the next generation unchanged and crossovers often give networks identical to their parents : their
+runs would be the same as before. A network is identified by a hash of what it computes (the nodes evaluated by
+neat.nn.FeedForwardNetwork with their activation, aggregation, bias, response and enabled links), so genomes that
+only differ by disabled connections or unused nodes have the same hash.
+The scores are only valid for the same evaluation : the hash of the encoder's weights file, LEVELS and the limits
+of the runs are part of the keys, with the budget (number of levels, maximum steps) of the scheduler's rung.
+'''
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import os
+import struct
+import threading
+
+
+def network_digest(net):
+	'''
+	:param net: neat.nn.FeedForwardNetwork
+	:return: hash of the network's computation
+	'''
+	h = hashlib.blake2b(digest_size=16)
+	h.update(repr((list(net.input_nodes), list(net.output_nodes))).encode('utf8'))
+	for node, act_func, agg_func, bias, response, links in net.node_evals:
+		h.update(repr((node, act_func.__name__, agg_func.__name__)).encode('utf8'))
+		# Exact values of the floats
+		h.update(struct.pack('<dd', bias, response))
+		for source, weight in links:
+			h.update(struct.pack('<qd', source, weight))
+	return h.hexdigest()
+
+
+def evaluation_context(encoder_weights_path, *settings):
+	'''
+	:param encoder_weights_path: weights of the encoder used by the runs
+	:param settings: anything else changing the scores (levels, limits of the runs)
+	:return: hash of the evaluation's context
+	'''
+	h = hashlib.blake2b(digest_size=16)
+	if os.path.exists(encoder_weights_path):
+		with open(encoder_weights_path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				h.update(block)
+	h.update(repr(settings).encode('utf8'))
+	return h.hexdigest()
+
+
+class FitnessCache():
+
+	def __init__(self, context, max_entries=200000):
+		'''
+		:param context: evaluation_context of the runs
+		:param max_entries: the least recently used scores are removed above max_entries
+		'''
+		self.context = context
+		self.max_entries = max_entries
+		self.scores = OrderedDict()
+		self.lock = threading.Lock()
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.lookups = 0
+		self.hits = 0
+
+	def stats(self):
+		return {'lookups': self.lookups, 'hits': self.hits,
+				'hit_rate': self.hits / self.lookups if self.lookups else 0., 'entries': len(self.scores)}
+
+	def wrap(self, digests, evaluate):
+		'''
+		:param digests: network_digest of every genome of the generation
+		:param evaluate: function (genome indices, number of levels, maximum steps, run states) -> (scores, emulated
+			frames, run states), as given to scheduler.SuccessiveHalving
+		:return: same function, only evaluating the networks whose score isn't known. The networks whose score is
+			known keep their previous run states
+		'''
+		def cached_evaluate(indices, nb_levels, max_steps, states):
+			scores = np.zeros(len(indices))
+			frames = np.zeros(len(indices), dtype=np.int64)
+			states = list(states)
+			# Networks to evaluate : key -> positions in indices (identical networks are evaluated once)
+			missing = OrderedDict()
+			with self.lock:
+				for position, index in enumerate(indices):
+					key = (self.context, digests[index], nb_levels, max_steps)
+					self.lookups += 1
+					if key in self.scores:
+						self.hits += 1
+						self.scores.move_to_end(key)
+						scores[position] = self.scores[key]
+					else:
+						missing.setdefault(key, []).append(position)
+			if len(missing) == 0:
+				return scores, frames, states
+
+			evaluated_scores, evaluated_frames, evaluated_states = evaluate(
+				np.array([indices[positions[0]] for positions in missing.values()]), nb_levels, max_steps,
+				[states[positions[0]] for positions in missing.values()])
+			with self.lock:
+				for (key, positions), score, frame_count, run_states in zip(missing.items(), evaluated_scores,
+																			evaluated_frames, evaluated_states):
+					scores[positions] = score
+					frames[positions[0]] = frame_count
+					# Identical networks have the same runs
+					for position in positions:
+						states[position] = run_states
+					self.scores[key] = score
+				while len(self.scores) > self.max_entries:
+					self.scores.popitem(last=False)
+			return scores, frames, states
+		return cached_evaluate
@@ -0,0 +1,195 @@
+'''
+Compressed storage of the recorded frames.
+
+Consecutive frames are almost identical (same background, same HUD), so a recording is saved as keyframes followed
+by the difference (xor) between every frame and the previous one. Every frame is compressed with zlib and the file
+ends with the position of every frame, which gives a random access by frame index.
+
+File layout :
+	FRAMES_MAGIC
+	compressed frames
+	positions of the frames (int64, nb frames + 1 values)
+	json header (shape of a frame, dtype, keyframe interval, number of frames)
+	trailer : position of the frames' positions, length of the header (2 uint64) + FRAMES_MAGIC
+
+Run this file to convert the .npy recordings of IMG_DIR and display the compression ratio and decoding speed.
+'''
+from constants import *
+import numpy as np
+import json
+import mmap
+import os
+import glob
+import struct
+import threading
+import time
+import zlib
+
+FRAMES_MAGIC = b'SFRM'
+TRAILER = struct.Struct('<QQ')
+# A keyframe every KEYFRAME_INTERVAL frames : at most KEYFRAME_INTERVAL - 1 deltas are decoded to reach a frame
+KEYFRAME_INTERVAL = 32
+# Fast compression, the frames' deltas are mostly zeros anyway
+COMPRESSION_LEVEL = 1
+
+
+class FrameFileWriter():
+	'''
+	Writes a compressed frames file chunk by chunk (same interface as recording.NpyAppender).
+	'''
+
+	def __init__(self, path, item_shape, dtype=np.uint8, keyframe_interval=KEYFRAME_INTERVAL):
+		self.path = path
+		self.item_shape = tuple(item_shape)
+		self.dtype = np.dtype(dtype)
+		self.keyframe_interval = keyframe_interval
+		self.length = 0
+		self.positions = []
+		self.previous = None
+		self.file = open(path, 'wb')
+		self.file.write(FRAMES_MAGIC)
+
+	def append(self, chunk):
+		for frame in np.asarray(chunk, dtype=self.dtype):
+			frame = np.ascontiguousarray(frame)
+			if self.length % self.keyframe_interval == 0:
+				data = frame
+			else:
+				data = np.bitwise_xor(frame, self.previous)
+			self.positions.append(self.file.tell())
+			self.file.write(zlib.compress(data.tobytes(), COMPRESSION_LEVEL))
+			self.previous = frame
+			self.length += 1
+
+	def close(self):
+		self.positions.append(self.file.tell())
+		header = json.dumps({'shape': self.item_shape, 'dtype': self.dtype.str, 'length': self.length,
+							 'keyframe_interval': self.keyframe_interval}).encode('utf8')
+		positions_position = self.file.tell()
+		self.file.write(np.array(self.positions, dtype='<i8').tobytes())
+		self.file.write(header)
+		self.file.write(TRAILER.pack(positions_position, len(header)) + FRAMES_MAGIC)
+		self.file.close()
+
+
+class FrameFile():
+	'''
+	Read access to a compressed frames file. It can be indexed like the memory-mapped array of a .npy recording :
+	frame_file[i], frame_file[start:end] or frame_file[array of indices].
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.data[:len(FRAMES_MAGIC)] != FRAMES_MAGIC or self.data[-len(FRAMES_MAGIC):] != FRAMES_MAGIC:
+			raise ValueError(path + ' is not a compressed frames file')
+		trailer_position = len(self.data) - len(FRAMES_MAGIC) - TRAILER.size
+		positions_position, header_length = TRAILER.unpack(self.data[trailer_position:trailer_position + TRAILER.size])
+		header = json.loads(self.data[trailer_position - header_length:trailer_position].decode('utf8'))
+		self.frame_shape = tuple(header['shape'])
+		self.dtype = np.dtype(header['dtype'])
+		self.keyframe_interval = header['keyframe_interval']
+		self.shape = (header['length'],) + self.frame_shape
+		self.positions = np.frombuffer(self.data, dtype='<i8', count=header['length'] + 1,
+									   offset=positions_position).copy()
+		# Last decoded frame of every thread, so that reading consecutive frames only decodes one delta per frame
+		self.cache = threading.local()
+
+	def __len__(self):
+		return self.shape[0]
+
+	def close(self):
+		self.data.close()
+
+	def _decompress(self, index):
+		data = zlib.decompress(self.data[self.positions[index]:self.positions[index + 1]])
+		return np.frombuffer(data, dtype=self.dtype).reshape(self.frame_shape)
+
+	def frame(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('frame ' + str(index) + ' out of range')
+		keyframe = index - index % self.keyframe_interval
+		cached_index = getattr(self.cache, 'index', -1)
+		if keyframe <= cached_index <= index:
+			start, frame = cached_index, self.cache.frame
+		else:
+			start, frame = keyframe, self._decompress(keyframe)
+		for delta_index in range(start + 1, index + 1):
+			frame = np.bitwise_xor(frame, self._decompress(delta_index))
+		self.cache.index, self.cache.frame = index, frame
+		return frame
+
+	def __getitem__(self, item):
+		if isinstance(item, (int, np.integer)):
+			return self.frame(int(item))
+		if isinstance(item, slice):
+			item = range(*item.indices(len(self)))
+		indices = np.asarray(item, dtype=np.int64)
+		frames = np.empty((len(indices),) + self.frame_shape, dtype=self.dtype)
+		# Decoding in increasing order reuses the previous frame as much as possible
+		for position in np.argsort(indices, kind='stable'):
+			frames[position] = self.frame(indices[position])
+		return frames
+
+
+def convert_recording(npy_path, keyframe_interval=KEYFRAME_INTERVAL):
+	'''
+	Converts a .npy recording into a compressed frames file saved next to it.
+
+	:return: path of the compressed file
+	'''
+	frames = np.load(npy_path, mmap_mode='r')
+	frames_path = os.path.splitext(npy_path)[0] + COMPRESSED_FRAMES_EXT
+	writer = FrameFileWriter(frames_path, frames.shape[1:], frames.dtype, keyframe_interval)
+	for start in range(0, len(frames), keyframe_interval):
+		writer.append(frames[start:start + keyframe_interval])
+	writer.close()
+	return frames_path
+
+
+def convert_recordings(directory=IMG_DIR, remove=False, manifest=None):
+	'''
+	Converts all the .npy recordings of a folder, checks that they are decoded without loss and displays the
+	compression ratio and the decoding speed.
+
+	:param remove: if True, the .npy files are removed once converted
+	:param manifest: if not None, the Manifest is updated with the converted recordings
+	'''
+	total_npy_size, total_frames_size, total_frames, total_decoding_time = 0, 0, 0, 0.
+	for npy_path in sorted(glob.glob(os.path.join(directory, '*.npy'))):
+		frames_path = convert_recording(npy_path)
+		frames = np.load(npy_path, mmap_mode='r')
+
+		t0 = time.time()
+		decoded = FrameFile(frames_path)[:]
+		decoding_time = time.time() - t0
+		if not np.array_equal(decoded, frames):
+			raise ValueError(frames_path + ' is not decoded as ' + npy_path)
+
+		npy_size, frames_size = os.path.getsize(npy_path), os.path.getsize(frames_path)
+		print('{0} : ratio {1:.1f}, {2:.0f} frames/s'.format(frames_path, npy_size / frames_size,
+															   len(frames) / max(decoding_time, 1e-9)))
+		total_npy_size += npy_size
+		total_frames_size += frames_size
+		total_frames += len(frames)
+		total_decoding_time += decoding_time
+		del frames, decoded
+		if manifest is not None:
+			manifest.add(frames_path)
+		if remove:
+			os.remove(npy_path)
+			if manifest is not None:
+				manifest.remove(npy_path)
+
+	if total_frames > 0:
+		print('total : {0} frames, {1:.1f} MB -> {2:.1f} MB (ratio {3:.1f}), decoding {4:.0f} frames/s'.format(
+			total_frames, total_npy_size / 1e6, total_frames_size / 1e6, total_npy_size / total_frames_size,
+			total_frames / max(total_decoding_time, 1e-9)))
+
+
+if __name__ == '__main__':
+	from manifest import Manifest
+	convert_recordings(IMG_DIR, manifest=Manifest())
@@ -0,0 +1,192 @@
+'''
+Index of all the recordings saved in IMG_DIR and ACTIONS_DIR.
+
+Every recording is described by one json line of MANIFEST_PATH, written when the recording is saved :
+	path : path of the file
+	kind : 'images' or 'actions'
+	level : level of the recording (ex : 'GreenHillZone.Act1')
+	split : extension name of the recording (VAE_TRAINING_EXT, RNN_TRAINING_EXT or RNN_TEST_EXT)
+	index : save index of the recording
+	format : 'npy' or 'frames' (see frame_codec.py)
+	length : number of frames
+	dtype, shape : dtype and shape of one frame
+	data_offset : position of the first frame in a .npy file, position of the first compressed frame in a frames file
+	item_nbytes : size of one frame in a .npy file
+	size : size of the file
+
+Loaders get the lengths of the recordings from the manifest, so they can plan their batches without opening the
+data files. The recordings copied into IMG_DIR or ACTIONS_DIR, deleted or replaced by hand are found when the
+manifest is loaded (see Manifest.sync).
+'''
+from constants import *
+from frame_codec import FrameFile
+import numpy as np
+import json
+import os
+import glob
+import threading
+
+RECORDINGS_DIRS = {'images': IMG_DIR, 'actions': ACTIONS_DIR}
+SPLITS = [VAE_TRAINING_EXT, RNN_TRAINING_EXT, RNN_TEST_EXT]
+
+
+def parse_recording_name(path):
+	'''
+	Recordings are named level + extension name + save index (see data_generation.generate_data).
+
+	:return: (level, split, index), split and index are None if the name doesn't follow this pattern
+	'''
+	name = os.path.splitext(os.path.basename(path))[0]
+	for split in SPLITS:
+		position = name.rfind(split)
+		if position > 0 and name[position + len(split):].isdigit():
+			return name[:position], split, int(name[position + len(split):])
+	return name, None, None
+
+
+def describe_recording(path, kind):
+	'''
+	Reads the header of a recording to create its manifest entry.
+	'''
+	level, split, index = parse_recording_name(path)
+	entry = {'path': os.path.normpath(path), 'kind': kind, 'level': level, 'split': split, 'index': index,
+			 'size': os.path.getsize(path)}
+	if path.endswith(COMPRESSED_FRAMES_EXT):
+		frames = FrameFile(path)
+		entry.update({'format': 'frames', 'length': len(frames), 'dtype': frames.dtype.str,
+					  'shape': list(frames.frame_shape), 'data_offset': int(frames.positions[0]), 'item_nbytes': None})
+		frames.close()
+	else:
+		with open(path, 'rb') as f:
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+			else:
+				shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+			entry.update({'format': 'npy', 'length': shape[0], 'dtype': dtype.str, 'shape': list(shape[1:]),
+						  'data_offset': f.tell(), 'item_nbytes': int(dtype.itemsize * np.prod(shape[1:]))})
+	return entry
+
+
+def _recordings():
+	'''
+	:return: (kind, path) of the recordings saved in IMG_DIR and ACTIONS_DIR
+	'''
+	recordings = []
+	for kind, directory in RECORDINGS_DIRS.items():
+		for file_extension in ('.npy', COMPRESSED_FRAMES_EXT):
+			for path in glob.glob(os.path.join(directory, '*' + file_extension)):
+				recordings.append((kind, path))
+	return recordings
+
+
+class Manifest():
+
+	def __init__(self, path=MANIFEST_PATH):
+		'''
+		Loads the manifest and updates it with the recordings of the folders. If it doesn't exist yet, it is created
+		from the recordings already saved.
+		'''
+		self.path = path
+		self.lock = threading.Lock()
+		self.entries = {}
+		if os.path.exists(path):
+			with open(path) as f:
+				for line in f:
+					if line.strip():
+						self._apply(json.loads(line))
+			self.sync()
+		else:
+			self.rebuild()
+
+	def _apply(self, entry):
+		# The last line written for a path is the right one
+		if entry.get('removed', False):
+			self.entries.pop(entry['path'], None)
+		else:
+			self.entries[entry['path']] = entry
+
+	def _write(self, entry):
+		with self.lock:
+			self._apply(entry)
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(entry) + '\n')
+
+	def add(self, path, kind=None):
+		'''
+		Adds (or updates) the entry of a saved recording.
+
+		:param kind: 'images' or 'actions', found with the folder of the recording if None
+		'''
+		if kind is None:
+			for recordings_kind, directory in RECORDINGS_DIRS.items():
+				if os.path.normpath(os.path.dirname(path)) == os.path.normpath(directory):
+					kind = recordings_kind
+		entry = describe_recording(path, kind)
+		self._write(entry)
+		return entry
+
+	def remove(self, path):
+		self._write({'path': os.path.normpath(path), 'removed': True})
+
+	def sync(self):
+		'''
+		Removes the entries of the recordings that don't exist anymore, adds the recordings of IMG_DIR and
+		ACTIONS_DIR that have no entry and describes again the ones whose size changed.
+
+		:return: number of entries removed, number of entries added or updated
+		'''
+		removed, added = 0, 0
+		for path, entry in list(self.entries.items()):
+			if not os.path.exists(path):
+				self.remove(path)
+				removed += 1
+		for kind, path in _recordings():
+			entry = self.entries.get(os.path.normpath(path))
+			if entry is None or entry['size'] != os.path.getsize(path):
+				self.add(path, kind)
+				added += 1
+		if removed or added:
+			print('manifest : {0} recordings removed, {1} added or updated'.format(removed, added))
+		return removed, added
+
+	def rebuild(self):
+		'''
+		Recreates the manifest from the recordings found in IMG_DIR and ACTIONS_DIR.
+		'''
+		with self.lock:
+			self.entries = {}
+			for kind, path in _recordings():
+				self._apply(describe_recording(path, kind))
+			directory = os.path.dirname(self.path)
+			if directory and not os.path.exists(directory):
+				os.makedirs(directory)
+			with open(self.path, 'w') as f:
+				for entry in self.entries.values():
+					f.write(json.dumps(entry) + '\n')
+
+	def query(self, kind='images', split=None, level=None):
+		'''
+		ex : manifest.query(split=RNN_TRAINING_EXT, level='GreenHillZone.Act2')
+
+		:return: entries of the matching recordings, sorted by path. When a recording exists in both formats, only
+			the compressed one is returned.
+		'''
+		entries = {}
+		for entry in self.entries.values():
+			if entry['kind'] != kind or (split is not None and entry['split'] != split) or \
+					(level is not None and entry['level'] != level):
+				continue
+			name = os.path.splitext(entry['path'])[0]
+			if name not in entries or entry['format'] == 'frames':
+				entries[name] = entry
+		return sorted(entries.values(), key=lambda entry: entry['path'])
+
+	def find(self, kind, level, split, index):
+		'''
+		:return: entry of a recording given its name, None if not found
+		'''
+		for entry in self.query(kind, split, level):
+			if entry['index'] == index:
+				return entry
+		return None
@@ -0,0 +1,77 @@
+'''
+Mixture density outputs of the MDN_LSTM in NumPy : mixture weights, sampling and log-likelihood.
+
+The output of the mdn layer for a timestep is [logits of pi, mu, log sigma], each of GAUSSIAN_MIXTURES * LATENT_DIM
+values (mixture after mixture), like in models.MDN_LSTM.get_mixture_coef : every dimension of the latent vector has
+its own mixture of gaussians. Every function works on outputs of any leading shape, ex : (batch, LATENT_DIM * 3 * K)
+for a step or (batch, time, LATENT_DIM * 3 * K) for sequences.
+'''
+from constants import *
+import numpy as np
+import math
+
+LOG_SQRT_TWO_PI = 0.5 * math.log(2 * math.pi)
+
+
+def mixture_coefficients(y_pred):
+	'''
+	:param y_pred: (..., 3 * K * LATENT_DIM) outputs of the mdn layer
+	:return: log of the mixture weights (normalized over the K gaussians), mu and log sigma, each of shape
+		(..., K, LATENT_DIM)
+	'''
+	y_pred = np.asarray(y_pred)
+	nb_mixtures = y_pred.shape[-1] // (3 * LATENT_DIM)
+	coefficients = y_pred.reshape(y_pred.shape[:-1] + (3, nb_mixtures, LATENT_DIM))
+	logits, mu, log_sigma = coefficients[..., 0, :, :], coefficients[..., 1, :, :], coefficients[..., 2, :, :]
+	return log_softmax(logits, axis=-2), mu, log_sigma
+
+
+def log_softmax(logits, axis=-1):
+	'''
+	Stable log of softmax (the maximum is subtracted before the exponential).
+	'''
+	shifted = logits - np.max(logits, axis=axis, keepdims=True)
+	return shifted - np.log(np.sum(np.exp(shifted), axis=axis, keepdims=True))
+
+
+def sample(y_pred, temperature=0., random_state=np.random):
+	'''
+	Draws latent vectors from the mixtures.
+
+	:param temperature: 0 gives the mean of the most probable gaussian of every dimension. Otherwise the logits of
+		the mixture weights are divided by temperature and the standard deviations multiplied by sqrt(temperature) :
+		higher temperatures give more random latent vectors
+	:param random_state: numpy.random.RandomState (or the numpy.random module)
+	:return: (..., LATENT_DIM) latent vectors
+	'''
+	log_pi, mu, log_sigma = mixture_coefficients(y_pred)
+	if temperature == 0:
+		component = np.argmax(log_pi, axis=-2)
+	else:
+		# Gumbel-max trick : argmax of the noisy logits is drawn from softmax(log_pi / temperature)
+		gumbel = -np.log(-np.log(random_state.uniform(1e-20, 1., size=log_pi.shape)))
+		component = np.argmax(log_pi / temperature + gumbel, axis=-2)
+	component = component[..., np.newaxis, :]
+	mean = np.take_along_axis(mu, component, axis=-2)[..., 0, :]
+	if temperature == 0:
+		return mean
+	sigma = np.exp(np.take_along_axis(log_sigma, component, axis=-2)[..., 0, :])
+	return mean + sigma * math.sqrt(temperature) * random_state.normal(size=mean.shape)
+
+
+def log_likelihood(y_pred, y_true, per_dimension=False):
+	'''
+	:param y_pred: (..., 3 * K * LATENT_DIM) outputs of the mdn layer
+	:param y_true: (..., LATENT_DIM) latent vectors
+	:param per_dimension: if True, the log-likelihood of every dimension is returned
+	:return: (...) log-likelihoods of the latent vectors (sum over the dimensions), or (..., LATENT_DIM)
+	'''
+	log_pi, mu, log_sigma = mixture_coefficients(y_pred)
+	z = (np.asarray(y_true)[..., np.newaxis, :] - mu) * np.exp(-log_sigma)
+	log_components = log_pi - 0.5 * np.square(z) - log_sigma - LOG_SQRT_TWO_PI
+	# Stable log of the sum over the gaussians
+	max_log = np.max(log_components, axis=-2, keepdims=True)
+	log_mixture = (max_log + np.log(np.sum(np.exp(log_components - max_log), axis=-2, keepdims=True)))[..., 0, :]
+	if per_dimension:
+		return log_mixture
+	return np.sum(log_mixture, axis=-1)
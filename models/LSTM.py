@@ -1,11 +1,14 @@
 from keras import Sequential, metrics
-from keras.layers import BatchNormalization, CuDNNLSTM, regularizers, Dense, Dropout
+from keras.layers import BatchNormalization, CuDNNLSTM, regularizers, Dense, Dropout, Input
+from keras.models import Model
 from keras.engine.saving import load_model
 import numpy as np
 import matplotlib.pyplot as plt
 import keyboard
 import sys
 from constants import *
+from stateful_training import train_stateful
+from step_inference import LSTMStepper, LSTMCell, BatchNormalization as NumpyBatchNormalization, rollout
 from keras import layers
 import keras.backend as K
 
@@ -13,18 +16,67 @@ import keras.backend as K
 
 class LSTM():
 
-	def __init__(self, input_shape=(None, LATENT_DIM + NB_ACTIONS)):
+	def __init__(self, input_shape=(None, LATENT_DIM + NB_ACTIONS), return_sequences=False):
+		'''
+		:param return_sequences: if True, the LSTM predicts the next latent vector of every timestep (training on
+			windows of several frames, see dataset.LatentWindows), else only of the last one
+		'''
 		self.input_shape = input_shape
+		self.return_sequences = return_sequences
 		self._build()
+		# Built at the first call of step, with the weights of the model at this moment
+		self.step_model = None
 
 	def _build(self):
 		self.model = Sequential()
 		# Only one lstm layer
 		# The output needs to be the same size as the LATENT_DIM because the LSTM predict the future latent vector
-		self.model.add(layers.LSTM(units=LATENT_DIM, input_shape =self.input_shape, activation='sigmoid', kernel_initializer='random_normal'))
+		self.model.add(layers.LSTM(units=LATENT_DIM, input_shape =self.input_shape, activation='sigmoid', kernel_initializer='random_normal',
+								   return_sequences=self.return_sequences))
 		self.model.add(BatchNormalization())
 		self.model.compile(loss='mse', optimizer='adam')
 
+	def _build_step_model(self):
+		x = Input(shape=(1, LATENT_DIM + NB_ACTIONS))
+		state_h = Input(shape=(LATENT_DIM,))
+		state_c = Input(shape=(LATENT_DIM,))
+		lstm = layers.LSTM(units=LATENT_DIM, activation='sigmoid', return_state=True)
+		output, h, c = lstm(x, initial_state=[state_h, state_c])
+		lstm.set_weights(self.model.layers[0].get_weights())
+		# Same BatchNormalization layer as the trained model
+		prediction = self.model.layers[1](output)
+		return Model([x, state_h, state_c], [prediction, h, c])
+
+	def step(self, inputs, states=None):
+		'''
+		Predicts the next latent vector of many sequences at once, one timestep after the other.
+
+		:param inputs: (batch, LATENT_DIM + NB_ACTIONS) latent vectors + actions of the current timestep
+		:param states: states of the LSTM returned by the previous call, None at the beginning of the sequences
+		:return: (batch, LATENT_DIM) predicted latent vectors, states of the LSTM
+		'''
+		if self.step_model is None:
+			self.step_model = self._build_step_model()
+		if states is None:
+			states = [np.zeros((len(inputs), LATENT_DIM)), np.zeros((len(inputs), LATENT_DIM))]
+		prediction, h, c = self.step_model.predict([inputs[:, np.newaxis]] + states, batch_size=len(inputs))
+		return prediction, [h, c]
+
+	def stepper(self, nb_sequences=1):
+		'''
+		:return: step_inference.LSTMStepper predicting the next latent vector in NumPy, with the current weights
+		'''
+		return LSTMStepper(LSTMCell.from_layer(self.model.layers[0]),
+						   NumpyBatchNormalization.from_layer(self.model.layers[1]), nb_sequences)
+
+	def rollout(self, start_latents, action_sequences, decoder=None, decode_batch_size=32):
+		'''
+		See step_inference.rollout.
+
+		:return: (N, T, LATENT_DIM) predicted latent vectors, and (N, T) + IMG_SHAPE frames if a decoder is given
+		'''
+		return rollout(self.step, start_latents, action_sequences, decoder, decode_batch_size)
+
 	def train(self, X_train, Y_train, X_test, Y_test, epochs=200):
 
 		print(X_train.shape)
@@ -32,6 +84,49 @@ class LSTM():
 		print(X_test.shape)
 		print(Y_test.shape)
 		self.model.fit(x=X_train, y=Y_train, epochs=epochs, validation_data=(X_test, Y_test), batch_size=SEQ_LENGTH, verbose=2, shuffle=False)
+		self.step_model = None
+
+	def train_on_windows(self, training_windows, validation_windows, epochs=200):
+		'''
+		:param training_windows: dataset.LatentWindows of the training LatentStore
+		:param validation_windows: dataset.LatentWindows of the validation LatentStore
+		'''
+		self.model.fit_generator(training_windows, epochs=epochs, validation_data=validation_windows, verbose=2,
+								 shuffle=False)
+		self.step_model = None
+
+	def _build_stateful(self, nb_lanes):
+		'''
+		:return: copy of the model with a stateful LSTM, for batches of nb_lanes sequences. Its BatchNormalization is
+			frozen (moving mean and variance, not trained) : the statistics of a batch would include the padding
+			timesteps of the lanes, which only have a sample weight of 0 in the loss
+		'''
+		x = Input(batch_shape=(nb_lanes, None, LATENT_DIM + NB_ACTIONS))
+		output = layers.LSTM(units=LATENT_DIM, activation='sigmoid', return_sequences=True, stateful=True)(x)
+		prediction = BatchNormalization(trainable=False)(output, training=False)
+		model = Model(x, prediction)
+		# The padding timesteps of the lanes have a weight of 0
+		model.compile(loss='mse', optimizer='adam', sample_weight_mode='temporal')
+		model.set_weights(self.model.get_weights())
+		return model
+
+	def train_truncated_bptt(self, training_lanes, validation_lanes, epochs=200):
+		'''
+		Trains on whole recordings, chunk after chunk, keeping the LSTM's state between the chunks of a recording
+		(see stateful_training.py). Needs return_sequences=True. The BatchNormalization keeps the statistics of the
+		previous trainings (train or train_on_windows).
+
+		:param training_lanes: dataset.LatentLanes of the training LatentStore
+		:param validation_lanes: dataset.LatentLanes of the validation LatentStore, with the same number of lanes
+		:return: history of the losses
+		'''
+		if not self.return_sequences:
+			raise ValueError('truncated backpropagation through time needs an LSTM with return_sequences=True')
+		stateful_model = self._build_stateful(training_lanes.nb_lanes)
+		history = train_stateful(stateful_model, training_lanes, validation_lanes, epochs)
+		self.model.set_weights(stateful_model.get_weights())
+		self.step_model = None
+		return history
 
 	def save(self, path):
 		self.model.save(path)
@@ -41,6 +136,7 @@ class LSTM():
 
 	def load_weights(self, file_path):
 		self.model.load_weights(filepath=file_path)
+		self.step_model = None
 
 	'''
 	We load the trained model of the LSTM in order to play inside it.
@@ -49,6 +145,8 @@ class LSTM():
 	'''
 	def play_in_dream(self, start_image, decoder):
 		latent_image = start_image
+		# The state of the LSTM is kept from one frame to the next
+		stepper = self.stepper()
 		while True:
 			# Player's actions
 			actions = [[0, 0, 0, 0]]
@@ -75,9 +173,8 @@ class LSTM():
 
 			# latent vector + actions are given to the input layer of the LSTM
 			lstm_input = np.concatenate((latent_image, actions), axis=1)
-			lstm_input = np.reshape(lstm_input, (1, 1, LATENT_DIM + NB_ACTIONS))
 			# Futur latent vector is predicted
-			latent_image = self.model.predict(lstm_input)
+			latent_image = stepper.step(lstm_input)
 			# We pass the latent vector through the decoder to see the corresponding image
 			reconstructed_image = decoder.predict(latent_image)
 			reconstructed_image = reconstructed_image.reshape(IMG_SHAPE)
@@ -1,9 +1,13 @@
 import math
+import numpy as np
 from keras.layers import Input, LSTM, Dense
 from keras.models import Model
 from keras import backend as K
 from keras.callbacks import EarlyStopping
 from constants import *
+import mdn
+from stateful_training import train_stateful
+from step_inference import LSTMStepper, LSTMCell, Dense as NumpyDense, rollout
 
 
 HIDDEN_UNITS = 256
@@ -48,11 +52,24 @@ def tf_normal(y_true, mu, sigma, pi):
 	return result
 
 
+def sample_latents(y_pred, temperature=0.):
+	'''
+	Draws latent vectors from the mixtures predicted for one timestep (see mdn.sample).
+
+	:param y_pred: (batch, GAUSSIAN_MIXTURES * 3 * LATENT_DIM) output of the mdn
+	:param temperature: 0 gives the mean of the most probable gaussian of every dimension, higher temperatures give
+		more random latent vectors
+	:return: (batch, LATENT_DIM) latent vectors
+	'''
+	return mdn.sample(y_pred, temperature)
+
+
 class MDN_LSTM():
 	def __init__(self):
 		self.models = self._build()
 		self.model = self.models[0]
 		self.forward = self.models[1]
+		self.step_model = self.models[2]
 		self.z_dim = LATENT_DIM
 		self.action_dim = NB_ACTIONS
 		self.hidden_units = HIDDEN_UNITS
@@ -64,7 +81,8 @@ class MDN_LSTM():
 		lstm = LSTM(HIDDEN_UNITS, return_sequences=True, return_state=True)
 
 		lstm_output, _, _ = lstm(rnn_x)
-		mdn = Dense(GAUSSIAN_MIXTURES * (3 * LATENT_DIM))(lstm_output)  # + discrete_dim
+		mdn_layer = Dense(GAUSSIAN_MIXTURES * (3 * LATENT_DIM))
+		mdn = mdn_layer(lstm_output)  # + discrete_dim
 
 		rnn = Model(rnn_x, mdn)
 
@@ -76,6 +94,9 @@ class MDN_LSTM():
 
 		forward = Model([rnn_x] + state_inputs, [state_h, state_c])
 
+		#### THE MODEL USED TO ROLL OUT MANY SEQUENCES, ONE TIMESTEP AFTER THE OTHER
+		step = Model([rnn_x] + state_inputs, [mdn_layer(state_h), state_h, state_c])
+
 		#### LOSS FUNCTION
 
 		def rnn_r_loss(y_true, y_pred):
@@ -84,7 +105,8 @@ class MDN_LSTM():
 			result = tf_normal(y_true, mu, sigma, pi)
 
 			result = -K.log(result + 1e-8)
-			result = K.mean(result, axis=(1, 2))  # mean over rollout length and z dim
+			# Mean over z dim, keras takes the mean over rollout length (weighted by the temporal sample weights)
+			result = K.mean(result, axis=2)
 
 			return result
 
@@ -98,7 +120,7 @@ class MDN_LSTM():
 
 		rnn.compile(loss=rnn_loss, optimizer='adam', metrics=[rnn_r_loss, rnn_kl_loss])
 
-		return (rnn, forward)
+		return (rnn, forward, step)
 
 	def load_weights(self, filepath):
 		self.model.load_weights(filepath)
@@ -110,8 +132,91 @@ class MDN_LSTM():
 		self.model.fit(X_train, Y_train, validation_data=val_data, shuffle=False, epochs=epochs,
 					   batch_size=SEQ_LENGTH, callbacks=callbacks_list, verbose=2)
 
+	def train_on_windows(self, training_windows, validation_windows, epochs=200):
+		'''
+		:param training_windows: dataset.LatentWindows of the training LatentStore (with sequence_targets=True)
+		:param validation_windows: dataset.LatentWindows of the validation LatentStore
+		'''
+		earlystop = EarlyStopping(monitor='val_loss', min_delta=0.0001, patience=10, verbose=1, mode='min')
+		callbacks_list = [earlystop]
+
+		self.model.fit_generator(training_windows, validation_data=validation_windows, shuffle=False, epochs=epochs,
+								 callbacks=callbacks_list, verbose=2)
+
+	def _build_stateful(self, nb_lanes):
+		'''
+		:return: copy of the trained model with a stateful LSTM, for batches of nb_lanes sequences
+		'''
+		rnn_x = Input(batch_shape=(nb_lanes, None, LATENT_DIM + NB_ACTIONS))
+		lstm_output = LSTM(HIDDEN_UNITS, return_sequences=True, stateful=True)(rnn_x)
+		mdn = Dense(GAUSSIAN_MIXTURES * (3 * LATENT_DIM))(lstm_output)
+		model = Model(rnn_x, mdn)
+		# Same loss as the model, the padding timesteps of the lanes have a weight of 0
+		model.compile(loss=self.model.loss, optimizer='adam', sample_weight_mode='temporal')
+		model.set_weights(self.model.get_weights())
+		return model
+
+	def train_truncated_bptt(self, training_lanes, validation_lanes, epochs=200):
+		'''
+		Trains on whole recordings, chunk after chunk, keeping the LSTM's state between the chunks of a recording
+		(see stateful_training.py).
+
+		:param training_lanes: dataset.LatentLanes of the training LatentStore
+		:param validation_lanes: dataset.LatentLanes of the validation LatentStore, with the same number of lanes
+		:return: history of the losses
+		'''
+		stateful_model = self._build_stateful(training_lanes.nb_lanes)
+		history = train_stateful(stateful_model, training_lanes, validation_lanes, epochs)
+		# The forward and step models share the layers of the model
+		self.model.set_weights(stateful_model.get_weights())
+		return history
+
 	def save_weights(self, filepath):
 		self.model.save_weights(filepath)
 
 	def predict(self, input):
-		return self.model.predict(input)
\ No newline at end of file
+		return self.model.predict(input)
+
+	def log_likelihood(self, inputs, targets):
+		'''
+		:param inputs: (batch, time, LATENT_DIM + NB_ACTIONS) latent vectors + actions
+		:param targets: (batch, time, LATENT_DIM) next latent vectors
+		:return: (batch, time) log-likelihoods of the targets under the predicted mixtures (see mdn.log_likelihood)
+		'''
+		return mdn.log_likelihood(self.model.predict(inputs), targets)
+
+	def step(self, inputs, states=None, temperature=0.):
+		'''
+		Predicts the next latent vector of many sequences at once, one timestep after the other.
+
+		:param inputs: (batch, LATENT_DIM + NB_ACTIONS) latent vectors + actions of the current timestep
+		:param states: states of the LSTM returned by the previous call, None at the beginning of the sequences
+		:param temperature: see sample_latents
+		:return: (batch, LATENT_DIM) latent vectors drawn from the predicted mixtures, states of the LSTM
+		'''
+		if states is None:
+			states = [np.zeros((len(inputs), HIDDEN_UNITS)), np.zeros((len(inputs), HIDDEN_UNITS))]
+		y_pred, h, c = self.step_model.predict([inputs[:, np.newaxis]] + states, batch_size=len(inputs))
+		return sample_latents(y_pred, temperature), [h, c]
+
+	def stepper(self, nb_sequences=1, temperature=0.):
+		'''
+		:param temperature: see sample_latents
+		:return: step_inference.LSTMStepper drawing the next latent vector in NumPy, with the current weights
+		'''
+		lstm_layer = [layer for layer in self.model.layers if isinstance(layer, LSTM)][0]
+		mdn_layer = NumpyDense.from_layer(self.model.layers[-1])
+		return LSTMStepper(LSTMCell.from_layer(lstm_layer),
+						   lambda h: sample_latents(mdn_layer(h), temperature), nb_sequences)
+
+	def rollout(self, start_latents, action_sequences, decoder=None, decode_batch_size=32, temperature=0.):
+		'''
+		See step_inference.rollout.
+
+		:param temperature: see sample_latents
+		:return: (N, T, LATENT_DIM) latent vectors drawn from the predicted mixtures, and (N, T) + IMG_SHAPE frames if
+			a decoder is given
+		'''
+		# step_model is the LSTM of forward followed by the mdn layer
+		return rollout(lambda inputs, states: self.step(inputs, states, temperature), start_latents, action_sequences,
+					   decoder, decode_batch_size)
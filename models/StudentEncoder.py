@@ -0,0 +1,118 @@
+from keras.callbacks import EarlyStopping, ModelCheckpoint
+from keras.layers import Dense, Input, Conv2D, Flatten, Lambda, AveragePooling2D, LeakyReLU
+from keras.models import Model
+from keras import backend as K
+from constants import *
+from dataset import FrameDataset, FrameBatches
+from manifest import Manifest
+from prefetch import Prefetcher, InputWaitLogger
+import numpy as np
+import time
+
+
+class StudentEncoder():
+	'''
+	Small encoder trained to give the same latent vectors as the VAE's encoder (distillation), to play faster.
+	The frames are reduced 4 times before 4 small convolutions, instead of the 5 convolutions and the Dense(1024)
+	of the VAE on the full frames.
+	'''
+
+	def __init__(self):
+		self.model = self._build()
+
+	def _build(self):
+		# Frames as they come from the emulator, like VAE(uint8_inputs=True)
+		inputs = Input(shape=IMG_SHAPE, name='encoder_input', dtype='uint8')
+		images = Lambda(lambda frames: K.cast(frames, K.floatx()) / 255., name='normalization')(inputs)
+		x = AveragePooling2D(pool_size=4)(images)
+		# (56, 80, 3)
+		x = Conv2D(filters=16, kernel_size=3, strides=2, padding='same')(x)
+		x = LeakyReLU()(x)
+		# (28, 40, 16)
+		x = Conv2D(filters=32, kernel_size=3, strides=2, padding='same')(x)
+		x = LeakyReLU()(x)
+		# (14, 20, 32)
+		x = Conv2D(filters=64, kernel_size=3, strides=2, padding='same')(x)
+		x = LeakyReLU()(x)
+		# (7, 10, 64)
+		x = Conv2D(filters=64, kernel_size=3, strides=2, padding='same')(x)
+		x = LeakyReLU()(x)
+		# (4, 5, 64)
+		x = Flatten()(x)
+		z_mean = Dense(LATENT_DIM, name='z_mean')(x)
+
+		encoder = Model(inputs, z_mean, name='student_encoder')
+		encoder.compile(loss='mse', optimizer='adam')
+		return encoder
+
+	def save_weights(self, file_path):
+		self.model.save_weights(filepath=file_path)
+
+	def load_weights(self, file_path):
+		self.model.load_weights(filepath=file_path)
+
+	def distill(self, teacher, filepath, epochs=100, batch_size=32, validation_split=0.2, workers=4, prefetch=8):
+		'''
+		Trains the student to give the mean latent vectors of the teacher on all the recorded frames.
+
+		:param teacher: trained VAE
+		:return: latent mean squared error of the student on the validation frames
+		'''
+		dataset = FrameDataset.from_manifest(Manifest(), None)
+		print('{0} frames encoded by the teacher'.format(len(dataset)))
+		# The targets are computed once, they are small compared to the frames
+		targets = teacher.encode_dataset(dataset)
+		training_indices, validation_indices = dataset.split(validation_split)
+
+		training_batches = Prefetcher(FrameBatches(dataset, training_indices, batch_size=batch_size, shuffle=True,
+												   normalize=False, targets=targets), workers=workers, depth=prefetch)
+		validation_batches = Prefetcher(FrameBatches(dataset, validation_indices, batch_size=batch_size, shuffle=False,
+													 normalize=False, targets=targets), workers=workers, depth=prefetch)
+
+		earlyStop = EarlyStopping(monitor='val_loss', min_delta=0.0001, patience=6, verbose=2)
+		checkpoint = ModelCheckpoint(filepath, monitor='val_loss', verbose=2, save_best_only=True,
+									 save_weights_only=True, mode='min')
+		inputWait = InputWaitLogger(training_batches)
+		self.model.fit_generator(training_batches, steps_per_epoch=len(training_batches), epochs=epochs, verbose=2,
+								 callbacks=[earlyStop, checkpoint, inputWait], validation_data=validation_batches,
+								 validation_steps=len(validation_batches), workers=0)
+		training_batches.close()
+		validation_batches.close()
+
+		self.load_weights(filepath)
+		latent_error = self.latent_error(dataset, validation_indices, targets[validation_indices], batch_size)
+		print('latent mse of the student : {0:.5f} (variance of the teacher\'s latents : {1:.5f})'.format(
+			latent_error, float(np.mean(np.var(targets[validation_indices], axis=0)))))
+		return latent_error
+
+	def latent_error(self, dataset, indices, targets, batch_size=32):
+		'''
+		:return: mean squared error between the student's latent vectors and the targets of the frames of indices
+		'''
+		squared_error = 0.
+		for start in range(0, len(indices), batch_size):
+			latents = self.model.predict(dataset.take(indices[start:start + batch_size]))
+			squared_error += float(np.sum((latents - targets[start:start + batch_size]) ** 2))
+		return squared_error / max(len(indices) * LATENT_DIM, 1)
+
+
+def benchmark_encoders(teacher, student, batch_size=8, nb_batches=50):
+	'''
+	Displays the number of frames encoded per second by the teacher and the student, with batches of the size used by
+	the evaluation threads of neat_sonic.py. Hide the GPU (CUDA_VISIBLE_DEVICES='') to measure the speed on CPU.
+
+	:param teacher: VAE(uint8_inputs=True)
+	:return: (frames/s of the teacher, frames/s of the student)
+	'''
+	frames = np.random.randint(0, 256, (batch_size,) + IMG_SHAPE, dtype=np.uint8)
+	speeds = []
+	for name, encoder in [('teacher', teacher.mean_encoder), ('student', student.model)]:
+		# The first call builds the graph's functions
+		encoder.predict(frames)
+		t0 = time.time()
+		for _ in range(nb_batches):
+			encoder.predict(frames)
+		speed = batch_size * nb_batches / (time.time() - t0)
+		print('{0} : {1:.0f} frames/s'.format(name, speed))
+		speeds.append(speed)
+	return speeds
@@ -5,9 +5,11 @@ from keras.models import Model
 from keras.losses import binary_crossentropy
 from keras import backend as K
 from constants import *
+from dataset import FrameDataset, FrameBatches, LatentStore, open_recording
+from manifest import Manifest
+from prefetch import Prefetcher, InputWaitLogger
 import numpy as np
 import os
-import glob
 import matplotlib.pyplot as plt
 
 
@@ -18,16 +20,29 @@ def sampling(args):
 
 
 class VAE():
-	def __init__(self):
+	def __init__(self, uint8_inputs=False):
+		'''
+		:param uint8_inputs: if True, the encoder takes the frames as they come from the emulator (uint8) and
+			normalizes them inside the graph, else it takes frames already divided by 255
+		'''
+		self.uint8_inputs = uint8_inputs
 		self.models = self._build()
 		self.vae = self.models[0]
 		self.encoder = self.models[1]
 		self.decoder = self.models[2]
+		# Deterministic encoder : mean of the latent distribution, without sampling
+		self.mean_encoder = self.models[3]
 
 	def _build(self):
-		inputs = Input(shape=IMG_SHAPE, name='encoder_input')
+		if self.uint8_inputs:
+			inputs = Input(shape=IMG_SHAPE, name='encoder_input', dtype='uint8')
+			# No float copy of the frames is made outside of the graph
+			images = Lambda(lambda frames: K.cast(frames, K.floatx()) / 255., name='normalization')(inputs)
+		else:
+			inputs = Input(shape=IMG_SHAPE, name='encoder_input')
+			images = inputs
 		# Size of the image given in input : (224, 320, 3)
-		x = Conv2D(filters=32, kernel_size=3, strides=2, kernel_initializer='normal', padding='same')(inputs)
+		x = Conv2D(filters=32, kernel_size=3, strides=2, kernel_initializer='normal', padding='same')(images)
 		x = LeakyReLU()(x)
 		# x = Dropout(0.25)(x)
 		x = BN()(x)
@@ -73,6 +88,7 @@ class VAE():
 
 		# instantiate encoder model
 		encoder = Model(inputs, z, name='encoder')
+		mean_encoder = Model(inputs, z_mean, name='mean_encoder')
 		# encoder.summary()
 
 		# build decoder model
@@ -116,7 +132,7 @@ class VAE():
 		vae = Model(inputs, outputs, name='vae')
 
 		# A classical loss function that uses binary crossentropy
-		reconstruction_loss = IMG_SHAPE[0] * IMG_SHAPE[1] * IMG_SHAPE[2] * binary_crossentropy(K.flatten(inputs),
+		reconstruction_loss = IMG_SHAPE[0] * IMG_SHAPE[1] * IMG_SHAPE[2] * binary_crossentropy(K.flatten(images),
 																							   K.flatten(outputs))
 
 		# Custom cost function
@@ -127,7 +143,7 @@ class VAE():
 		vae.add_loss(vae_loss)
 		vae.compile(optimizer='adam')
 
-		return (vae, encoder, decoder)
+		return (vae, encoder, decoder, mean_encoder)
 
 	def save_weights(self, file_path):
 		self.vae.save_weights(filepath=file_path)
@@ -135,83 +151,100 @@ class VAE():
 	def load_weights(self, file_path):
 		self.vae.load_weights(filepath=file_path)
 
-	def train(self, filepath, epochs=100, batch_size=32, validation_split=0.2):
-		training_data = None
+	def preprocess(self, frames):
+		'''
+		:param frames: uint8 frames from the emulator or the recordings
+		:return: frames in the format expected by the encoder
+		'''
+		if self.uint8_inputs:
+			return frames
+		# Dividing by 255 converts into float64, for memory purposes we switch to float16
+		return frames.astype(np.float16) / 255
 
-		# We load all the numpy arrays created by the user for the VAE
-		for data_file in glob.glob(os.path.join(IMG_DIR, '*' + VAE_TRAINING_EXT + '*.npy')):
+	def train(self, filepath, epochs=100, batch_size=32, validation_split=0.2, workers=4, prefetch=8):
+		'''
+		:param workers: number of threads preparing the batches
+		:param prefetch: maximum number of batches prepared in advance
+		'''
+		# The recordings created by the user for the VAE are memory-mapped, only the frames of a batch are loaded
+		dataset = FrameDataset.from_manifest(Manifest(), VAE_TRAINING_EXT)
+		for data_file in dataset.paths:
 			print(data_file)
-			if training_data is None:
-				training_data = np.load(data_file)
-			else:
-				training_data = np.concatenate((training_data, np.load(data_file)))
+		training_indices, validation_indices = dataset.split(validation_split)
 
-		# Loaded array is of uint8 type, dividing it by 255 automatically converts it into float64 type.
-		# For memory purposes, I convert switch to float16 type.
-		training_data = training_data.astype(np.float16) / 255
+		# Batches are converted one at a time (or not at all with uint8_inputs), the whole dataset is never copied
+		# They are prepared by other threads while the network trains on the current batch
+		normalize = not self.uint8_inputs
+		training_batches = Prefetcher(FrameBatches(dataset, training_indices, batch_size=batch_size, shuffle=True,
+												   normalize=normalize), workers=workers, depth=prefetch)
+		validation_batches = Prefetcher(FrameBatches(dataset, validation_indices, batch_size=batch_size, shuffle=False,
+													 normalize=normalize), workers=workers, depth=prefetch)
 
 		# If the network didn't improve during the last 5 epochs, we stop the training.
 		earlyStop = EarlyStopping(monitor='val_loss', min_delta=0.0001, patience=6, verbose=2)
 		checkpoint = ModelCheckpoint(filepath, monitor='val_loss', verbose=2, save_best_only=True, mode='min')
-		callbacks_list = [earlyStop, checkpoint]
-
-		self.vae.fit(training_data, epochs=epochs, batch_size=batch_size, verbose=2, callbacks=callbacks_list,
-					 validation_split=validation_split, shuffle=True)
-
-	def generate_latent_images(self):
-
-		# ================ training data =====================
-
-		training_latent_images = None
-		for data_file in glob.glob(os.path.join(IMG_DIR, '*' + RNN_TRAINING_EXT + '*.npy')):
-			print(data_file)
-			if training_latent_images is None:
-				training_latent_images = np.load(data_file).astype(np.float16) / 255
-			else:
-				training_latent_images = np.concatenate((training_latent_images, np.load(data_file).astype(np.float16)/255))
-		training_latent_images = self.encoder.predict(training_latent_images)
-
-		training_actions = None
-		for data_file in glob.glob(os.path.join(ACTIONS_DIR, '*' + RNN_TRAINING_EXT + '*.npy')):
-			print(data_file)
-			if training_actions is None:
-				training_actions = np.load(data_file)
-			else:
-				training_actions = np.concatenate((training_actions, np.load(data_file)))
-
-		x_train = np.append(training_latent_images, training_actions, axis=1)
-		y_train = training_latent_images
-
-		del training_latent_images, training_actions
-		x_train = np.delete(x_train[:np.shape(x_train)[0] - 1], np.s_[SEQ_LENGTH::SEQ_LENGTH + 1], axis=0)
-		y_train = np.delete(y_train, np.s_[::SEQ_LENGTH + 1], axis=0)
+		# Displays the time lost waiting for the batches, to choose the number of workers
+		inputWait = InputWaitLogger(training_batches)
+		callbacks_list = [earlyStop, checkpoint, inputWait]
 
-		# ================ validation data =====================
+		self.vae.fit_generator(training_batches, steps_per_epoch=len(training_batches), epochs=epochs, verbose=2,
+							   callbacks=callbacks_list, validation_data=validation_batches,
+							   validation_steps=len(validation_batches), workers=0)
+		training_batches.close()
+		validation_batches.close()
 
-		validation_latent_images = None
-		for data_file in glob.glob(os.path.join(IMG_DIR, '*' + RNN_TEST_EXT + '*.npy')):
-			print(data_file)
-			if validation_latent_images is None:
-				validation_latent_images = np.load(data_file).astype(np.float16)/255
-			else:
-				validation_latent_images = np.concatenate((validation_latent_images, np.load(data_file).astype(np.float16)/255))
-		validation_latent_images = self.encoder.predict(validation_latent_images)
-
-		validation_actions = None
-		for data_file in glob.glob(os.path.join(ACTIONS_DIR, '*' + RNN_TEST_EXT + '*.npy')):
-			print(data_file)
-			if validation_actions is None:
-				validation_actions = np.load(data_file)
-			else:
-				validation_actions = np.concatenate((validation_actions, np.load(data_file)))
+	def encode_recordings(self, extension_name, batch_size=64):
+		'''
+		Encodes the recordings ending by extension_name into a LatentStore, one batch of frames at a time.
+		The latent vectors are written directly on the disk so the memory used doesn't depend on the number of
+		recordings.
 
-		x_test = np.append(validation_latent_images, validation_actions, axis=1)
-		y_test = validation_latent_images
-		del validation_latent_images, validation_actions
-		x_test = np.delete(x_test[:np.shape(x_test)[0] - 1], np.s_[SEQ_LENGTH::SEQ_LENGTH + 1], axis=0)
-		y_test = np.delete(y_test, np.s_[::SEQ_LENGTH + 1], axis=0)
+		:param extension_name: RNN_TRAINING_EXT or RNN_TEST_EXT
+		:return: the LatentStore saved into LATENT_IMG_DIR
+		'''
+		# The manifest gives the length of every recording without opening them
+		manifest = Manifest()
+		images_entries = manifest.query('images', extension_name)
+		actions_entries = []
+		for entry in images_entries:
+			# The actions of a recording have the same level and save index as its images
+			actions_entry = manifest.find('actions', entry['level'], extension_name, entry['index'])
+			if actions_entry is None or actions_entry['length'] != entry['length']:
+				raise ValueError('The actions of ' + entry['path'] + ' are missing or have a different length')
+			actions_entries.append(actions_entry)
+
+		images_paths = [entry['path'] for entry in images_entries]
+		store = LatentStore.create(os.path.join(LATENT_IMG_DIR, extension_name.strip('.')),
+								   [entry['length'] for entry in images_entries])
+		images = [open_recording(path) for path in images_paths]
+		actions = [np.load(entry['path'], mmap_mode='r') for entry in actions_entries]
+		for index, path in enumerate(images_paths):
+			print(path)
+			latents, store_actions = store.recording(index)
+			for start in range(0, len(images[index]), batch_size):
+				end = start + batch_size
+				latents[start:end] = self.encoder.predict(self.preprocess(images[index][start:end]))
+			store_actions[:] = actions[index]
+		store.flush()
+		return store
+
+	def encode_dataset(self, dataset, batch_size=64):
+		'''
+		:param dataset: FrameDataset
+		:return: (len(dataset), LATENT_DIM) float32 array, mean latent vector of every frame
+		'''
+		latents = np.empty((len(dataset), LATENT_DIM), dtype=np.float32)
+		for start in range(0, len(dataset), batch_size):
+			end = min(start + batch_size, len(dataset))
+			latents[start:end] = self.mean_encoder.predict(self.preprocess(dataset.take(np.arange(start, end))))
+		return latents
 
-		return x_train, y_train, x_test, y_test
+	def generate_latent_images(self, batch_size=64):
+		'''
+		:return: LatentStores of the LSTM's training and validation recordings
+			(use LatentStore.training_pairs to get the inputs and labels of the LSTMs)
+		'''
+		return self.encode_recordings(RNN_TRAINING_EXT, batch_size), self.encode_recordings(RNN_TEST_EXT, batch_size)
 
 	def generate_render(self, data_path, save_path=None):
 		'''
@@ -221,8 +254,7 @@ class VAE():
 		:param save_path: If not None, we save the VAE's images
 		:return:
 		'''
-		images = np.load(data_path).astype(np.float16)
-		images = images / 255
+		images = self.preprocess(np.load(data_path))
 
 		generated_images = []
 		for image in images:
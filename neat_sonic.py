@@ -6,8 +6,6 @@
 # For reproducible results
 from numpy.random import seed
 seed(42)
-from tensorflow import set_random_seed
-set_random_seed(42)
 import gym
 import matplotlib.pyplot as plt
 import multiprocessing
@@ -17,15 +15,22 @@ import os
 import pickle
 import time
 import visualize
-from models.VAE import VAE
+from batched_encoder import BatchedEncoder
+from emulator import make_envs
+from rollout_cache import RolloutCache, RolloutNode
+from scheduler import SuccessiveHalving
+from profiling import Profiler, WorkerProfile, print_profile
+from checkpointing import IncrementalCheckpointer, restore_checkpoint
+from fitness_cache import FitnessCache, network_digest, evaluation_context
+from numpy_inference import load_model, numpy_weights_path
+from distributed import Coordinator, TaskError, start_local_workers, COORDINATOR_ADDRESS
 from constants import *
+from fitness import compute_fitness, MAX_STEPS, MAX_STEPS_WITHOUT_PROGRESS
 import retrowrapper
 import retro
-from keras import backend as K
-import tensorflow as tf
 import threading
 import time
-from queue import Queue
+from queue import Queue, Empty
 import math
 
 MIN_REWARD = 0
@@ -34,26 +39,139 @@ levels_distances = 0
 for end in LEVELS_END:
 	levels_distances += end
 
-MAX_STEPS_WITHOUT_PROGRESS = 600
-MAX_STEPS = 4500
 NB_THREADS = 8
+# 'threads' : PopulationEvaluator, 'processes' : ProcessPopulationEvaluator, 'dream' : dream.DreamEvaluator,
+# 'distributed' : DistributedPopulationEvaluator
+EVALUATION_MODE = 'threads'
+# One process per physical core (2 hardware threads per core)
+NB_PROCESSES = max(1, multiprocessing.cpu_count() // 2)
+# Seconds between two checks of the processes of ProcessPopulationEvaluator while waiting for their results
+RESULT_POLL_INTERVAL = 5
+# Workers started on this machine by DistributedPopulationEvaluator, the others are started with distributed.py
+NB_LOCAL_WORKERS = 0
+# Budgets (number of levels, maximum steps) of the successive halving of the evaluation (see scheduler.py). The last
+# one is the full evaluation, [(len(LEVELS), MAX_STEPS)] evaluates every genome entirely.
+EVALUATION_RUNGS = [(1, MAX_STEPS // 3), (1, MAX_STEPS), (len(LEVELS), MAX_STEPS)]
+# Fraction of the genomes of a rung evaluated with the budget of the next one
+PROMOTION_RATIO = 0.5
+# The networks see the latent vectors of the small encoder distilled from the VAE (faster, see models/StudentEncoder.py)
+USE_STUDENT_ENCODER = False
+# The encoder runs in NumPy, from the export of numpy_inference.py (python numpy_inference.py [--student]) : no keras
+# graph is built, the latent vectors are the means of the latent distribution (VAE.mean_encoder)
+USE_NUMPY_ENCODER = False
+# Networks already evaluated with the same encoder and levels get their previous score (see fitness_cache.py).
+# Only used with a deterministic encoder (USE_STUDENT_ENCODER or USE_NUMPY_ENCODER) : with the VAE's encoder, a score
+# is one random draw of the latent vectors and a lucky score would be kept by the genome for every generation
+USE_FITNESS_CACHE = True
+# Runs start from the emulator's save state of previous runs with the same first actions (see rollout_cache.py).
+# Only exact with a deterministic encoder (USE_STUDENT_ENCODER or USE_NUMPY_ENCODER) : the VAE's encoder samples the
+# latent vectors, a resumed run would see the samples of the run that filled the cache and get its score
+USE_ROLLOUT_CACHE = False
+# Memory of the emulator's save states of the rollout cache, divided between the processes of the evaluation
+ROLLOUT_CACHE_BYTES = 1 << 30
 
 score_range = []
 
-def compute_fitness(distance, step, done=False):
-	score = distance
-	if done:
-		score += MAX_STEPS - step
-	return score
-
 # I played to the 2 levels and it took me about 35s and 38s to finish them
 number_steps_to_beat = 35*60 + 38*60
 REWARD_THRESHOLD = compute_fitness(levels_distances, number_steps_to_beat)
 # REWARD_THRESHOLD = compute_fitness(9450, 35*60)
 print('fitness threshold : ' + str(REWARD_THRESHOLD))
 
-def run_net_in_env(env, session, graph, encoder, net, render=False):
-	env.reset()
+def encoder_weights_path(student=USE_STUDENT_ENCODER):
+	if student:
+		return SAVED_MODELS_DIR + '/StudentEncoder_GreenHillZone.h5'
+	return SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5'
+
+def load_encoder(student=USE_STUDENT_ENCODER, numpy_encoder=USE_NUMPY_ENCODER):
+	'''
+	Loads the trained encoder, ready to be used from several threads.
+
+	:param student: if True, the small encoder distilled from the VAE (models/StudentEncoder.py) is used
+	:param numpy_encoder: if True, the NumPy export of the encoder is loaded (numpy_inference.py)
+	:return: encoder, tensorflow session, tensorflow graph (None, None with numpy_encoder)
+	'''
+	if numpy_encoder:
+		return load_model(numpy_weights_path(encoder_weights_path(student)), 'encoder'), None, None
+	# Imported only here : the workers of the NumPy encoder start without tensorflow
+	from keras import backend as K
+	from tensorflow import set_random_seed
+	import tensorflow as tf
+	# For reproducible results
+	set_random_seed(42)
+	if student:
+		from models.StudentEncoder import StudentEncoder
+		student_encoder = StudentEncoder()
+		student_encoder.load_weights(encoder_weights_path(student))
+		encoder = student_encoder.model
+	else:
+		from models.VAE import VAE
+		# Observations of the emulator are given as they are (uint8), the encoder normalizes them like in training
+		vae = VAE(uint8_inputs=True)
+		vae.load_weights(file_path=encoder_weights_path(student))
+		# We only use the encoder part
+		encoder = vae.encoder
+	# We need to initialize the network for multithreading
+	# Check here for more info : https://stackoverflow.com/questions/46725323/keras-tensorflow-exception-while-predicting-from-multiple-threads
+	rand_image = np.random.randint(0, 256, (1,) + IMG_SHAPE, dtype=np.uint8)
+	encoder.predict(rand_image)
+	session = K.get_session()
+	graph = tf.get_default_graph()
+	graph.finalize()
+	return encoder, session, graph
+
+def direct_encoder(session, graph, encoder):
+	'''
+	:return: function giving the latent vector of an observation, calling the encoder directly
+	'''
+	def encode(observation):
+		if session is None:
+			return encoder.predict(np.array([observation]))[0]
+		with session.as_default():
+			with graph.as_default():
+				return encoder.predict(np.array([observation]))[0]
+	return encode
+
+def choose_action(net, latent_vector):
+	'''
+	:return: emulator's buttons pressed by the network
+	'''
+	action = np.zeros((12,), dtype=np.bool)
+
+	if net is not None:
+		output = net.activate(latent_vector)
+
+		bool_output = []
+
+		# Activation function = clamped.
+		# Output goes from -1 to 1, which we'll convert into a boolean value
+		for value in output:
+			if value <= 0:
+				bool_output.append(False)
+			else:
+				bool_output.append(True)
+
+		action[1] = bool_output[Actions.JUMP]
+		action[6] = bool_output[Actions.LEFT]
+		action[7] = bool_output[Actions.RIGHT]
+		action[5] = bool_output[Actions.DOWN]
+	return action
+
+def run_net_in_env(env, encode, net, render=False, cache=None, level=None, max_steps=MAX_STEPS, trace=None,
+				   profile=None, start=None):
+	'''
+	:param encode: function giving the latent vector of an observation (direct_encoder or BatchedEncoder.encode)
+	:param cache: RolloutCache shared by the runs, the run starts from the longest cached run with the same actions
+	:param level: level of env, needed with a cache
+	:param max_steps: the run is stopped after max_steps steps (at most MAX_STEPS)
+	:param trace: if not None, list receiving [step, latent vector, action, reward] for every decision of the run
+		(the reward being the sum of the rewards of the decision's frames)
+	:param profile: WorkerProfile receiving the time spent in every part of the run and the reason why it ended
+	:param start: RolloutNode returned by a previous call with a smaller max_steps, the run continues from there (the
+		cache isn't used, it doesn't know the actions of the run before start)
+	:return: best score of the run, number of frames emulated, RolloutNode of the end of the run (with a save state of
+		the emulator if the run was stopped by max_steps and can continue)
+	'''
 	latent_vector = np.zeros(LATENT_DIM)
 	# The final score of the network (not necessary the best)
 	cumulative_reward = 0.0
@@ -61,80 +179,200 @@ def run_net_in_env(env, session, graph, encoder, net, render=False):
 	best_score = 0.0
 	# Number of steps without progression since the bestcore's step
 	steps_without_progress = 0
-
-	for step in range(MAX_STEPS):
-		# Game runs at 60 fps or the AI plays at 15 fps (every 4 frame)
-		if step % FRAME_JUMP == 0:
-			action = np.zeros((12,), dtype=np.bool)
-
-			if net is not None:
-				output = net.activate(latent_vector)
-
-				bool_output = []
-
-				# Activation function = clamped.
-				# Output goes from -1 to 1, which we'll convert into a boolean value
-				for value in output:
-					if value <= 0:
-						bool_output.append(False)
-					else:
-						bool_output.append(True)
-
-				action = np.zeros((12,), dtype=np.bool)
-				action[1] = bool_output[Actions.JUMP]
-				action[6] = bool_output[Actions.LEFT]
-				action[7] = bool_output[Actions.RIGHT]
-				action[5] = bool_output[Actions.DOWN]
-
-			last_action = action
-
-		# If it is a frame where the AI doesn't play, we repeat the last action
+	start_step = 0
+	if profile is None:
+		profile = WorkerProfile()
+
+	if start is not None:
+		if start.final_score is not None:
+			return start.final_score, 0, start
+		if start.step >= max_steps:
+			return start.best_score, 0, start
+		with profile.measure('reset'):
+			env.set_state(start.snapshot)
+		start_step = start.step
+		latent_vector, cumulative_reward = start.latent_vector, start.cumulative_reward
+		best_score, steps_without_progress = start.best_score, start.steps_without_progress
+		cache = None
+	elif cache is not None:
+		with profile.measure('cache_lookup'):
+			key, node = cache.resume(level, lambda latent: choose_action(net, latent), latent_vector, max_steps)
+		if node is not None and node.final_score is not None:
+			profile.count('end_cached')
+			# The node is at the step of the run's last decision
+			return node.final_score, 0, RolloutNode(node.step + 1, None, None, None, None, None, node.final_score)
+		if node is not None:
+			with profile.measure('reset'):
+				env.set_state(node.snapshot)
+			start_step = node.step
+			latent_vector, cumulative_reward = node.latent_vector, node.cumulative_reward
+			best_score, steps_without_progress = node.best_score, node.steps_without_progress
 		else:
-			action = last_action
-
+			with profile.measure('reset'):
+				env.reset()
+		# Nodes of this run, added to the cache at the end
+		path = []
+	else:
+		with profile.measure('reset'):
+			env.reset()
+
+	# The run ends before MAX_STEPS because of the game, not because of max_steps
+	ended = False
+	# Number of frames played
+	step = start_step
+	# Game runs at 60 fps or the AI plays at 15 fps (every 4 frame)
+	while step < max_steps:
+		if cache is not None and step > start_step:
+			key = cache.child(key, last_action)
+			snapshot = None
+			if step % (FRAME_JUMP * cache.snapshot_interval) == 0:
+				with profile.measure('snapshot'):
+					snapshot = env.get_state()
+			path.append((key, RolloutNode(step, latent_vector, cumulative_reward, best_score,
+										  steps_without_progress, snapshot, None)))
+		with profile.measure('activate'):
+			action = choose_action(net, latent_vector)
+		last_action = action
+		if trace is not None:
+			trace.append([step, latent_vector, action, 0.])
+
+		# The action is repeated during the FRAME_JUMP frames of the decision, played in one call
 		# If you use the scenario.json of this project, reward represents the distance Sonic traveled since the last step
 		# So, positive if he goes right and negative in the left direction
-		observation, reward, done, info = env.step(action)
+		with profile.measure('env_step'):
+			observation, reward, done, info, nb_frames = env.skip_step(action, min(FRAME_JUMP, max_steps - step))
+		step += nb_frames
 		if render:
 			env.render()
 
-		if info['lives'] < NB_LIFES_AT_START or done or steps_without_progress >= MAX_STEPS_WITHOUT_PROGRESS:
-			break
-
-		if (step - 1) % FRAME_JUMP == 0:
-			with session.as_default():
-				with graph.as_default():
-					latent_vector = encoder.predict(np.array([observation]))[0]
-
-		del observation
-
+		# The reward of the decision counts even if it ends the run (ex : the frames before the end of the level)
 		cumulative_reward += reward
+		if trace is not None:
+			trace[-1][3] += reward
 
 		# The score depends of the farthest sonic went AND the time he took to get there.
 		# But in my opinion distance is most important than the time, that's why I choose to use log10.
 		# Feel free to modify the way you compute the reward.
-		current_score = compute_fitness(cumulative_reward, step)
+		current_score = compute_fitness(cumulative_reward, step - 1)
 		if current_score > best_score:
 			best_score = current_score
 			steps_without_progress = 0
 		else:
-			steps_without_progress += 1
-	return best_score
+			steps_without_progress += nb_frames
+
+		if info['lives'] < NB_LIFES_AT_START or done or steps_without_progress >= MAX_STEPS_WITHOUT_PROGRESS:
+			if info['lives'] < NB_LIFES_AT_START:
+				profile.count('end_death')
+			elif done:
+				profile.count('end_done')
+			else:
+				profile.count('end_no_progress')
+			ended = True
+			break
+
+		with profile.measure('encode'):
+			latent_vector = encode(observation)
+
+		del observation
+
+	if not ended:
+		profile.count('end_max_steps' if max_steps == MAX_STEPS else 'end_step_budget')
+	profile.count('frames', step - start_step)
+
+	if cache is not None:
+		if ended or step == MAX_STEPS:
+			# The run ends during its last decision : the same decisions give the same score
+			path.append((cache.child(key, last_action),
+						 RolloutNode(step - 1, None, None, None, None, None, best_score)))
+		cache.add_run(path)
+
+	if ended or step == MAX_STEPS:
+		end = RolloutNode(step, None, None, None, None, None, best_score)
+	else:
+		# Stopped by max_steps, the run can continue with a larger budget
+		with profile.measure('snapshot'):
+			end = RolloutNode(step, latent_vector, cumulative_reward, best_score, steps_without_progress,
+							  env.get_state(), None)
+	return best_score, step - start_step, end
+
+def run_net_on_levels(envs, encode, net, nb_levels, max_steps, cache=None, traces=None, profile=None, states=None):
+	'''
+	Runs a network on the first nb_levels levels.
+
+	:param envs: environments of the levels of LEVELS
+	:param traces: if not None, list receiving (level, trace of run_net_in_env) for every level
+	:param states: if not None, end of the previous runs of the network on the first levels (returned by a call with
+		a smaller budget), these runs continue from there
+	:return: sum of the best scores on the levels, number of frames emulated, end of the run on every level
+	'''
+	score, frames, end_states = 0, 0, []
+	for index, (level, env) in enumerate(list(zip(LEVELS, envs))[:nb_levels]):
+		trace = [] if traces is not None else None
+		start = states[index] if states is not None and index < len(states) else None
+		level_score, level_frames, end = run_net_in_env(env, encode, net, cache=cache, level=level,
+														max_steps=max_steps, trace=trace, profile=profile, start=start)
+		if traces is not None:
+			traces.append((level, trace))
+		score += level_score
+		frames += level_frames
+		end_states.append(end)
+	return score, frames, end_states
+
+def print_scheduler_stats(scheduler_stats):
+	for rung_stats in scheduler_stats['rungs']:
+		print("rung {0} levels, {1} steps : {2} genomes, {3} frames emulated".format(
+			rung_stats['nb_levels'], rung_stats['max_steps'], rung_stats['genomes'], rung_stats['frames']))
+	print("emulator frames : {0} emulated, about {1} for a full evaluation ({2} saved)".format(
+		scheduler_stats['frames'], scheduler_stats['full_frames_estimate'], scheduler_stats['frames_saved']))
+
+def make_fitness_cache(student_encoder=USE_STUDENT_ENCODER):
+	'''
+	:return: FitnessCache of the runs of this file, None if USE_FITNESS_CACHE is False or if the encoder isn't
+		deterministic
+	'''
+	if not USE_FITNESS_CACHE:
+		return None
+	if not (student_encoder or USE_NUMPY_ENCODER):
+		print('fitness cache disabled : the VAE\'s encoder samples the latent vectors, a score can\'t be reused')
+		return None
+	return FitnessCache(evaluation_context(encoder_weights_path(student_encoder), LEVELS, MAX_STEPS,
+										   MAX_STEPS_WITHOUT_PROGRESS, FRAME_JUMP, USE_NUMPY_ENCODER))
+
+def print_fitness_cache_stats(cache_stats):
+	print("fitness cache : {0} hits on {1} evaluations (hit rate {2:.2f}), {3} scores known".format(
+		cache_stats['hits'], cache_stats['lookups'], cache_stats['hit_rate'], cache_stats['entries']))
+
+def make_rollout_cache(student_encoder=USE_STUDENT_ENCODER, nb_caches=1):
+	'''
+	:param nb_caches: number of caches of the evaluation (one per process), sharing ROLLOUT_CACHE_BYTES
+	:return: RolloutCache, None if USE_ROLLOUT_CACHE is False or if the encoder isn't deterministic
+	'''
+	if not USE_ROLLOUT_CACHE:
+		return None
+	if not (student_encoder or USE_NUMPY_ENCODER):
+		print('rollout cache disabled : the VAE\'s encoder samples the latent vectors, runs can\'t be resumed exactly')
+		return None
+	return RolloutCache(max_snapshot_bytes=ROLLOUT_CACHE_BYTES // nb_caches)
+
+def print_rollout_cache_stats(cache_stats):
+	print("rollout cache : hit rate {0:.2f}, {1} runs not emulated, {2} frames skipped, {3} nodes, {4} save states "
+		  "({5:.0f} MB), evicted : {6} nodes, {7} save states".format(
+		cache_stats['hit_rate'], cache_stats['finished_runs'], cache_stats['resumed_steps'], cache_stats['nodes'],
+		cache_stats['snapshots'], cache_stats['snapshot_bytes'] / 2 ** 20, cache_stats['node_evictions'],
+		cache_stats['snapshot_evictions']))
 
 class PopulationEvaluator(object):
-	def __init__(self):
-		# Loading autoencoder
-		vae = VAE()
-		vae.load_weights(file_path=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5')
-		# We only use the encoder part
-		self.encoder = vae.encoder
-		# We need to initialize the network for multithreading
-		# Check here for more info : https://stackoverflow.com/questions/46725323/keras-tensorflow-exception-while-predicting-from-multiple-threads
-		rand_image = np.random.rand(1, 224, 320, 3)
-		self.encoder.predict(rand_image)
-		self.session = K.get_session()
-		self.graph = tf.get_default_graph()
-		self.graph.finalize()
+	def __init__(self, student_encoder=USE_STUDENT_ENCODER):
+		'''
+		:param student_encoder: if True, observations are encoded by the distilled encoder instead of the VAE's
+		'''
+		self.encoder, self.session, self.graph = load_encoder(student_encoder)
+		# Observations of all the threads are encoded together
+		self.batched_encoder = BatchedEncoder(self.encoder, self.session, self.graph, max_batch_size=NB_THREADS)
+		self.scheduler = SuccessiveHalving(EVALUATION_RUNGS, PROMOTION_RATIO)
+		# Shared by all the threads and kept from one generation to the next
+		self.rollout_cache = make_rollout_cache(student_encoder)
+		self.fitness_cache = make_fitness_cache(student_encoder)
 
 		# For multithreading, evalutations of networks will be added in this queue
 		self.queue = Queue()
@@ -142,68 +380,372 @@ class PopulationEvaluator(object):
 		self.workers_created = False
 
 		self.finished_runs = 0
+		# Times of the threads, written into profiling.PROFILE_PATH every generation
+		self.profiler = Profiler()
+		# Generation of the population being evaluated, set by run_neat
+		self.generation = 0
+		# If not None, list receiving the traces of the runs (see run_net_on_levels), used by dream.DreamEvaluator
+		self.traces = None
 
 	# Evaluates the fitness of one network
-	def eval_net(self):
-		envs = []
-		for level in LEVELS:
-			envs.append(retrowrapper.RetroWrapper(game='SonicTheHedgehog-Genesis', state=level,
-										use_restricted_actions=retro.ACTIONS_ALL, scenario='scenario'))
+	def eval_net(self, worker_name):
+		profile = self.profiler.worker(worker_name)
+		envs = make_envs()
 		while True:
+			wait_start = time.perf_counter()
 			item = self.queue.get()
-			net, genome, generation_scores, net_index = item[0], item[1], item[2], item[3]
-			generation_scores[net_index] = 0
+			# The time between two generations is not a wait of the worker
+			profile.add_time('queue_wait', time.perf_counter() - max(wait_start, self.profiler.generation_start))
+			net, scores, frames, states, index, nb_levels, max_steps = item
 
-			for env in envs:
-				best_env_score = run_net_in_env(env, self.session, self.graph, self.encoder, net)
-				generation_scores[net_index] += best_env_score
+			scores[index], frames[index], states[index] = run_net_on_levels(
+				envs, self.batched_encoder.encode, net, nb_levels, max_steps, self.rollout_cache, self.traces, profile,
+				states[index])
 
-			genome.fitness = generation_scores[net_index]
 			self.finished_runs += 1
-			print('run ' + str(self.finished_runs) + ' fitness : ' + str(genome.fitness))
+			print('run ' + str(self.finished_runs) + ' score : ' + str(scores[index]))
 			self.queue.task_done()
 
-	def evaluate_genomes(self, genomes, config):
+	def evaluate_nets(self, nets, indices, nb_levels, max_steps, states):
+		'''
+		Evaluates some networks with a budget of the scheduler.
+
+		:param states: end of the previous runs of every network (see run_net_on_levels)
+		:return: scores, number of frames emulated and end of the runs of the networks of indices
+		'''
+		scores = np.zeros(len(indices))
+		frames = np.zeros(len(indices), dtype=np.int64)
+		states = list(states)
+		for position, net_index in enumerate(indices):
+			self.queue.put([nets[net_index], scores, frames, states, position, nb_levels, max_steps])
+		self.queue.join()
+		return scores, frames, states
+
+	def evaluate_genomes(self, genomes, config, scheduler=None):
+		'''
+		:param scheduler: scheduler.SuccessiveHalving used instead of the evaluator's (ex : a full evaluation)
+		'''
+		if scheduler is None:
+			scheduler = self.scheduler
 		t0 = time.time()
 		self.finished_runs = 0
+		self.batched_encoder.reset_stats()
+		if self.rollout_cache is not None:
+			self.rollout_cache.reset_stats()
+		if self.fitness_cache is not None:
+			self.fitness_cache.reset_stats()
+		self.profiler.start_generation(self.generation)
 
 		# Creation of the population's networks
 		nets = []
 		for gid, g in genomes:
-			nets.append((g, neat.nn.FeedForwardNetwork.create(g, config)))
+			nets.append(neat.nn.FeedForwardNetwork.create(g, config))
 			g.fitness = 0
 
 		print("network creation time {0}".format(time.time() - t0))
 		t0 = time.time()
-		generation_scores = np.zeros(len(nets))  # Array initialization with zeros
-		net_index = 0
 
 		# We create the threads only at the first generation
 		# Once created, no need to create new ones, just use those which are already created
 		if not self.workers_created:
 			for i in range(NB_THREADS):
-				t = threading.Thread(target=self.eval_net)
+				t = threading.Thread(target=self.eval_net, args=('thread-' + str(i),))
 				t.start()
 		self.workers_created = True
 
-		for genome, net in nets:
-			self.queue.put([net, genome, generation_scores, net_index])
-			net_index += 1
-
-		self.queue.join()
+		evaluate = lambda indices, nb_levels, max_steps, states: self.evaluate_nets(nets, indices, nb_levels,
+																					 max_steps, states)
+		if self.fitness_cache is not None:
+			evaluate = self.fitness_cache.wrap([network_digest(net) for net in nets], evaluate)
+		generation_scores, scheduler_stats = scheduler.run(len(nets), evaluate)
+		for (gid, genome), fitness in zip(genomes, generation_scores):
+			genome.fitness = fitness
 
 		print("simulation run time {0}".format(time.time() - t0))
+		print_scheduler_stats(scheduler_stats)
+		encoder_stats = self.batched_encoder.stats()
+		print_profile(self.profiler.end_generation({'encoder_predict_time': encoder_stats['predict_time'],
+													'encoder_mean_batch_size': encoder_stats['mean_batch_size']}))
+		print("encoder : {0} batches, mean batch size {1:.2f}, mean queue latency {2:.2f} ms, max {3:.2f} ms".format(
+			encoder_stats['batches'], encoder_stats['mean_batch_size'], 1000 * encoder_stats['mean_queue_latency'],
+			1000 * encoder_stats['max_queue_latency']))
+		print("encoder batch sizes : " + str(encoder_stats['batch_sizes']))
+		if self.fitness_cache is not None:
+			print_fitness_cache_stats(self.fitness_cache.stats())
+		if self.rollout_cache is not None:
+			print_rollout_cache_stats(self.rollout_cache.stats())
+
+		scores = [s for s in generation_scores]
+		score_range.append((min(scores), np.mean(scores), max(scores)))
+		print('best score : ' + str(max(scores)))
+
+def evaluation_process(tasks, results):
+	'''
+	Main function of the processes of ProcessPopulationEvaluator.
+	The encoder and the environments of every level are loaded once, then genomes are evaluated until None is received.
+	Messages sent to results : ('ready', name) once loaded, ('start', genome index, name) before an evaluation, then
+	('result', genome index, score, frames, end of the runs, name, profile) or ('error', genome index, message, name,
+	profile) if the evaluation raised an exception.
+	'''
+	name = multiprocessing.current_process().name
+	encoder, session, graph = load_encoder()
+	encode = direct_encoder(session, graph, encoder)
+	envs = make_envs()
+	rollout_cache = make_rollout_cache(nb_caches=NB_PROCESSES)
+	profile = WorkerProfile()
+	results.put(('ready', name))
+	while True:
+		wait_start = time.time()
+		task = tasks.get()
+		if task is None:
+			break
+		genome_index, genome, config, nb_levels, max_steps, states, sending_time = task
+		results.put(('start', genome_index, name))
+		# Waiting before the genome is sent (between two generations) is not a wait of the process
+		profile.add_time('queue_wait', time.time() - max(wait_start, sending_time))
+		try:
+			net = neat.nn.FeedForwardNetwork.create(genome, config)
+			score, frames, states = run_net_on_levels(envs, encode, net, nb_levels, max_steps, rollout_cache,
+													  profile=profile, states=states)
+		except Exception as e:
+			# The genome gets MIN_REWARD, the process goes on with the next one
+			results.put(('error', genome_index, repr(e), name, profile.collect()))
+			continue
+		# The times are sent with the results
+		results.put(('result', genome_index, score, frames, states, name, profile.collect()))
+	for env in envs:
+		env.close()
+
+class ProcessPopulationEvaluator(object):
+	'''
+	Same as PopulationEvaluator but with processes instead of threads : networks' activations and the rewards'
+	computations are not serialized by the GIL anymore.
+	Genomes are sent to the processes, their fitness are sent back and assigned to the genomes in this process.
+	A genome whose evaluation raises an exception or kills its process gets MIN_REWARD, a dead process is replaced.
+	'''
+	def __init__(self, nb_processes=NB_PROCESSES):
+		self.scheduler = SuccessiveHalving(EVALUATION_RUNGS, PROMOTION_RATIO)
+		self.profiler = Profiler()
+		# Generation of the population being evaluated, set by run_neat
+		self.generation = 0
+		self.fitness_cache = make_fitness_cache()
+		# Processes are spawned rather than forked, a forked tensorflow session can't be used
+		self.context = multiprocessing.get_context('spawn')
+		self.tasks = self.context.Queue()
+		self.results = self.context.Queue()
+		# name -> process
+		self.processes = {}
+		# Names of the processes that finished loading
+		self.ready = set()
+		# name -> genome index being evaluated by the process
+		self.running = {}
+		for _ in range(nb_processes):
+			self._start_process()
+
+	def _start_process(self):
+		# Not daemonic : every process creates the processes of its environments (retrowrapper)
+		process = self.context.Process(target=evaluation_process, args=(self.tasks, self.results))
+		process.start()
+		self.processes[process.name] = process
+
+	def _check_processes(self):
+		'''
+		Replaces the dead processes.
+
+		:return: genome indices whose evaluation killed a process
+		'''
+		lost = []
+		for name, process in list(self.processes.items()):
+			if process.is_alive():
+				continue
+			del self.processes[name]
+			if name not in self.ready:
+				raise RuntimeError('evaluation process {0} died while loading (exit code {1})'.format(
+					name, process.exitcode))
+			print('evaluation process {0} died (exit code {1}), it is replaced'.format(name, process.exitcode))
+			if name in self.running:
+				lost.append(self.running.pop(name))
+			self._start_process()
+		return lost
+
+	def evaluate_nets(self, genomes, config, indices, nb_levels, max_steps, states):
+		for position, genome_index in enumerate(indices):
+			self.tasks.put((position, genomes[genome_index][1], config, nb_levels, max_steps, states[position],
+							time.time()))
+
+		scores = np.zeros(len(indices))
+		frames = np.zeros(len(indices), dtype=np.int64)
+		end_states = [None] * len(indices)
+		finished_runs = 0
+		while finished_runs < len(indices):
+			try:
+				message = self.results.get(timeout=RESULT_POLL_INTERVAL)
+			except Empty:
+				for position in self._check_processes():
+					scores[position], frames[position] = MIN_REWARD, 0
+					finished_runs += 1
+					print('run ' + str(finished_runs) + ' killed its process, score : ' + str(MIN_REWARD))
+				continue
+			if message[0] == 'ready':
+				self.ready.add(message[1])
+				continue
+			if message[0] == 'start':
+				self.running[message[2]] = message[1]
+				continue
+			if message[0] == 'error':
+				position, error, worker_name, stats = message[1:]
+				scores[position], frames[position] = MIN_REWARD, 0
+				print('run ' + str(finished_runs + 1) + ' failed : ' + error)
+			else:
+				position, scores[position], frames[position], end_states[position], worker_name, stats = message[1:]
+				print('run ' + str(finished_runs + 1) + ' score : ' + str(scores[position]))
+			self.running.pop(worker_name, None)
+			self.profiler.worker(worker_name).merge(stats)
+			finished_runs += 1
+		return scores, frames, end_states
+
+	def evaluate_genomes(self, genomes, config):
+		t0 = time.time()
+		self.profiler.start_generation(self.generation)
+		evaluate = lambda indices, nb_levels, max_steps, states: self.evaluate_nets(genomes, config, indices,
+																					 nb_levels, max_steps, states)
+		if self.fitness_cache is not None:
+			self.fitness_cache.reset_stats()
+			evaluate = self.fitness_cache.wrap(
+				[network_digest(neat.nn.FeedForwardNetwork.create(genome, config)) for gid, genome in genomes], evaluate)
+		generation_scores, scheduler_stats = self.scheduler.run(len(genomes), evaluate)
+		for (gid, genome), fitness in zip(genomes, generation_scores):
+			genome.fitness = fitness
+
+		run_time = time.time() - t0
+		print("simulation run time {0} ({1:.2f} genomes/s)".format(run_time, len(genomes) / run_time))
+		print_scheduler_stats(scheduler_stats)
+		print_profile(self.profiler.end_generation())
+		if self.fitness_cache is not None:
+			print_fitness_cache_stats(self.fitness_cache.stats())
 
 		scores = [s for s in generation_scores]
 		score_range.append((min(scores), np.mean(scores), max(scores)))
 		print('best score : ' + str(max(scores)))
 
+	def close(self):
+		for _ in self.processes:
+			self.tasks.put(None)
+		for process in self.processes.values():
+			process.join()
+
+
+def remote_evaluation(config):
+	'''
+	Loads the encoder and the environments of a worker of DistributedPopulationEvaluator (see distributed.py).
+
+	:param config: NEAT config sent by the coordinator
+	:return: function evaluating a task (genome, number of levels, maximum steps, end of the previous runs)
+	'''
+	encoder, session, graph = load_encoder()
+	encode = direct_encoder(session, graph, encoder)
+	envs = make_envs()
+	rollout_cache = make_rollout_cache()
+	profile = WorkerProfile()
+	last_result_time = [time.time()]
+
+	def evaluate(task, sending_time):
+		genome, nb_levels, max_steps, states = task
+		# Waiting before the genome is sent (between two generations) is not a wait of the worker
+		profile.add_time('queue_wait', max(0., time.time() - max(last_result_time[0], sending_time)))
+		net = neat.nn.FeedForwardNetwork.create(genome, config)
+		score, frames, states = run_net_on_levels(envs, encode, net, nb_levels, max_steps, rollout_cache,
+												  profile=profile, states=states)
+		last_result_time[0] = time.time()
+		# The times are sent with the results
+		return score, frames, states, profile.collect()
+	return evaluate
+
+class DistributedPopulationEvaluator(object):
+	'''
+	Same as ProcessPopulationEvaluator but the genomes are evaluated by workers connected through a socket, which can
+	run on other hosts (see distributed.py). The genomes of a worker that stops answering are evaluated by another one.
+	'''
+	def __init__(self, config, address=None, nb_local_workers=NB_LOCAL_WORKERS):
+		'''
+		:param address: (host, port) or path of a Unix socket the workers connect to, distributed.COORDINATOR_ADDRESS
+			(loopback) by default
+		:param nb_local_workers: number of workers started on this machine
+		'''
+		self.scheduler = SuccessiveHalving(EVALUATION_RUNGS, PROMOTION_RATIO)
+		self.profiler = Profiler()
+		# Generation of the population being evaluated, set by run_neat
+		self.generation = 0
+		self.fitness_cache = make_fitness_cache()
+		self.coordinator = Coordinator(address if address is not None else COORDINATOR_ADDRESS, setup=config)
+		print('waiting for workers on ' + str(self.coordinator.address))
+		local_address = self.coordinator.address
+		if isinstance(local_address, tuple) and local_address[0] == '0.0.0.0':
+			local_address = ('localhost', local_address[1])
+		self.local_workers = start_local_workers(local_address, nb_local_workers)
+
+	def evaluate_nets(self, genomes, indices, nb_levels, max_steps, states):
+		scores = np.zeros(len(indices))
+		frames = np.zeros(len(indices), dtype=np.int64)
+		end_states = [None] * len(indices)
+		finished_runs = [0]
+
+		def receive(position, result, worker_name):
+			if isinstance(result, TaskError):
+				# The genome crashed the worker's evaluation, it isn't selected
+				scores[position], frames[position] = MIN_REWARD, 0
+			else:
+				scores[position], frames[position], end_states[position], stats = result
+				self.profiler.worker(worker_name).merge(stats)
+			finished_runs[0] += 1
+			print('run ' + str(finished_runs[0]) + ' score : ' + str(scores[position]))
+
+		self.coordinator.map([(genomes[genome_index][1], nb_levels, max_steps, genome_states)
+							  for genome_index, genome_states in zip(indices, states)], receive)
+		return scores, frames, end_states
+
+	def evaluate_genomes(self, genomes, config):
+		t0 = time.time()
+		self.profiler.start_generation(self.generation)
+		evaluate = lambda indices, nb_levels, max_steps, states: self.evaluate_nets(genomes, indices, nb_levels,
+																					 max_steps, states)
+		if self.fitness_cache is not None:
+			self.fitness_cache.reset_stats()
+			evaluate = self.fitness_cache.wrap(
+				[network_digest(neat.nn.FeedForwardNetwork.create(genome, config)) for gid, genome in genomes], evaluate)
+		generation_scores, scheduler_stats = self.scheduler.run(len(genomes), evaluate)
+		for (gid, genome), fitness in zip(genomes, generation_scores):
+			genome.fitness = fitness
+
+		run_time = time.time() - t0
+		coordinator_stats = self.coordinator.stats()
+		print("simulation run time {0} ({1:.2f} genomes/s), {2} workers".format(run_time, len(genomes) / run_time,
+																			 coordinator_stats['workers']))
+		print("since the start : {0} workers lost, {1} genomes evaluated again".format(coordinator_stats['lost_workers'],
+																	 coordinator_stats['requeued_tasks']))
+		print_scheduler_stats(scheduler_stats)
+		print_profile(self.profiler.end_generation(coordinator_stats))
+		if self.fitness_cache is not None:
+			print_fitness_cache_stats(self.fitness_cache.stats())
 
-def run_neat(checkpoint=None):
-	envs = []
-	for level in LEVELS:
-		envs.append(retrowrapper.RetroWrapper(game='SonicTheHedgehog-Genesis', state=level,
-									use_restricted_actions=retro.ACTIONS_ALL, scenario='scenario'))
+		scores = [s for s in generation_scores]
+		score_range.append((min(scores), np.mean(scores), max(scores)))
+		print('best score : ' + str(max(scores)))
+
+	def close(self):
+		# The workers stop when they ask for their next genome
+		self.coordinator.close()
+		for process in self.local_workers:
+			process.join()
+
+def run_neat(checkpoint=None, evaluation_mode=EVALUATION_MODE):
+	'''
+	:param checkpoint: generation of a checkpoint of NEAT_DIR/checkpoints, or path of a neat.Checkpointer file
+	:param evaluation_mode: 'threads' (PopulationEvaluator), 'processes' (ProcessPopulationEvaluator), 'dream'
+		(dream.DreamEvaluator, with the LSTM trained by procedure.py) or 'distributed' (DistributedPopulationEvaluator,
+		start workers with distributed.py)
+	'''
+	envs = make_envs()
 	# Load the config file, which is assumed to live in
 	# the same directory as this script.
 	local_dir = os.path.dirname(__file__)
@@ -212,27 +754,53 @@ def run_neat(checkpoint=None):
 						 neat.DefaultSpeciesSet, neat.DefaultStagnation,
 						 config_path)
 
-	if checkpoint is not None:
+	if isinstance(checkpoint, int):
+		pop = restore_checkpoint(NEAT_DIR + '/checkpoints', checkpoint)
+	elif checkpoint is not None:
+		# Checkpoint file of neat.Checkpointer
 		pop = neat.Checkpointer.restore_checkpoint(checkpoint)
 	else:
 		# Create the population, which is the top-level object for a NEAT run.
 		pop = neat.Population(config)
 
-	# Checkpoint every generation or 900 seconds.
-	pop.add_reporter(neat.Checkpointer(1, 900, filename_prefix=NEAT_DIR + '/neat-checkpoint-'))
+	# Checkpoint every generation, written in the background, only the new genomes are saved
+	checkpointer = IncrementalCheckpointer(NEAT_DIR + '/checkpoints', generation_interval=1)
+	if checkpoint is not None:
+		# The checkpoints after the restored generation are put aside, a new chain starts
+		checkpointer.resume(pop.generation)
+	pop.add_reporter(checkpointer)
 	stats = neat.StatisticsReporter()
 	pop.add_reporter(stats)
 	# Add a stdout reporter to show progress in the terminal.
 	pop.add_reporter(neat.StdOutReporter(True))
 	# Run until the winner from a generation is able to solve the environment
 	# or the user interrupts the process.
-	popEvaluator = PopulationEvaluator()
+	if evaluation_mode == 'processes':
+		popEvaluator = ProcessPopulationEvaluator()
+		# The best network of every generation is run here
+		encoder, session, graph = load_encoder()
+		encode = direct_encoder(session, graph, encoder)
+	elif evaluation_mode == 'distributed':
+		popEvaluator = DistributedPopulationEvaluator(config)
+		encoder, session, graph = load_encoder()
+		encode = direct_encoder(session, graph, encoder)
+	elif evaluation_mode == 'dream':
+		from dream import DreamEvaluator
+		from models.LSTM import LSTM
+		lstm = LSTM(return_sequences=True)
+		lstm.load_weights(SAVED_MODELS_DIR + '/LSTM_GreenHillZone.h5')
+		popEvaluator = DreamEvaluator(lstm, PopulationEvaluator())
+		encode = popEvaluator.real_evaluator.batched_encoder.encode
+	else:
+		popEvaluator = PopulationEvaluator()
+		encode = popEvaluator.batched_encoder.encode
 	while 1:
 		try:
 			solved = False
 			total_score = 0
 
 			# 'run' returns the best genome
+			popEvaluator.generation = pop.generation
 			best_genome = pop.run(popEvaluator.evaluate_genomes, 1)
 
 			visualize.plot_stats(stats, ylog=False, view=False, filename=NEAT_DIR + "/fitness.svg")
@@ -241,7 +809,7 @@ def run_neat(checkpoint=None):
 			best_network = neat.nn.FeedForwardNetwork.create(best_genome, config)
 
 			for env in envs:
-				total_score += run_net_in_env(env, popEvaluator.session, popEvaluator.graph, popEvaluator.encoder, best_network, render=True)
+				total_score += run_net_in_env(env, encode, best_network, render=True)[0]
 
 			visualize.draw_net(config, best_genome, view=False, filename=NEAT_DIR + "/gen-" +str(pop.generation) + "-net", show_disabled=False)
 
@@ -265,22 +833,14 @@ def run_neat(checkpoint=None):
 			print("User break.")
 			break
 
+	if evaluation_mode in ('processes', 'distributed'):
+		popEvaluator.close()
+	checkpointer.close()
 	env.close()
 
 def run_network(file_name, record=False):
-	envs = []
-	for level in LEVELS:
-		envs.append(retrowrapper.RetroWrapper(game='SonicTheHedgehog-Genesis', state=level,
-									use_restricted_actions=retro.ACTIONS_ALL, scenario='scenario', record=record))
-
-	vae = VAE()
-	vae.load_weights(file_path=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5')
-	encoder = vae.encoder
-	rand_image = np.random.rand(1, 224, 320, 3)
-	encoder.predict(rand_image)  # warmup
-	session = K.get_session()
-	graph = tf.get_default_graph()
-	graph.finalize()
+	envs = make_envs(record=record)
+	encoder, session, graph = load_encoder()
 
 	local_dir = os.path.dirname(__file__)
 	config_path = os.path.join(local_dir, NEAT_DIR, 'config')
@@ -294,7 +854,7 @@ def run_network(file_name, record=False):
 	best_network = neat.nn.FeedForwardNetwork.create(best_genome, config)
 
 	for env in envs:
-		run_net_in_env(env, session, graph, encoder, best_network, render=True)
+		run_net_in_env(env, direct_encoder(session, graph, encoder), best_network, render=True)
 
 if __name__ == '__main__':
 	run_neat(checkpoint=NEAT_DIR + '/neat-checkpoint-127')
@@ -0,0 +1,287 @@
+'''
+Inference of the encoder and the decoder in pure NumPy, without keras or tensorflow.
+
+Loading the VAE in a NEAT worker builds the whole keras graph, loads the h5 weights, runs a warm-up predict and
+finalizes the graph. export_vae writes once the layers of the trained encoder (mean of the latent distribution, like
+VAE.mean_encoder) and decoder into a .npz file ; load_model reads one of them back as a NumpyModel, which only needs
+NumPy. The layers are the ones used by models/VAE.py and models/StudentEncoder.py : Conv2D and Conv2DTranspose with
+'same' or 'valid' padding (computed like tensorflow), Dense, LeakyReLU, BatchNormalization (inference), Flatten,
+Reshape, AveragePooling2D and the normalization of the uint8 frames.
+
+Export and check the models (the tolerance is the maximum difference with keras) :
+	python numpy_inference.py
+	python numpy_inference.py --student
+'''
+from constants import *
+from step_inference import ACTIVATIONS
+import argparse
+import json
+import numpy as np
+import time
+
+
+def _same_padding(size, kernel_size, stride):
+	'''
+	:return: padding before and after a dimension, like tensorflow's 'same' padding
+	'''
+	out_size = -(-size // stride)
+	total = max((out_size - 1) * stride + kernel_size - size, 0)
+	return total // 2, total - total // 2
+
+
+def conv2d(x, kernel, bias, strides, padding):
+	'''
+	:param x: (batch, height, width, channels)
+	:param kernel: (kernel height, kernel width, channels, filters) like keras
+	'''
+	kernel_height, kernel_width, channels, filters = kernel.shape
+	stride_y, stride_x = strides
+	if padding == 'same':
+		x = np.pad(x, ((0, 0), _same_padding(x.shape[1], kernel_height, stride_y),
+					   _same_padding(x.shape[2], kernel_width, stride_x), (0, 0)))
+	batch, height, width, _ = x.shape
+	out_height = (height - kernel_height) // stride_y + 1
+	out_width = (width - kernel_width) // stride_x + 1
+	# Patches of the convolution, without copy, in the order of the kernel's weights
+	s_batch, s_y, s_x, s_channel = x.strides
+	patches = np.lib.stride_tricks.as_strided(
+		x, shape=(batch, out_height, out_width, kernel_height, kernel_width, channels),
+		strides=(s_batch, s_y * stride_y, s_x * stride_x, s_y, s_x, s_channel), writeable=False)
+	y = patches.reshape(-1, kernel_height * kernel_width * channels).dot(kernel.reshape(-1, filters))
+	y = y.reshape(batch, out_height, out_width, filters)
+	if bias is not None:
+		y += bias
+	return y
+
+
+def conv2d_transpose(x, kernel, bias, strides, padding):
+	'''
+	Transposed convolution : every input pixel adds the kernel multiplied by its value to the output (scatter-add),
+	the output is then cropped like tensorflow's 'same' padding.
+
+	:param kernel: (kernel height, kernel width, filters, channels) like keras
+	'''
+	kernel_height, kernel_width, filters, channels = kernel.shape
+	stride_y, stride_x = strides
+	batch, height, width, _ = x.shape
+	full = np.zeros((batch, (height - 1) * stride_y + kernel_height, (width - 1) * stride_x + kernel_width, filters),
+					dtype=np.float32)
+	flat_x = x.reshape(-1, channels)
+	for a in range(kernel_height):
+		for b in range(kernel_width):
+			contribution = flat_x.dot(kernel[a, b].T).reshape(batch, height, width, filters)
+			full[:, a:a + stride_y * height:stride_y, b:b + stride_x * width:stride_x] += contribution
+	if padding == 'same':
+		out_height, out_width = height * stride_y, width * stride_x
+		pad_top = max((height - 1) * stride_y + kernel_height - out_height, 0) // 2
+		pad_left = max((width - 1) * stride_x + kernel_width - out_width, 0) // 2
+		full = full[:, pad_top:pad_top + out_height, pad_left:pad_left + out_width]
+	if bias is not None:
+		full += bias
+	return full
+
+
+def _layer_spec(layer, arrays, prefix):
+	'''
+	:param arrays: dict receiving the weights of the layer, named prefix + weight
+	:return: description of a keras layer (json), None if the layer does nothing at inference
+	'''
+	kind = layer.__class__.__name__
+	config = layer.get_config()
+	weights = layer.get_weights()
+	spec = {'type': kind}
+	if kind in ('InputLayer', 'Dropout'):
+		return None
+	if kind == 'Lambda':
+		if layer.name != 'normalization':
+			raise ValueError('Lambda layer not supported : ' + layer.name)
+		spec['type'] = 'Normalization'
+	elif kind in ('Conv2D', 'Conv2DTranspose'):
+		spec.update(strides=list(config['strides']), padding=config['padding'], activation=config['activation'])
+		arrays[prefix + 'kernel'] = weights[0]
+		if config['use_bias']:
+			arrays[prefix + 'bias'] = weights[1]
+	elif kind == 'Dense':
+		spec['activation'] = config['activation']
+		arrays[prefix + 'kernel'] = weights[0]
+		if config['use_bias']:
+			arrays[prefix + 'bias'] = weights[1]
+	elif kind == 'LeakyReLU':
+		spec['alpha'] = float(config['alpha'])
+	elif kind == 'BatchNormalization':
+		gamma = weights.pop(0) if config['scale'] else 1.
+		beta = weights.pop(0) if config['center'] else 0.
+		moving_mean, moving_variance = weights
+		# Folded into one multiplication and one addition
+		scale = gamma / np.sqrt(moving_variance + config['epsilon'])
+		arrays[prefix + 'scale'] = scale
+		arrays[prefix + 'offset'] = beta - moving_mean * scale
+	elif kind == 'Reshape':
+		spec['target_shape'] = list(config['target_shape'])
+	elif kind == 'AveragePooling2D':
+		if config['padding'] != 'valid' or tuple(config['pool_size']) != tuple(config['strides']):
+			raise ValueError('only AveragePooling2D with valid padding and strides = pool_size are supported')
+		spec['pool_size'] = list(config['pool_size'])
+	elif kind != 'Flatten':
+		raise ValueError('layer not supported by the NumPy inference : ' + kind)
+	return spec
+
+
+def export_model(model, name, arrays):
+	'''
+	Adds a keras model made of a chain of layers to the arrays of a .npz file.
+
+	:param name: name of the model in the file
+	:return: description of the layers
+	'''
+	specs = []
+	for layer in model.layers:
+		prefix = '{0}/{1}/'.format(name, len(specs))
+		spec = _layer_spec(layer, arrays, prefix)
+		if spec is not None:
+			specs.append(spec)
+	arrays[name + '/spec'] = np.array(json.dumps(specs))
+	return specs
+
+
+class NumpyModel():
+
+	def __init__(self, specs, arrays, prefix):
+		self.layers = []
+		for index, spec in enumerate(specs):
+			weights = {key[len(prefix) + len(str(index)) + 2:]: np.asarray(arrays[key], dtype=np.float32)
+					   for key in arrays.keys() if key.startswith('{0}/{1}/'.format(prefix, index))}
+			self.layers.append((spec, weights))
+
+	def _apply(self, spec, weights, x):
+		kind = spec['type']
+		if kind == 'Normalization':
+			return x.astype(np.float32) / 255.
+		if kind in ('Conv2D', 'Conv2DTranspose'):
+			function = conv2d if kind == 'Conv2D' else conv2d_transpose
+			x = function(x, weights['kernel'], weights.get('bias'), spec['strides'], spec['padding'])
+			return ACTIVATIONS[spec['activation']](x)
+		if kind == 'Dense':
+			x = x.dot(weights['kernel'])
+			if 'bias' in weights:
+				x += weights['bias']
+			return ACTIVATIONS[spec['activation']](x)
+		if kind == 'LeakyReLU':
+			return np.where(x > 0, x, spec['alpha'] * x)
+		if kind == 'BatchNormalization':
+			return x * weights['scale'] + weights['offset']
+		if kind == 'Flatten':
+			return x.reshape(len(x), -1)
+		if kind == 'Reshape':
+			return x.reshape([len(x)] + spec['target_shape'])
+		if kind == 'AveragePooling2D':
+			pool_y, pool_x = spec['pool_size']
+			batch, height, width, channels = x.shape
+			x = x[:, :height // pool_y * pool_y, :width // pool_x * pool_x]
+			return x.reshape(batch, height // pool_y, pool_y, width // pool_x, pool_x, channels).mean(axis=(2, 4))
+		raise ValueError('unknown layer : ' + kind)
+
+	def predict(self, x, batch_size=32):
+		'''
+		Same as keras' predict.
+		'''
+		outputs = []
+		for start in range(0, len(x), batch_size):
+			y = np.asarray(x[start:start + batch_size])
+			if y.dtype != np.uint8:
+				y = y.astype(np.float32)
+			for spec, weights in self.layers:
+				y = self._apply(spec, weights, y)
+			outputs.append(y.astype(np.float32))
+		return np.concatenate(outputs)
+
+
+def load_model(path, name='encoder'):
+	'''
+	:param path: .npz file written by export_vae or export_student_encoder
+	:param name: 'encoder' or 'decoder'
+	:return: NumpyModel
+	'''
+	with np.load(path) as arrays:
+		specs = json.loads(str(arrays[name + '/spec']))
+		return NumpyModel(specs, {key: arrays[key] for key in arrays.files if key.startswith(name + '/')}, name)
+
+
+def numpy_weights_path(weights_path):
+	'''
+	:return: path of the .npz export of a .h5 weights file
+	'''
+	return weights_path[:-len('.h5')] + '.npz' if weights_path.endswith('.h5') else weights_path + '.npz'
+
+
+def export_vae(weights_path=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5'):
+	'''
+	Writes the mean encoder and the decoder of a trained VAE into numpy_weights_path(weights_path).
+
+	:return: path of the export, VAE(uint8_inputs=True) with the weights
+	'''
+	from models.VAE import VAE
+	vae = VAE(uint8_inputs=True)
+	vae.load_weights(file_path=weights_path)
+	arrays = {}
+	export_model(vae.mean_encoder, 'encoder', arrays)
+	export_model(vae.decoder, 'decoder', arrays)
+	path = numpy_weights_path(weights_path)
+	np.savez(path, **arrays)
+	return path, vae
+
+
+def export_student_encoder(weights_path=SAVED_MODELS_DIR + '/StudentEncoder_GreenHillZone.h5'):
+	'''
+	Writes a trained StudentEncoder (encoder only) into numpy_weights_path(weights_path).
+
+	:return: path of the export, StudentEncoder with the weights
+	'''
+	from models.StudentEncoder import StudentEncoder
+	student = StudentEncoder()
+	student.load_weights(weights_path)
+	arrays = {}
+	export_model(student.model, 'encoder', arrays)
+	path = numpy_weights_path(weights_path)
+	np.savez(path, **arrays)
+	return path, student
+
+
+def compare(keras_model, numpy_model, inputs, nb_batches=10):
+	'''
+	Displays the maximum difference between the outputs of the keras and the NumPy models and their speeds on CPU
+	(hide the GPU with CUDA_VISIBLE_DEVICES='' for a fair comparison).
+
+	:param inputs: one batch of inputs
+	:return: maximum absolute difference, {name : inputs per second}
+	'''
+	keras_outputs = keras_model.predict(inputs, batch_size=len(inputs))
+	numpy_outputs = numpy_model.predict(inputs, batch_size=len(inputs))
+	error = float(np.max(np.abs(keras_outputs - numpy_outputs)))
+	speeds = {}
+	for name, model in [('keras', keras_model), ('numpy', numpy_model)]:
+		t0 = time.time()
+		for _ in range(nb_batches):
+			model.predict(inputs, batch_size=len(inputs))
+		speeds[name] = len(inputs) * nb_batches / (time.time() - t0)
+	print('{0} : max difference {1:.2e}, keras {2:.1f} frames/s, numpy {3:.1f} frames/s'.format(
+		keras_model.name, error, speeds['keras'], speeds['numpy']))
+	return error, speeds
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Exports the encoder and the decoder for the NumPy inference')
+	parser.add_argument('--student', action='store_true', help='export the distilled encoder instead of the VAE')
+	parser.add_argument('--batch-size', type=int, default=8, help='batch size of the comparison with keras')
+	args = parser.parse_args()
+
+	frames = np.random.randint(0, 256, (args.batch_size,) + IMG_SHAPE, dtype=np.uint8)
+	if args.student:
+		path, student = export_student_encoder()
+		compare(student.model, load_model(path, 'encoder'), frames)
+	else:
+		path, vae = export_vae()
+		compare(vae.mean_encoder, load_model(path, 'encoder'), frames)
+		latents = vae.mean_encoder.predict(frames)
+		compare(vae.decoder, load_model(path, 'decoder'), latents)
+	print('exported to ' + path)
@@ -8,6 +8,7 @@ from pyglet.window import key as keycodes
 from pyglet.gl import *
 import ctypes
 import retro
+from emulator import skip_frames
 from models.VAE import *
 
 
@@ -34,13 +35,13 @@ def play(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', scenario='
 	:param game: game to load
 	:param state: level to load
 	:param scenario: scenario to load
+	:param frame_jump: number of frames played with the same action
 	:return:
 	'''
 
 	print('\n\tBACKSPACE : reset the level'
 		  '\n\tECHAP : End')
 
-	jump = 0
 	env = retro.make(game=game, state=state, use_restricted_actions=retro.ACTIONS_ALL, scenario=scenario)
 	obs = env.reset()
 
@@ -57,7 +58,8 @@ def play(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', scenario='
 	pyglet.app.platform_event_loop.start()
 
 	fps_display = pyglet.clock.ClockDisplay()
-	clock.set_fps_limit(60)
+	# The frame_jump frames of an action are played in one iteration
+	clock.set_fps_limit(60 / frame_jump)
 
 	glEnable(GL_TEXTURE_2D)
 	texture_id = GLuint(0)
@@ -114,17 +116,12 @@ def play(game='SonicTheHedgehog-Genesis', state='GreenHillZone.Act1', scenario='
 			'START': keycodes.ENTER in keys_pressed or ButtonCodes.START in buttons_pressed,
 		}
 
-		if jump == 0:
-			action = [inputs[b] for b in env.BUTTONS]
-			last_action = action
-			obs, rew, done, info = env.step(action)
-			jump = frame_jump
-		else:
-			obs, rew, done, info = env.step(last_action)
+		action = [inputs[b] for b in env.BUTTONS]
+		# The action is repeated during frame_jump frames
+		obs, rew, done, info, nb_frames = skip_frames(env, action, frame_jump)
 		total_reward += rew
 		print(total_reward)
 		print(rew)
-		jump -= 1
 
 		glBindTexture(GL_TEXTURE_2D, texture_id)
 		video_buffer = ctypes.cast(obs.tobytes(), ctypes.POINTER(ctypes.c_short))
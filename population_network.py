@@ -0,0 +1,219 @@
+'''
+Activation of all the networks of a NEAT generation in one call.
+
+The genomes are compiled into numpy arrays : every node gets a slot in a (population, slots) array of values, and
+the nodes are evaluated layer by layer (a node's layer is 1 + the highest layer of its inputs). For every layer, the
+links of its nodes are stored in (population, layer width, links) arrays of source slots and weights, padded with
+links of weight 0 from a slot that is always 0. Genomes with different topologies are evaluated together.
+
+The links are summed in the same order as neat.nn.FeedForwardNetwork, so the outputs are identical (bit for bit with
+the clamped activation, up to the rounding of numpy's exp/tanh/sin for the other activations).
+
+Run this file with a checkpoint to check it against FeedForwardNetwork :
+	python population_network.py data/neat/neat-checkpoint-127
+'''
+from constants import *
+import numpy as np
+import neat
+import sys
+
+
+# Vectorized versions of neat's activation functions (neat/activations.py)
+def _sigmoid(z):
+	return 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0)))
+
+
+def _tanh(z):
+	return np.tanh(np.clip(2.5 * z, -60.0, 60.0))
+
+
+def _sin(z):
+	return np.sin(np.clip(5.0 * z, -60.0, 60.0))
+
+
+def _gauss(z):
+	return np.exp(-5.0 * np.clip(z, -3.4, 3.4) ** 2)
+
+
+def _softplus(z):
+	return 0.2 * np.log(1 + np.exp(np.clip(5.0 * z, -60.0, 60.0)))
+
+
+def _inv(z):
+	with np.errstate(divide='ignore'):
+		return np.where(z == 0.0, 0.0, 1.0 / np.where(z == 0.0, 1.0, z))
+
+
+ACTIVATIONS = {
+	'sigmoid_activation': _sigmoid,
+	'tanh_activation': _tanh,
+	'sin_activation': _sin,
+	'gauss_activation': _gauss,
+	'relu_activation': lambda z: np.where(z > 0.0, z, 0.0),
+	'lelu_activation': lambda z: np.where(z > 0.0, z, 0.005 * z),
+	'softplus_activation': _softplus,
+	'identity_activation': lambda z: z,
+	'clamped_activation': lambda z: np.clip(z, -1.0, 1.0),
+	'inv_activation': _inv,
+	'log_activation': lambda z: np.log(np.maximum(z, 1e-7)),
+	'exp_activation': lambda z: np.exp(np.clip(z, -60.0, 60.0)),
+	'abs_activation': np.abs,
+	'hat_activation': lambda z: np.maximum(0.0, 1 - np.abs(z)),
+	'square_activation': lambda z: z ** 2,
+	'cube_activation': lambda z: z ** 3,
+}
+ACTIVATION_NAMES = sorted(ACTIVATIONS)
+
+
+# Emulator's button of every action, in the order of the Actions class
+EMULATOR_BUTTONS = [1, 6, 7, 5]
+
+
+def to_emulator_actions(buttons):
+	'''
+	:param buttons: (n, NB_ACTIONS) bool array, in the order of the Actions class
+	:return: (n, 12) bool array of the emulator's buttons
+	'''
+	actions = np.zeros((len(buttons), 12), dtype=np.bool_)
+	actions[:, EMULATOR_BUTTONS] = buttons
+	return actions
+
+
+def from_emulator_actions(actions):
+	'''
+	:param actions: (n, 12) bool array of the emulator's buttons
+	:return: (n, NB_ACTIONS) bool array, in the order of the Actions class
+	'''
+	return np.asarray(actions)[:, EMULATOR_BUTTONS]
+
+
+class PopulationNetwork():
+
+	def __init__(self, genomes, config):
+		'''
+		:param genomes: list of genomes
+		:param config: neat config of the genomes
+		'''
+		self.nb_inputs = len(config.genome_config.input_keys)
+		self.nb_outputs = len(config.genome_config.output_keys)
+		networks = [neat.nn.FeedForwardNetwork.create(genome, config) for genome in genomes]
+		self.population_size = len(networks)
+
+		# Slots : 0 always 0, inputs, outputs, hidden nodes, then a slot receiving the padding nodes' values
+		self.zero_slot = 0
+		self.first_output_slot = 1 + self.nb_inputs
+		nb_hidden = [len([node_eval for node_eval in network.node_evals
+						  if node_eval[0] not in config.genome_config.output_keys]) for network in networks]
+		self.trash_slot = self.first_output_slot + self.nb_outputs + max(nb_hidden + [0])
+		self.nb_slots = self.trash_slot + 1
+
+		# Nodes of every genome, grouped by layer : (slot, activation index, bias, response, [(source slot, weight)])
+		genomes_layers = [self._layers(network, config) for network in networks]
+		nb_layers = max([len(layers) for layers in genomes_layers] + [0])
+
+		self.layers = []
+		for depth in range(nb_layers):
+			width = max(len(layers[depth]) if depth < len(layers) else 0 for layers in genomes_layers)
+			nb_links = max([len(node[4]) for layers in genomes_layers if depth < len(layers) for node in layers[depth]]
+						   + [1])
+			targets = np.full((self.population_size, width), self.trash_slot, dtype=np.int64)
+			activations = np.zeros((self.population_size, width), dtype=np.int64)
+			biases = np.zeros((self.population_size, width))
+			responses = np.zeros((self.population_size, width))
+			sources = np.full((self.population_size, width, nb_links), self.zero_slot, dtype=np.int64)
+			weights = np.zeros((self.population_size, width, nb_links))
+			for genome_index, layers in enumerate(genomes_layers):
+				if depth >= len(layers):
+					continue
+				for position, (slot, activation, bias, response, links) in enumerate(layers[depth]):
+					targets[genome_index, position] = slot
+					activations[genome_index, position] = activation
+					biases[genome_index, position] = bias
+					responses[genome_index, position] = response
+					for link_index, (source, weight) in enumerate(links):
+						sources[genome_index, position, link_index] = source
+						weights[genome_index, position, link_index] = weight
+			self.layers.append((targets, activations, biases, responses, sources, weights,
+								np.unique(activations[targets != self.trash_slot])))
+
+	def _layers(self, network, config):
+		input_keys = config.genome_config.input_keys
+		output_keys = config.genome_config.output_keys
+		slots = {key: 1 + i for i, key in enumerate(input_keys)}
+		slots.update({key: self.first_output_slot + i for i, key in enumerate(output_keys)})
+		depths = {key: 0 for key in input_keys}
+
+		layers = []
+		next_hidden_slot = self.first_output_slot + self.nb_outputs
+		for node, act_func, agg_func, bias, response, links in network.node_evals:
+			if agg_func.__name__ != 'sum_aggregation':
+				raise ValueError('Aggregation ' + agg_func.__name__ + ' is not supported by PopulationNetwork')
+			if act_func.__name__ not in ACTIVATIONS:
+				raise ValueError('Activation ' + act_func.__name__ + ' is not supported by PopulationNetwork')
+			if node not in slots:
+				slots[node] = next_hidden_slot
+				next_hidden_slot += 1
+			# Sources not evaluated before this node keep their initial value, they are in layer 0
+			depth = 1 + max([depths.get(source, 0) for source, _ in links] + [0])
+			depths[node] = depth
+			while len(layers) < depth:
+				layers.append([])
+			layers[depth - 1].append((slots[node], ACTIVATION_NAMES.index(act_func.__name__), bias, response,
+									  [(slots.get(source, self.zero_slot), weight) for source, weight in links]))
+		return layers
+
+	def activate(self, inputs):
+		'''
+		:param inputs: (population size, nb inputs) array, the inputs of every genome
+		:return: (population size, nb outputs) array of the outputs of every genome
+		'''
+		values = np.zeros((self.population_size, self.nb_slots))
+		values[:, 1:1 + self.nb_inputs] = inputs
+		rows = np.arange(self.population_size)[:, np.newaxis]
+		for targets, activations, biases, responses, sources, weights, used_activations in self.layers:
+			# Links are added one after the other, in the order of FeedForwardNetwork
+			s = np.zeros(targets.shape)
+			for link_index in range(sources.shape[2]):
+				s += values[rows, sources[:, :, link_index]] * weights[:, :, link_index]
+			z = biases + responses * s
+			layer_values = np.zeros(targets.shape)
+			for activation in used_activations:
+				mask = activations == activation
+				layer_values[mask] = ACTIVATIONS[ACTIVATION_NAMES[activation]](z[mask])
+			values[rows, targets] = layer_values
+			values[:, self.trash_slot] = 0.0
+		return values[:, self.first_output_slot:self.first_output_slot + self.nb_outputs]
+
+	def buttons(self, inputs):
+		'''
+		Output goes from -1 to 1 (clamped activation), positive values are pressed buttons.
+
+		:return: (population size, NB_ACTIONS) bool array
+		'''
+		return self.activate(inputs) > 0
+
+
+def check_population_network(genomes, config, nb_samples=100):
+	'''
+	Compares the outputs of a PopulationNetwork with the outputs of neat.nn.FeedForwardNetwork on random inputs.
+
+	:return: maximum absolute difference between the outputs
+	'''
+	population_network = PopulationNetwork(genomes, config)
+	networks = [neat.nn.FeedForwardNetwork.create(genome, config) for genome in genomes]
+	max_difference = 0.
+	for _ in range(nb_samples):
+		inputs = np.random.normal(size=(len(genomes), population_network.nb_inputs))
+		outputs = population_network.activate(inputs)
+		expected = np.array([network.activate(genome_inputs.tolist())
+							 for network, genome_inputs in zip(networks, inputs)])
+		max_difference = max(max_difference, float(np.max(np.abs(outputs - expected))))
+		if not np.array_equal(outputs > 0, expected > 0):
+			raise AssertionError('Buttons of PopulationNetwork differ from FeedForwardNetwork')
+	return max_difference
+
+
+if __name__ == '__main__':
+	population = neat.Checkpointer.restore_checkpoint(sys.argv[1])
+	difference = check_population_network(list(population.population.values()), population.config)
+	print('maximum difference with FeedForwardNetwork : ' + str(difference))
@@ -0,0 +1,88 @@
+'''
+Prepares the next training batches while the network trains on the current one.
+
+The batches of a keras Sequence are built by a pool of threads (reading memory-mapped or compressed recordings,
+gathering and converting frames release the GIL), at most `depth` batches in advance.
+'''
+from keras.callbacks import Callback
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import deque
+import time
+
+
+class Prefetcher():
+	'''
+	Endless generator of the batches of a Sequence, epoch after epoch, for keras' fit_generator (use it with
+	workers=0 so that keras doesn't add its own threads).
+	'''
+
+	def __init__(self, sequence, workers=4, depth=8):
+		'''
+		:param sequence: keras Sequence giving the batches
+		:param workers: number of threads building batches
+		:param depth: maximum number of batches prepared in advance
+		'''
+		self.sequence = sequence
+		self.depth = depth
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.pending = deque()
+		self.next_index = 0
+		# Time spent by the training loop waiting for batches that were not ready
+		self.wait_time = 0.
+		self.steps = 0
+
+	def __len__(self):
+		return len(self.sequence)
+
+	def __iter__(self):
+		return self
+
+	def _submit(self):
+		while len(self.pending) < self.depth:
+			if self.next_index == len(self.sequence):
+				# The sequence is shuffled at the end of an epoch : the batches still being built must be finished
+				wait(self.pending)
+				self.sequence.on_epoch_end()
+				self.next_index = 0
+			self.pending.append(self.executor.submit(self.sequence.__getitem__, self.next_index))
+			self.next_index += 1
+
+	def __next__(self):
+		self._submit()
+		t0 = time.time()
+		batch = self.pending.popleft().result()
+		self.wait_time += time.time() - t0
+		self.steps += 1
+		self._submit()
+		return batch
+
+	def reset_stats(self):
+		self.wait_time = 0.
+		self.steps = 0
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+
+
+class InputWaitLogger(Callback):
+	'''
+	Displays how long the training waited for its input batches during every epoch. If it is a large part of the
+	epoch's time, more workers are needed.
+	'''
+
+	def __init__(self, prefetcher):
+		super(InputWaitLogger, self).__init__()
+		self.prefetcher = prefetcher
+		self.epoch_start = 0.
+
+	def on_epoch_begin(self, epoch, logs=None):
+		self.prefetcher.reset_stats()
+		self.epoch_start = time.time()
+
+	def on_epoch_end(self, epoch, logs=None):
+		epoch_time = time.time() - self.epoch_start
+		steps = max(self.prefetcher.steps, 1)
+		print('input wait : {0:.1f}s on {1:.1f}s ({2:.1f} ms per step)'.format(
+			self.prefetcher.wait_time, epoch_time, 1000 * self.prefetcher.wait_time / steps))
+		if logs is not None:
+			logs['input_wait'] = self.prefetcher.wait_time
@@ -12,11 +12,13 @@ Folders of the projet :
 '''
 from keras.engine.saving import load_model
 from data_generation import generate_data
+from dataset import LatentStore, LatentWindows, LatentLanes
 from models.LSTM import LSTM
 import numpy as np
 from constants import *
 from models.MDN_LSTM import MDN_LSTM
 from models.VAE import VAE
+from models.StudentEncoder import StudentEncoder, benchmark_encoders
 from play import play
 from process import create_project_folders
 
@@ -49,7 +51,8 @@ create_project_folders()
 	===============================================
 '''
 
-vae = VAE()
+# Frames are given to the VAE in uint8, it normalizes them itself
+vae = VAE(uint8_inputs=True)
 # /!\ If the memory of your graphic card is too low, you can choose a smaller batch_size
 # print('\nVAE training.')
 # Do one train with Dropout
@@ -68,6 +71,20 @@ vae.train(filepath=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5', batch_size=16, ep
 # images_array_path = IMG_DIR + '/GreenHillZone.Act2.vae_train1.npy'
 # vae.generate_render(data_path=images_array_path)
 
+'''
+	===============================================
+	3 - Variante - Distillation of the encoder
+	A small encoder learns to give the latent vectors of the VAE, neat_sonic.py can use it (USE_STUDENT_ENCODER)
+	===============================================
+'''
+
+# student = StudentEncoder()
+# student.distill(vae, filepath=SAVED_MODELS_DIR + '/StudentEncoder_GreenHillZone.h5', batch_size=32, epochs=100)
+# benchmark_encoders(vae, student)
+
+# The encoders can also run in NumPy, without keras (neat_sonic.py USE_NUMPY_ENCODER) : export them with
+# python numpy_inference.py (VAE) or python numpy_inference.py --student
+
 '''
 	===============================================
 	4 - Generation of the LSTM's training dataset
@@ -84,25 +101,18 @@ vae.train(filepath=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5', batch_size=16, ep
 # 	print("\tDonnées de validation")
 # 	generate_data(state=level, extension_name=RNN_TEST_EXT, frame_jump=FRAME_JUMP, fixed_record_size=True)
 
-# X_train_rnn, Y_train_rnn, X_test_rnn, Y_test_rnn = vae.generate_latent_images()
-
-# np.save(DATA_DIR + '/X_train_rnn_GreenHillZone', X_train_rnn)
-# np.save(DATA_DIR + '/X_test_rnn_GreenHillZone', X_test_rnn)
-# np.save(DATA_DIR + '/Y_train_rnn_GreenHillZone', Y_train_rnn)
-# np.save(DATA_DIR + '/Y_test_rnn_GreenHillZone', Y_test_rnn)
-
-# X_train_rnn = np.load(DATA_DIR + '/X_train_rnn_GreenHillZone.npy')
-# X_test_rnn = np.load(DATA_DIR + '/X_test_rnn_GreenHillZone.npy')
-# Y_train_rnn = np.load(DATA_DIR + '/Y_train_rnn_GreenHillZone.npy')
-# Y_test_rnn = np.load(DATA_DIR + '/Y_test_rnn_GreenHillZone.npy')
+# The latent vectors are saved into LATENT_IMG_DIR + '/rnn_train' and LATENT_IMG_DIR + '/rnn_test'
+# train_store, test_store = vae.generate_latent_images()
 
-# nb_training_sequences = int(X_train_rnn.shape[0] / SEQ_LENGTH)
-# nb_validation_sequences = int(X_test_rnn.shape[0] / SEQ_LENGTH)
+# train_store = LatentStore(LATENT_IMG_DIR + '/rnn_train')
+# test_store = LatentStore(LATENT_IMG_DIR + '/rnn_test')
 
-# X_train_rnn = np.reshape(X_train_rnn, (X_train_rnn.shape[0], 1, X_train_rnn.shape[1]))
-# X_test_rnn = np.reshape(X_test_rnn, (X_test_rnn.shape[0], 1, X_test_rnn.shape[1]))
-# Y_train_rnn = np.reshape(Y_train_rnn, (Y_train_rnn.shape[0], Y_train_rnn.shape[1]))
-# Y_test_rnn = np.reshape(Y_test_rnn, (Y_test_rnn.shape[0], Y_test_rnn.shape[1]))
+# Windows of 64 consecutive frames, taken inside the recordings
+# training_windows = LatentWindows(train_store, window=64, batch_size=32)
+# validation_windows = LatentWindows(test_store, window=64, batch_size=32, shuffle=False)
+# Or whole recordings packed into 32 lanes and cut into chunks of 64 frames (truncated backpropagation through time)
+# training_lanes = LatentLanes(train_store, nb_lanes=32, chunk_length=64)
+# validation_lanes = LatentLanes(test_store, nb_lanes=32, chunk_length=64, shuffle=False)
 
 '''
 	===============================================
@@ -112,8 +122,9 @@ vae.train(filepath=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5', batch_size=16, ep
 
 # print('\nEntraînement LSTM.')
 
-# lstm = LSTM()
-# lstm.train(X_train=X_train_rnn, Y_train=Y_train_rnn, X_test=X_test_rnn, Y_test=Y_test_rnn, epochs=200)
+# lstm = LSTM(return_sequences=True)
+# lstm.train_on_windows(training_windows, validation_windows, epochs=200)
+# lstm.train_truncated_bptt(training_lanes, validation_lanes, epochs=200)
 # lstm.save_weights(SAVED_MODELS_DIR + '/LSTM_GreenHillZone.h5')
 # lstm.load_weights(SAVED_MODELS_DIR + '/LSTM_GreenHillZone.h5')
 
@@ -127,7 +138,8 @@ vae.train(filepath=SAVED_MODELS_DIR + '/VAE_GreenHillZone.h5', batch_size=16, ep
 # print('\nEntraînement MDN_LSTM.')
 
 # mdn_lstm = MDN_LSTM()
-# mdn_lstm.train(X_train=X_train_rnn, Y_train=Y_train_rnn, val_data=(X_test_rnn, Y_test_rnn), epochs=200)
+# mdn_lstm.train_on_windows(training_windows, validation_windows, epochs=200)
+# mdn_lstm.train_truncated_bptt(training_lanes, validation_lanes, epochs=200)
 # mdn_lstm.save_weights(SAVED_MODELS_DIR + '/MDN_LSTM.h5')
 # mdn_lstm.load_weights(SAVED_MODELS_DIR + '/MDN_LSTM.h5')
 
@@ -0,0 +1,143 @@
+'''
+Where the time of a NEAT generation goes.
+
+Every evaluation worker (thread or process) has a WorkerProfile measuring the time spent in the parts of
+neat_sonic.run_net_in_env (env.step, encoding, network activation, resets) and waiting for genomes, and counting the
+frames and the reasons why the runs ended. At the end of every generation, the Profiler writes one json line per
+worker, and one for all the workers together, into PROFILE_PATH :
+	{"generation": 3, "worker": "thread-0", "wall_time": 52.1, "times": {"env_step": 30.2, ...},
+	 "counts": {"frames": 81000, "end_death": 12, ...}, "frames_per_s": 1554.7}
+'''
+from constants import *
+import json
+import os
+import threading
+import time
+
+PROFILE_PATH = NEAT_DIR + '/profile.jsonl'
+
+
+class _Measure():
+
+	def __init__(self, profile, name):
+		self.profile = profile
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+	def __exit__(self, *exc_info):
+		self.profile.add_time(self.name, time.perf_counter() - self.start)
+
+
+class WorkerProfile():
+	'''
+	Times and counters of one worker. Only used by its worker, so there is no lock.
+	'''
+
+	def __init__(self, name=None):
+		self.name = name
+		self.reset()
+
+	def reset(self):
+		self.times = {}
+		self.counts = {}
+
+	def add_time(self, name, seconds):
+		self.times[name] = self.times.get(name, 0.) + seconds
+
+	def count(self, name, n=1):
+		self.counts[name] = self.counts.get(name, 0) + n
+
+	def measure(self, name):
+		'''
+		ex : with profile.measure('env_step'): env.step(action)
+		'''
+		return _Measure(self, name)
+
+	def collect(self):
+		'''
+		:return: times and counters since the last call (to send them to another process)
+		'''
+		stats = {'times': self.times, 'counts': self.counts}
+		self.reset()
+		return stats
+
+	def merge(self, stats):
+		for name, seconds in stats['times'].items():
+			self.add_time(name, seconds)
+		for name, n in stats['counts'].items():
+			self.count(name, n)
+
+
+class Profiler():
+
+	def __init__(self, path=PROFILE_PATH):
+		self.path = path
+		self.workers = {}
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.generation_start = time.perf_counter()
+
+	def worker(self, name):
+		'''
+		:return: WorkerProfile of a worker, created at its first call
+		'''
+		with self.lock:
+			if name not in self.workers:
+				self.workers[name] = WorkerProfile(name)
+			return self.workers[name]
+
+	def start_generation(self, generation):
+		'''
+		:param generation: generation of the population (neat.Population.generation), written in the profiles
+		'''
+		with self.lock:
+			self.generation = generation
+			for profile in self.workers.values():
+				profile.reset()
+			self.generation_start = time.perf_counter()
+
+	def end_generation(self, extra=None):
+		'''
+		Writes the profiles of the generation.
+
+		:param extra: dict added to the line of all the workers (ex : statistics of the encoder)
+		:return: line of all the workers
+		'''
+		wall_time = time.perf_counter() - self.generation_start
+		total = WorkerProfile('all')
+		lines = []
+		with self.lock:
+			for name, profile in sorted(self.workers.items()):
+				total.merge({'times': profile.times, 'counts': profile.counts})
+				lines.append(self._line(name, wall_time, profile))
+		total_line = self._line('all', wall_time, total)
+		if extra is not None:
+			total_line.update(extra)
+		lines.append(total_line)
+
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		with open(self.path, 'a') as f:
+			for line in lines:
+				f.write(json.dumps(line) + '\n')
+		return total_line
+
+	def _line(self, name, wall_time, profile):
+		return {'generation': self.generation, 'time': time.time(), 'worker': name, 'wall_time': wall_time,
+				'times': dict(profile.times), 'counts': dict(profile.counts),
+				'frames_per_s': profile.counts.get('frames', 0) / wall_time if wall_time > 0 else 0.}
+
+
+def print_profile(total_line):
+	'''
+	Displays the share of the generation's time of every part (summed over the workers).
+	'''
+	worker_time = max(sum(total_line['times'].values()), 1e-9)
+	parts = ', '.join('{0} {1:.0f}%'.format(name, 100 * seconds / worker_time)
+					  for name, seconds in sorted(total_line['times'].items(), key=lambda item: -item[1]))
+	print('profile : {0:.0f} frames/s, {1}'.format(total_line['frames_per_s'], parts))
+	ends = {name[len('end_'):]: n for name, n in total_line['counts'].items() if name.startswith('end_')}
+	print('runs ended by : ' + str(ends))
@@ -0,0 +1,260 @@
+'''
+Recording of game sessions on the disk while playing.
+
+Frames and actions are written by chunks from a background thread so the game loop never waits for np.save and
+the memory used doesn't grow with the length of the session.
+'''
+from constants import *
+from frame_codec import FrameFileWriter
+import numpy as np
+import os
+import struct
+import threading
+from queue import Queue
+
+# Size of the .npy header we write, big enough for any shape we record
+NPY_HEADER_SIZE = 128
+# Number of frames sent at once to the writer thread
+CHUNK_SIZE = 32
+# Number of chunks waiting to be written before the game loop blocks
+MAX_PENDING_CHUNKS = 8
+
+
+def npy_header(dtype, shape):
+	'''
+	.npy header (format version 1.0) padded to NPY_HEADER_SIZE bytes so it can be rewritten once the final shape
+	is known.
+	'''
+	header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+	# magic string (6) + version (2) + header length (2) + header + '\n'
+	padding = NPY_HEADER_SIZE - 10 - len(header) - 1
+	if padding < 0:
+		raise ValueError('Shape ' + str(shape) + ' is too big for the .npy header')
+	header = header + ' ' * padding + '\n'
+	return np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpyAppender():
+	'''
+	Writes a .npy file chunk by chunk. The file can be read with np.load once closed.
+	'''
+
+	def __init__(self, path, item_shape, dtype):
+		self.path = path
+		self.item_shape = tuple(item_shape)
+		self.dtype = np.dtype(dtype)
+		self.length = 0
+		self.file = open(path, 'wb')
+		self.file.write(npy_header(self.dtype, (0,) + self.item_shape))
+
+	def append(self, chunk):
+		chunk = np.ascontiguousarray(chunk, dtype=self.dtype)
+		self.file.write(chunk.tobytes())
+		self.length += len(chunk)
+
+	def close(self):
+		# The header is rewritten with the real number of items
+		self.file.seek(0)
+		self.file.write(npy_header(self.dtype, (self.length,) + self.item_shape))
+		self.file.close()
+
+
+def open_writer(path, item_shape, dtype):
+	'''
+	:param path: final path of the file, its extension gives the format (.npy or compressed frames)
+	:return: writer of the file, which is named path + '.part' until it is committed
+	'''
+	if path.endswith(COMPRESSED_FRAMES_EXT):
+		return FrameFileWriter(path + '.part', item_shape, dtype)
+	return NpyAppender(path + '.part', item_shape, dtype)
+
+
+class RecordingSink():
+	'''
+	Receives the frames and actions of the game loop and writes them on the disk from a background thread.
+
+	A segment is the recording that will become one saved file (per type of data). It is started with
+	start_segment, then ends with commit (files are kept) or discard (files are removed).
+	While being written, files end with '.part' so that they are not found by the training scripts.
+	An error of the writer thread (ex : full disk) loses its segment and is raised by the next call to start_segment,
+	append, commit or close.
+	'''
+
+	def __init__(self, chunk_size=CHUNK_SIZE, max_pending_chunks=MAX_PENDING_CHUNKS, manifest=None):
+		'''
+		:param manifest: if not None, the committed recordings are added to this Manifest
+		'''
+		self.chunk_size = chunk_size
+		self.manifest = manifest
+		# Bounded queue : if the disk is too slow, the game loop waits instead of filling the memory
+		self.queue = Queue(maxsize=max_pending_chunks)
+		self.paths = None
+		self.buffers = None
+		self.length = 0
+		# Exception of the writer thread, not yet raised in the game loop
+		self.error = None
+		self.thread = threading.Thread(target=self._write, daemon=True)
+		self.thread.start()
+
+	def start_segment(self, paths, item_shapes, dtypes):
+		'''
+		:param paths: final path of every recorded stream (ex : images and actions), ending by '.npy' or by
+			COMPRESSED_FRAMES_EXT
+		:param item_shapes: shape of one item of every stream
+		:param dtypes: dtype of every stream
+		'''
+		self.discard()
+		self._raise_error()
+		self.paths = list(paths)
+		self.buffers = [[] for _ in paths]
+		self.length = 0
+		self.queue.put(('open', self.paths, item_shapes, dtypes))
+
+	def is_recording(self):
+		return self.paths is not None
+
+	def append(self, *items):
+		'''
+		Adds one item to every stream of the current segment (ex : sink.append(image, action)).
+		'''
+		self._raise_error()
+		for buffer, item in zip(self.buffers, items):
+			buffer.append(item)
+		self.length += 1
+		if len(self.buffers[0]) >= self.chunk_size:
+			self._flush()
+
+	def __len__(self):
+		return self.length
+
+	def commit(self):
+		'''
+		Ends the current segment and keeps its files.
+		'''
+		self._raise_error()
+		if self.paths is None:
+			return
+		self._flush()
+		self.queue.put(('commit',))
+		self.paths = None
+		self.buffers = None
+		self.length = 0
+
+	def discard(self):
+		'''
+		Ends the current segment and removes its files.
+		'''
+		if self.paths is None:
+			return
+		self.queue.put(('discard',))
+		self.paths = None
+		self.buffers = None
+		self.length = 0
+
+	def close(self):
+		'''
+		Waits until everything is written and stops the writer thread. An unfinished segment is discarded.
+		'''
+		self.discard()
+		self.queue.put(None)
+		self.thread.join()
+		self._raise_error()
+
+	def _raise_error(self):
+		'''
+		Raises the exception of the writer thread. The segment it was writing is lost, its '.part' files are removed.
+		'''
+		if self.error is None:
+			return
+		error, self.error = self.error, None
+		self.paths = None
+		self.buffers = None
+		self.length = 0
+		raise error
+
+	def _flush(self):
+		if self.buffers[0]:
+			self.queue.put(('append', [np.array(buffer) for buffer in self.buffers]))
+			self.buffers = [[] for _ in self.buffers]
+
+	def _write(self):
+		appenders = []
+		# After an error, the commands of the segment are dropped until the next one is opened. The queue is still
+		# emptied so the game loop never blocks on it.
+		failed = False
+		while True:
+			command = self.queue.get()
+			if command is None:
+				return
+			if failed and command[0] != 'open':
+				continue
+			try:
+				failed = False
+				if command[0] == 'open':
+					paths, item_shapes, dtypes = command[1:]
+					appenders = []
+					for path, item_shape, dtype in zip(paths, item_shapes, dtypes):
+						appenders.append(open_writer(path, item_shape, dtype))
+				elif command[0] == 'append':
+					for appender, chunk in zip(appenders, command[1]):
+						appender.append(chunk)
+				elif command[0] == 'commit':
+					# Every file is complete before the first one is renamed
+					for appender in appenders:
+						appender.close()
+					committed = []
+					try:
+						for appender in appenders:
+							path = appender.path[:-len('.part')]
+							os.replace(appender.path, path)
+							committed.append(path)
+							if self.manifest is not None:
+								self.manifest.add(path)
+					except Exception:
+						# The streams of a recording are saved together or not at all
+						_remove_committed(committed, self.manifest)
+						raise
+					for path in committed:
+						print('Saved at : ' + path)
+					appenders = []
+				elif command[0] == 'discard':
+					for appender in appenders:
+						appender.close()
+						os.remove(appender.path)
+					appenders = []
+			except Exception as e:
+				self.error = e
+				failed = True
+				_remove_parts(appenders)
+				appenders = []
+
+
+def _remove_parts(appenders):
+	'''
+	Closes and removes the '.part' files of a failed segment, as far as possible.
+	'''
+	for appender in appenders:
+		try:
+			appender.file.close()
+		except Exception:
+			pass
+		try:
+			os.remove(appender.path)
+		except OSError:
+			pass
+
+
+def _remove_committed(paths, manifest):
+	'''
+	Removes the files of a segment already renamed, and their manifest entries, as far as possible.
+	'''
+	for path in paths:
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		if manifest is not None:
+			try:
+				manifest.remove(path)
+			except Exception:
+				pass
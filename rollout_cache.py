@@ -0,0 +1,168 @@
+'''
+Cache of the beginnings of the runs, shared by the evaluations of the networks.
+
+Many networks of a generation press the same buttons at the beginning of a level. The game being deterministic, two
+runs with the same actions go through the same frames : the evaluation of a network can start where the longest run
+with the same first actions stopped instead of starting from env.reset().
+
+The runs form a tree : a node is the state of a run after a sequence of decisions (one decision every FRAME_JUMP
+frames), identified by a hash of the level and of the actions taken. A node stores what run_net_in_env needs to
+continue the run (latent vector, scores, step) and, every snapshot_interval decisions, a save state of the emulator.
+The node reached when a run ends stores its final score, so a network making the same decisions as a previous one
+is not run at all.
+
+Nodes and save states are evicted in least recently used order, the nodes of a run before their parents. The save
+states are limited by their size in memory : a run of MAX_STEPS steps keeps about 70 of them.
+'''
+from collections import OrderedDict, namedtuple
+import hashlib
+import threading
+
+# State of a run before a decision. snapshot is None when the node has no save state.
+# If final_score is not None the run ended at this step, during the previous decision, and the other fields are not
+# used.
+RolloutNode = namedtuple('RolloutNode', ['step', 'latent_vector', 'cumulative_reward', 'best_score',
+										 'steps_without_progress', 'snapshot', 'final_score'])
+
+
+class RolloutCache():
+
+	def __init__(self, max_nodes=100000, max_snapshot_bytes=1 << 30, snapshot_interval=16):
+		'''
+		:param max_nodes: maximum number of nodes (a node without save state uses about 1 KB)
+		:param max_snapshot_bytes: maximum total size of the emulator save states kept
+		:param snapshot_interval: a save state is kept every snapshot_interval decisions
+		'''
+		self.max_nodes = max_nodes
+		self.max_snapshot_bytes = max_snapshot_bytes
+		self.snapshot_interval = snapshot_interval
+		self.nodes = OrderedDict()
+		self.snapshots = OrderedDict()
+		self.snapshot_bytes = 0
+		self.lock = threading.Lock()
+		self.reset_stats()
+
+	@staticmethod
+	def root(level):
+		return hashlib.blake2b(level.encode('utf8'), digest_size=16).digest()
+
+	@staticmethod
+	def child(key, action):
+		'''
+		:param key: key of a node
+		:param action: emulator's buttons pressed from this node during FRAME_JUMP frames
+		:return: key of the node reached
+		'''
+		return hashlib.blake2b(key + action.tobytes(), digest_size=16).digest()
+
+	def _touch(self, key):
+		self.nodes.move_to_end(key)
+		if key in self.snapshots:
+			self.snapshots.move_to_end(key)
+
+	def add_run(self, path):
+		'''
+		Adds the nodes of a run.
+
+		:param path: list of (key, RolloutNode) in the order of the run
+		'''
+		with self.lock:
+			# The deepest nodes are the least recently used : a node is evicted before its parents
+			for key, node in reversed(path):
+				self.nodes[key] = node._replace(snapshot=None)
+				if node.snapshot is not None:
+					self._remove_snapshot(key)
+					self.snapshots[key] = node.snapshot
+					self.snapshot_bytes += len(node.snapshot)
+				self._touch(key)
+			while len(self.nodes) > self.max_nodes:
+				old_key, _ = self.nodes.popitem(last=False)
+				self.node_evictions += 1
+				if self._remove_snapshot(old_key):
+					self.snapshot_evictions += 1
+			while self.snapshot_bytes > self.max_snapshot_bytes:
+				old_key = next(iter(self.snapshots))
+				self._remove_snapshot(old_key)
+				self.snapshot_evictions += 1
+
+	def _remove_snapshot(self, key):
+		'''
+		:return: True if the node had a save state
+		'''
+		snapshot = self.snapshots.pop(key, None)
+		if snapshot is None:
+			return False
+		self.snapshot_bytes -= len(snapshot)
+		return True
+
+	def _get(self, key):
+		with self.lock:
+			node = self.nodes.get(key)
+			if node is not None and key in self.snapshots:
+				node = node._replace(snapshot=self.snapshots[key])
+			return node
+
+	def resume(self, level, decide, latent_vector, max_steps):
+		'''
+		Follows the decisions of a network in the tree, as far as the runs already cached go.
+
+		:param level: level of the run
+		:param decide: function giving the emulator's buttons (bool array) the network presses for a latent vector
+		:param latent_vector: latent vector at the beginning of the run
+		:param max_steps: maximum number of steps of the run, nodes reached after are not used
+		:return: (key, node) of the deepest node with a save state or with a final score, (root key, None) if there
+			is no such node
+		'''
+		key = self.root(level)
+		resumed_key, resumed_node = key, None
+		visited = []
+		while True:
+			key = self.child(key, decide(latent_vector))
+			node = self._get(key)
+			if node is None or node.step >= max_steps:
+				break
+			visited.append(key)
+			if node.final_score is not None:
+				resumed_key, resumed_node = key, node
+				break
+			latent_vector = node.latent_vector
+			if node.snapshot is not None:
+				resumed_key, resumed_node = key, node
+
+		with self.lock:
+			for key in reversed(visited):
+				if key in self.nodes:
+					self._touch(key)
+			self.runs += 1
+			if resumed_node is not None:
+				self.resumed_runs += 1
+				self.resumed_steps += resumed_node.step
+				if resumed_node.final_score is not None:
+					self.finished_runs += 1
+		return resumed_key, resumed_node
+
+	def reset_stats(self):
+		with self.lock:
+			self.runs = 0
+			# Runs resumed from a save state or a final score
+			self.resumed_runs = 0
+			# Runs entirely found in the cache
+			self.finished_runs = 0
+			# Frames not emulated thanks to the cache
+			self.resumed_steps = 0
+			self.node_evictions = 0
+			self.snapshot_evictions = 0
+
+	def stats(self):
+		with self.lock:
+			return {
+				'runs': self.runs,
+				'hit_rate': self.resumed_runs / self.runs if self.runs else 0.,
+				'finished_runs': self.finished_runs,
+				'resumed_steps': self.resumed_steps,
+				'nodes': len(self.nodes),
+				'snapshots': len(self.snapshots),
+				'snapshot_bytes': self.snapshot_bytes,
+				'node_evictions': self.node_evictions,
+				'snapshot_evictions': self.snapshot_evictions,
+			}
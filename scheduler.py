@@ -0,0 +1,141 @@
+'''
+Successive halving of the evaluation budget of a generation.
+
+All the genomes are evaluated with a small budget (the first level, a few steps), then only the best ones are
+evaluated with the next budget, and so on until the full evaluation (all the levels, MAX_STEPS).
+
+A budget (rung) is (number of levels, maximum number of steps per level) : the score of a genome on a rung is the sum
+of its best scores on the first levels, the runs being stopped after the maximum number of steps. The budgets must
+increase from one rung to the next, so the score of a genome can only increase when it is promoted (a run's best
+score can only increase with more steps and the score of a level is at least 0).
+A run stopped by a budget keeps its state (rollout_cache.RolloutNode with a save state of the emulator) : when the
+genome is promoted, the run continues from there instead of being played again from the beginning of the level.
+
+The score of an eliminated genome is only a lower bound of its full fitness. Its fitness is estimated from the
+genomes promoted from the same rung : its score is multiplied by the ratio of their final fitness to their scores on
+this rung, and kept under the lowest final fitness of these promoted genomes. The genomes keep the order of the rung
+they were eliminated at, and the fitness of the species is on the scale of a full evaluation. NEAT still doesn't see
+exactly the fitness of a full evaluation : a genome that is slow to start can be eliminated while it would have beaten
+promoted genomes with the full budget.
+'''
+import numpy as np
+import math
+
+
+def estimate_fitness(eliminated_scores, promoted_scores, promoted_fitness):
+	'''
+	:param eliminated_scores: scores on a rung of the genomes eliminated at this rung
+	:param promoted_scores: scores on the same rung of the genomes promoted from it
+	:param promoted_fitness: final fitness of the promoted genomes
+	:return: estimated fitness of the eliminated genomes, lower than the lowest final fitness of the promoted genomes
+		(unless they are all 0)
+	'''
+	eliminated_scores = np.asarray(eliminated_scores, dtype=np.float64)
+	if len(eliminated_scores) == 0:
+		return eliminated_scores
+	total_score = np.sum(promoted_scores)
+	# The budgets increase, the scores can't decrease
+	ratio = max(np.sum(promoted_fitness) / total_score, 1.) if total_score > 0 else 1.
+	best_score = np.max(eliminated_scores)
+	lowest_fitness = np.min(promoted_fitness)
+	if best_score > 0 and best_score * ratio >= lowest_fitness:
+		ratio = np.nextafter(lowest_fitness, -np.inf) / best_score
+	return eliminated_scores * ratio
+
+
+class SuccessiveHalving():
+
+	def __init__(self, rungs, promotion_ratio=0.5):
+		'''
+		:param rungs: list of (number of levels, maximum number of steps), increasing budgets
+		:param promotion_ratio: fraction of the genomes of a rung promoted to the next one
+		'''
+		for (nb_levels, max_steps), (next_nb_levels, next_max_steps) in zip(rungs, rungs[1:]):
+			if next_nb_levels < nb_levels or next_max_steps < max_steps:
+				raise ValueError('budgets of the rungs must increase : ' + str(rungs))
+		if not 0 < promotion_ratio <= 1:
+			raise ValueError('promotion_ratio must be in ]0, 1]')
+		self.rungs = rungs
+		self.promotion_ratio = promotion_ratio
+
+	def run(self, nb_genomes, evaluate):
+		'''
+		:param evaluate: function (genome indices, number of levels, maximum steps, run states) -> (scores, emulated
+			frames, run states) of these genomes. The run states of a genome are the RolloutNode of the end of its runs
+			on the levels played (see neat_sonic.run_net_on_levels), None if it has no run yet : the runs continue
+			from these states
+		:return: fitness of every genome, statistics of the rungs
+		'''
+		fitness = np.zeros(nb_genomes)
+		run_states = [None] * nb_genomes
+		candidates = np.arange(nb_genomes)
+		rungs_candidates, rungs_scores, rungs_stats = [], [], []
+		for rung_index, (nb_levels, max_steps) in enumerate(self.rungs):
+			scores, frames, states = evaluate(candidates, nb_levels, max_steps, [run_states[i] for i in candidates])
+			scores = np.asarray(scores, dtype=np.float64)
+			fitness[candidates] = scores
+			for genome_index, genome_states in zip(candidates, states):
+				run_states[genome_index] = genome_states
+			rungs_candidates.append(candidates)
+			rungs_scores.append(scores)
+			rungs_stats.append({'nb_levels': nb_levels, 'max_steps': max_steps, 'genomes': len(candidates),
+								'frames': int(np.sum(frames))})
+			if rung_index < len(self.rungs) - 1:
+				nb_promoted = max(1, int(math.ceil(self.promotion_ratio * len(candidates))))
+				# Stable sort : ties keep the order of the genomes
+				order = np.argsort(-scores, kind='stable')
+				# The save states of the eliminated genomes won't be used
+				for genome_index in candidates[order[nb_promoted:]]:
+					run_states[genome_index] = _without_snapshots(run_states[genome_index])
+				candidates = candidates[order[:nb_promoted]]
+
+		# The final fitness of the genomes promoted from a rung is known once the next rungs are done
+		for rung_index in range(len(self.rungs) - 2, -1, -1):
+			promoted = np.isin(rungs_candidates[rung_index], rungs_candidates[rung_index + 1])
+			eliminated = rungs_candidates[rung_index][~promoted]
+			fitness[eliminated] = estimate_fitness(rungs_scores[rung_index][~promoted],
+												   rungs_scores[rung_index][promoted],
+												   fitness[rungs_candidates[rung_index][promoted]])
+
+		frames = sum(rung_stats['frames'] for rung_stats in rungs_stats)
+		full_frames = self.full_frames_estimate(run_states, rungs_candidates[-1])
+		stats = {
+			'rungs': rungs_stats,
+			'frames': frames,
+			# Frames a full evaluation of every genome would have emulated (without the caches)
+			'full_frames_estimate': full_frames,
+			'frames_saved': full_frames - frames,
+		}
+		return fitness, stats
+
+	def full_frames_estimate(self, run_states, evaluated):
+		'''
+		The runs that ended count their frames. On every level, a run stopped by a budget counts at least the mean
+		frames of the runs of the genomes fully evaluated, a level not played counts this mean.
+
+		:param evaluated: indices of the genomes evaluated with the last rung
+		:return: estimation of the number of frames of a full evaluation of every genome
+		'''
+		nb_levels, max_steps = self.rungs[-1]
+		level_frames = []
+		for level in range(nb_levels):
+			steps = [run_states[i][level].step for i in evaluated
+					 if run_states[i] is not None and level < len(run_states[i])]
+			level_frames.append(np.mean(steps) if steps else max_steps)
+		total = 0.
+		for states in run_states:
+			for level in range(nb_levels):
+				state = states[level] if states is not None and level < len(states) else None
+				if state is None:
+					total += level_frames[level]
+				elif state.final_score is not None:
+					total += state.step
+				else:
+					total += max(state.step, level_frames[level])
+		return int(total)
+
+
+def _without_snapshots(states):
+	if states is None:
+		return None
+	return [state._replace(snapshot=None) for state in states]
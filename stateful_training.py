@@ -0,0 +1,90 @@
+'''
+Truncated backpropagation through time of the LSTMs on whole recordings.
+
+A copy of the model is built with stateful LSTM layers and a fixed batch size (the number of lanes of a
+dataset.LatentLanes). It is trained on the chunks of the lanes one after the other : the gradients only go back to
+the beginning of the chunk (memory bounded by the chunk's length), but the state of the LSTM is kept from one chunk
+to the next, so the network still sees the whole recording. The states of the lanes where a new recording starts are
+reset before the chunk, and the padding timesteps have a sample weight of 0.
+'''
+from keras import backend as K
+import numpy as np
+import time
+
+
+def reset_lanes(model, lanes):
+	'''
+	Sets to 0 the states of the stateful layers of a model for some rows of the batch.
+
+	:param lanes: (batch,) booleans, True for the rows to reset
+	'''
+	if not np.any(lanes):
+		return
+	for layer in model.layers:
+		if getattr(layer, 'stateful', False):
+			for state in layer.states:
+				value = K.get_value(state)
+				value[lanes] = 0
+				K.set_value(state, value)
+
+
+def _run_epoch(model, lanes, train):
+	'''
+	:return: mean loss of the timesteps with a target
+	'''
+	model.reset_states()
+	total_loss, nb_timesteps = 0., 0
+	for index in range(len(lanes)):
+		x, y, weights, resets = lanes[index]
+		reset_lanes(model, resets)
+		if train:
+			loss = model.train_on_batch(x, y, sample_weight=weights)
+		else:
+			loss = model.test_on_batch(x, y, sample_weight=weights)
+		if isinstance(loss, list):
+			loss = loss[0]
+		# Keras gives the mean loss of the timesteps of non-zero weight
+		timesteps = int(np.count_nonzero(weights))
+		total_loss += float(loss) * timesteps
+		nb_timesteps += timesteps
+	return total_loss / max(nb_timesteps, 1)
+
+
+def train_stateful(model, training_lanes, validation_lanes=None, epochs=200, patience=10, min_delta=0.0001):
+	'''
+	:param model: stateful model compiled with sample_weight_mode='temporal', of batch size training_lanes.nb_lanes
+	:param training_lanes: dataset.LatentLanes of the training LatentStore
+	:param validation_lanes: dataset.LatentLanes of the validation LatentStore, with the same number of lanes
+	:param patience: the training stops when the validation loss hasn't decreased of min_delta for patience epochs,
+		the weights of the best epoch are kept
+	:return: history {'loss': [...], 'val_loss': [...]}
+	'''
+	if validation_lanes is not None and validation_lanes.nb_lanes != training_lanes.nb_lanes:
+		raise ValueError('training and validation lanes must have the same number of lanes (batch size)')
+	history = {'loss': [], 'val_loss': []}
+	best_loss, best_weights, wait = np.inf, None, 0
+	for epoch in range(epochs):
+		t0 = time.time()
+		loss = _run_epoch(model, training_lanes, train=True)
+		training_lanes.on_epoch_end()
+		history['loss'].append(loss)
+		message = 'epoch {0}/{1} - {2:.0f}s - {3:.0f} timesteps/s - loss: {4:.5f}'.format(
+			epoch + 1, epochs, time.time() - t0, training_lanes.nb_timesteps() / max(time.time() - t0, 1e-9), loss)
+		monitored_loss = loss
+		if validation_lanes is not None:
+			monitored_loss = _run_epoch(model, validation_lanes, train=False)
+			history['val_loss'].append(monitored_loss)
+			message += ' - val_loss: {0:.5f}'.format(monitored_loss)
+		print(message)
+
+		if monitored_loss < best_loss - min_delta:
+			best_loss, best_weights, wait = monitored_loss, model.get_weights(), 0
+		else:
+			wait += 1
+			if wait >= patience:
+				print('epoch {0}: early stopping'.format(epoch + 1))
+				break
+	if best_weights is not None:
+		model.set_weights(best_weights)
+	model.reset_states()
+	return history
@@ -0,0 +1,213 @@
+'''
+Step by step inference of the LSTMs in NumPy, with the weights of the trained keras models.
+
+Playing in a dream predicts one timestep at a time : model.predict has a large fixed cost for such a small input, and
+the LSTM's state is lost between two calls. An LSTMStepper keeps the state (h, c) of its sequences and computes a
+timestep with a few matrix products (keras' LSTM equations, gates in keras' order i, f, c, o).
+rollout advances many dreams of a world model at once, from their first latent vectors and their actions.
+
+benchmark_stepper compares the time of a step with model.predict and with the step model of the world model.
+'''
+from constants import *
+import numpy as np
+import time
+
+# Time of a step of one sequence the NumPy inference must stay under (the game runs at 60 fps)
+LATENCY_TARGET = 0.001
+
+ACTIVATIONS = {
+	'linear': lambda x: x,
+	'tanh': np.tanh,
+	'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+	# Same as keras.backend.hard_sigmoid
+	'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0., 1.),
+	'relu': lambda x: np.maximum(x, 0.),
+}
+
+
+def _activation(name):
+	if name not in ACTIVATIONS:
+		raise ValueError('activation not supported by the NumPy inference : ' + str(name))
+	return ACTIVATIONS[name]
+
+
+class LSTMCell():
+
+	def __init__(self, kernel, recurrent_kernel, bias, activation='tanh', recurrent_activation='hard_sigmoid'):
+		'''
+		:param kernel: (input dim, 4 * units) weights of the inputs, gates in the order i, f, c, o
+		:param recurrent_kernel: (units, 4 * units) weights of h
+		'''
+		self.kernel = np.asarray(kernel, dtype=np.float32)
+		self.recurrent_kernel = np.asarray(recurrent_kernel, dtype=np.float32)
+		self.bias = np.zeros(self.kernel.shape[1], dtype=np.float32) if bias is None else np.asarray(bias, np.float32)
+		self.units = self.recurrent_kernel.shape[0]
+		self.activation = _activation(activation)
+		self.recurrent_activation = _activation(recurrent_activation)
+
+	@staticmethod
+	def from_layer(layer):
+		'''
+		:param layer: keras.layers.LSTM
+		'''
+		config = layer.get_config()
+		weights = layer.get_weights()
+		return LSTMCell(weights[0], weights[1], weights[2] if config['use_bias'] else None, config['activation'],
+						config['recurrent_activation'])
+
+	def step(self, x, h, c):
+		'''
+		:param x: (batch, input dim)
+		:return: h, c of the next timestep
+		'''
+		z = x.dot(self.kernel)
+		z += h.dot(self.recurrent_kernel)
+		z += self.bias
+		units = self.units
+		i = self.recurrent_activation(z[:, :units])
+		f = self.recurrent_activation(z[:, units:2 * units])
+		c = f * c + i * self.activation(z[:, 2 * units:3 * units])
+		o = self.recurrent_activation(z[:, 3 * units:])
+		return o * self.activation(c), c
+
+
+class Dense():
+
+	def __init__(self, kernel, bias, activation='linear'):
+		self.kernel = np.asarray(kernel, dtype=np.float32)
+		self.bias = np.zeros(self.kernel.shape[1], dtype=np.float32) if bias is None else np.asarray(bias, np.float32)
+		self.activation = _activation(activation)
+
+	@staticmethod
+	def from_layer(layer):
+		config = layer.get_config()
+		weights = layer.get_weights()
+		return Dense(weights[0], weights[1] if config['use_bias'] else None, config['activation'])
+
+	def __call__(self, x):
+		return self.activation(x.dot(self.kernel) + self.bias)
+
+
+class BatchNormalization():
+	'''
+	BatchNormalization of keras at inference time (moving mean and variance).
+	'''
+
+	def __init__(self, gamma, beta, moving_mean, moving_variance, epsilon=1e-3):
+		self.scale = (np.asarray(gamma) / np.sqrt(np.asarray(moving_variance) + epsilon)).astype(np.float32)
+		self.offset = (np.asarray(beta) - np.asarray(moving_mean) * self.scale).astype(np.float32)
+
+	@staticmethod
+	def from_layer(layer):
+		config = layer.get_config()
+		weights = list(layer.get_weights())
+		gamma = weights.pop(0) if config['scale'] else 1.
+		beta = weights.pop(0) if config['center'] else 0.
+		moving_mean, moving_variance = weights
+		return BatchNormalization(gamma, beta, moving_mean, moving_variance, config['epsilon'])
+
+	def __call__(self, x):
+		return x * self.scale + self.offset
+
+
+class LSTMStepper():
+	'''
+	Predicts the next timestep of nb_sequences sequences, keeping the state of the LSTM between the calls.
+	'''
+
+	def __init__(self, cell, head, nb_sequences=1):
+		'''
+		:param cell: LSTMCell
+		:param head: function giving the output of the model from h (BatchNormalization, mdn layer...)
+		'''
+		self.cell = cell
+		self.head = head
+		self.reset(nb_sequences)
+
+	def reset(self, nb_sequences=None):
+		'''
+		Starts new sequences (state of 0).
+		'''
+		if nb_sequences is not None:
+			self.nb_sequences = nb_sequences
+		self.h = np.zeros((self.nb_sequences, self.cell.units), dtype=np.float32)
+		self.c = np.zeros((self.nb_sequences, self.cell.units), dtype=np.float32)
+
+	@property
+	def states(self):
+		return [self.h, self.c]
+
+	def step(self, inputs):
+		'''
+		:param inputs: (nb_sequences, LATENT_DIM + NB_ACTIONS) latent vectors + actions of the current timestep
+		:return: (nb_sequences, LATENT_DIM) outputs for the next timestep
+		'''
+		self.h, self.c = self.cell.step(np.asarray(inputs, dtype=np.float32), self.h, self.c)
+		return self.head(self.h)
+
+
+def rollout(step_function, start_latents, action_sequences, decoder=None, decode_batch_size=32):
+	'''
+	Advances many dreams at once : the latent vector predicted for a timestep is the input of the next one, with the
+	action of the sequence. The states of the LSTM are carried from one timestep to the next.
+
+	:param step_function: function (inputs, states) -> (next latent vectors, states) of a world model, states being
+		None at the first timestep (ex : LSTM.step)
+	:param start_latents: (N, LATENT_DIM) latent vectors of the first frames
+	:param action_sequences: (N, T, NB_ACTIONS) actions of every dream at every timestep
+	:param decoder: if not None, keras model of the VAE's decoder giving the frames of the predicted latent vectors
+	:return: (N, T, LATENT_DIM) predicted latent vectors, and (N, T) + IMG_SHAPE frames if a decoder is given
+	'''
+	action_sequences = np.asarray(action_sequences, dtype=np.float32)
+	nb_dreams, nb_steps = action_sequences.shape[:2]
+	latents = np.empty((nb_dreams, nb_steps, LATENT_DIM), dtype=np.float32)
+	latent_vectors = np.asarray(start_latents, dtype=np.float32)
+	states = None
+	for t in range(nb_steps):
+		latent_vectors, states = step_function(np.concatenate((latent_vectors, action_sequences[:, t]), axis=1), states)
+		latents[:, t] = latent_vectors
+	if decoder is None:
+		return latents
+	frames = decoder.predict(latents.reshape(-1, LATENT_DIM), batch_size=decode_batch_size)
+	return latents, frames.reshape((nb_dreams, nb_steps) + IMG_SHAPE)
+
+
+def benchmark_stepper(world_model, nb_steps=500):
+	'''
+	Displays the time of a step of one sequence with the NumPy stepper, the step model of keras (world_model.step)
+	and model.predict on a (1, 1, LATENT_DIM + NB_ACTIONS) input, and the difference between the stepper's and the
+	step model's predictions.
+
+	:param world_model: models.LSTM.LSTM or models.MDN_LSTM.MDN_LSTM (its mean prediction, temperature 0)
+	:return: {name : seconds per step}, maximum absolute difference
+	'''
+	inputs = np.random.rand(nb_steps, 1, LATENT_DIM + NB_ACTIONS).astype(np.float32)
+	stepper = world_model.stepper()
+	times = {}
+
+	t0 = time.perf_counter()
+	stepper_outputs = [stepper.step(x) for x in inputs]
+	times['numpy_stepper'] = (time.perf_counter() - t0) / nb_steps
+
+	# The first call builds the graph's functions
+	states = None
+	world_model.step(inputs[0], states)
+	t0 = time.perf_counter()
+	step_outputs = []
+	for x in inputs:
+		output, states = world_model.step(x, states)
+		step_outputs.append(output)
+	times['keras_step_model'] = (time.perf_counter() - t0) / nb_steps
+
+	world_model.model.predict(inputs[0][np.newaxis])
+	t0 = time.perf_counter()
+	for x in inputs:
+		world_model.model.predict(x[np.newaxis])
+	times['keras_predict'] = (time.perf_counter() - t0) / nb_steps
+
+	error = float(np.max(np.abs(np.concatenate(stepper_outputs) - np.concatenate(step_outputs))))
+	for name, seconds in times.items():
+		print('{0} : {1:.3f} ms/step'.format(name, 1000 * seconds))
+	print('max difference with the step model : {0:.2e}, target of {1:.1f} ms/step {2}'.format(
+		error, 1000 * LATENCY_TARGET, 'met' if times['numpy_stepper'] <= LATENCY_TARGET else 'NOT met'))
+	return times, error